@@ -1,2 +1,5 @@
 
 __version__ = "0.6.0"
+
+# Used by Django 1.7+, Django < 1.7 ignores it:
+default_app_config = "dbpreferences.apps.DBPreferencesConfig"
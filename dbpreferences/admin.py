@@ -39,10 +39,9 @@ class PreferenceAdmin(admin.ModelAdmin):
         preferences makes no sence, yet. (This hides the add button)
         
         Every user can only change existing preferences. Preferences entry are
-        added automatically by first accessing the preferences form.
+        added automatically by first accessing the preferences form, or for
+        all registered forms with: ./manage.py sync_preferences
         
-        TODO: If the forms must be registered, we can create all preferences
-        into database on first startup.
         see also:
         http://code.google.com/p/django-dbpreferences/issues/detail?id=5
         """
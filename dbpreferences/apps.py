@@ -0,0 +1,26 @@
+# coding: utf-8
+
+"""
+    dbpreferences app config
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+try:
+    from django.apps import AppConfig
+except ImportError: # Django < 1.7: see FormRegistry._check_discovered()
+    AppConfig = None
+
+
+if AppConfig is not None:
+    class DBPreferencesConfig(AppConfig):
+        name = "dbpreferences"
+        verbose_name = "DBPreferences"
+
+        def ready(self):
+            from dbpreferences.form_registry import form_registry
+            form_registry.autodiscover()
@@ -10,10 +10,10 @@
 
 from __future__ import absolute_import, print_function
 
+import hashlib
 import warnings
 
 import sys
-import pprint
 
 from django import forms
 from django.db import models
@@ -21,9 +21,11 @@ from django.contrib.sites.models import Site
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User, Group
 from django.utils import six
+from django.utils.encoding import force_bytes
 
-from dbpreferences.tools import forms_utils, easy_import, data_eval
+from dbpreferences.tools import forms_utils, easy_import, dict_codec
 from dbpreferences.tools.data_eval import DataEvalError
+from dbpreferences.tools.data_repr import data_repr
 
 
 
@@ -65,7 +67,7 @@ class DictData(dict):
         if isinstance(value, dict):
             super(DictData, self).__init__(value)
         else:
-            d = data_eval.data_eval(value)
+            d = dict_codec.loads(value)
             assert isinstance(d, dict)
             super(DictData, self).__init__(d)
 
@@ -80,20 +82,60 @@ class DictData(dict):
 
     def __repr__(self):
         """ used in django admin form field and in DictModelField.get_db_prep_save() """
-        return pprint.pformat(dict(self))
+        return data_repr(self)
+
+
+def get_fingerprint(text):
+    """
+    The length and the hash of the text, see DictModelField.get_text_length()
+
+    >>> get_fingerprint("{'foo': 'bar'}") == get_fingerprint(u"{'foo': 'bar'}")
+    True
+    >>> get_fingerprint("{'foo': 'bar'}")[0]
+    14
+    """
+    return (len(text), hashlib.sha1(force_bytes(text)).digest())
+
+
+class LazyDictDescriptor(object):
+    """
+    Model attribute for DictModelField (instead of the deprecated SubfieldBase)
+
+    The serialized text from the database would be hold in the instance
+    __dict__ and deserialized on the first read access. So nothing would be
+    parsed, if the value is never used (e.g.: admin changelist, count rows).
+
+    The fingerprint of the first assigned text (the one from the database)
+    is stored as snapshot, see DictModelField.has_changed()
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.field.attname]
+        if isinstance(value, six.string_types):
+            value = self.field.to_python(value)
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+        if isinstance(value, six.string_types):
+            instance.__dict__.setdefault(self.field.fingerprint_attname, get_fingerprint(value))
 
 
-# https://docs.djangoproject.com/en/1.8/releases/1.8/#subfieldbase
-@six.add_metaclass(models.SubfieldBase) # SubfieldBase will be removed in Django 2.0
 class DictModelField(models.Field):
     description = "DictModelField"
 
     """
     A dict field.
     Stores a python dict into a text field.
+    The value would be deserialized lazy, see LazyDictDescriptor.
 
-    FIXME: Will not work with .values(...), because of:
-        https://code.djangoproject.com/ticket/9619
+    .values(...) returns the serialized text, because the deserialization
+    is done by LazyDictDescriptor. Use DictData(text) to get the dict.
 
     https://docs.djangoproject.com/en/1.8/howto/custom-model-fields/#converting-values-to-python-objects
     
@@ -123,28 +165,20 @@ class DictModelField(models.Field):
     #     print("DictModelField.getattr: %20s: %r" % (item, result))
     #     return result
 
-    def to_python(self, value):
-        """
-        Converts the input value into the expected Python data type, raising
-        django.core.exceptions.ValidationError if the data can't be converted.
-        Returns the converted value. Subclasses should override this.
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(DictModelField, self).contribute_to_class(cls, name, *args, **kwargs)
+        self.fingerprint_attname = "_%s_fingerprint" % self.attname
+        self.prepared_attname = "_%s_prepared" % self.attname
+        setattr(cls, self.attname, LazyDictDescriptor(self))
 
-        to_python() will be not called since 1.8:
-        https://docs.djangoproject.com/en/1.8/releases/1.8/#subfieldbase
-        """
-        result = self.from_db_value(value)
-        # print("\nDictModelField.to_python() return", result, type(result))
-        return result
-
-    def from_db_value(self, value, expression=None, connection=None, context=None):
+    def to_python(self, value):
         """
         Converts the input value into the expected Python data type, raising
         django.core.exceptions.ValidationError if the data can't be converted.
-        Returns the converted value. Subclasses should override this.
+        Returns the converted value.
 
-        from_db_value() is new in new in django 1.8!
+        Called from LazyDictDescriptor on the first read access.
         """
-        # print("\nDictModelField.from_db_value()")
         if isinstance(value, dict):
             # print("is a dict")
             return value
@@ -157,25 +191,82 @@ class DictModelField(models.Field):
                 return None
 
         try:
-            result = DictData(value)
-            # print("\nDictModelField.from_db_value() return", result, type(result))
-            return result
+            return DictData(value)
         except DataEvalError as err:
             msg = "Can't deserialize %r: %s" % (value, err)
             raise forms.ValidationError(msg)
 
+    def has_changed(self, model_instance, text=None):
+        """
+        Returns True if the value is not the same as the text loaded from
+        (or last saved into) the database. Changes in nested objects would
+        be also detected, because the dict is serialized and compared with
+        the fingerprint snapshot. text: the already serialized value
+        """
+        fingerprint = model_instance.__dict__.get(self.fingerprint_attname)
+        if fingerprint is None:
+            return True
+
+        if text is None:
+            value = model_instance.__dict__[self.attname]
+            if value is None:
+                return True
+            text = self.get_prep_value(value)
+        return get_fingerprint(text) != fingerprint
+
+    def get_text_length(self, model_instance):
+        """
+        returns the length of the serialized value, as loaded from (or last
+        saved into) the database, without serializing it again.
+        None if the instance was never loaded/saved.
+        """
+        fingerprint = model_instance.__dict__.get(self.fingerprint_attname)
+        if fingerprint is not None:
+            return fingerprint[0]
+
+    def prepare(self, model_instance):
+        """
+        Serialize the value for has_changed() and the following save() of
+        the instance, so it's serialized only once: pre_save() uses the text.
+        The value must not be changed until the save.
+        """
+        text = self.get_prep_value(model_instance.__dict__[self.attname])
+        model_instance.__dict__[self.prepared_attname] = text
+        return text
+
+    def pre_save(self, model_instance, add):
+        """
+        Returns the serialized value, without deserialize it via
+        LazyDictDescriptor. So a never read text would be saved back as it is.
+        The saved text is the new fingerprint snapshot.
+        """
+        value = model_instance.__dict__[self.attname]
+        prepared = model_instance.__dict__.pop(self.prepared_attname, None)
+        if value is not None:
+            value = self.get_prep_value(value) if prepared is None else prepared
+            model_instance.__dict__[self.fingerprint_attname] = get_fingerprint(value)
+        return value
+
     def get_prep_value(self, value):
         """
         Perform preliminary non-db specific value checks and conversions.
+        Serialize the dict with the codec from settings.DBPREFERENCES_DICT_CODEC
+        A text is already serialized (e.g.: never read value from the database)
         """
-        if value is not None:
-            return repr(value)
+        if isinstance(value, six.string_types):
+            return value
+        elif value is not None:
+            return dict_codec.dumps(value)
         else:
             if self.null == False:
                 raise forms.ValidationError(_("This field cannot be null."))
             else:
                 return None
 
+    def value_to_string(self, obj):
+        """ used in serialization, e.g.: dumpdata """
+        return self.get_prep_value(obj.__dict__[self.attname])
+
     def formfield(self, **kwargs):
         # Always use own form field and widget:
         kwargs['form_class'] = DictFormField
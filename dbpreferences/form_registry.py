@@ -0,0 +1,150 @@
+# coding: utf-8
+
+"""
+    dbpreferences form registry
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    All DBPreferencesBaseForm classes from the "preference_forms" modules of
+    the installed apps. Collected once by autodiscover() in
+    DBPreferencesConfig.ready(), so Preference.get_form_class() doesn't
+    import the form class on every call. Django < 1.7 has no app registry:
+    There the modules of settings.INSTALLED_APPS are discovered on the first
+    listing of the registry.
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import inspect
+from importlib import import_module
+
+from django.conf import settings
+from django.utils.module_loading import module_has_submodule
+
+try:
+    from django.apps import apps
+except ImportError: # Django < 1.7
+    apps = None
+
+from dbpreferences.tools import easy_import, forms_utils
+
+
+# The filename in witch the form should be stored:
+PREF_FORM_FILENAME = "preference_forms"
+
+
+FieldInfo = collections.namedtuple("FieldInfo", "name field_type required initial help_text")
+
+
+class RegisteredForm(object):
+    """ A form class with the precomputed init dict and field metadata """
+    __slots__ = ("form_class", "init_dict", "fields")
+
+    def __init__(self, form_class):
+        self.form_class = form_class
+        self.init_dict = forms_utils.get_init_dict(form_class)
+        self.fields = tuple(
+            FieldInfo(
+                name=name,
+                field_type=field.__class__.__name__,
+                required=field.required,
+                initial=field.initial,
+                help_text=field.help_text,
+            )
+            for name, field in form_class.base_fields.items()
+        )
+
+    def get_init_dict(self):
+        """ returns a copy of the initial values """
+        return dict(self.init_dict)
+
+
+class FormRegistry(object):
+    def __init__(self):
+        self._forms = {} # (app_label, form_name) -> RegisteredForm
+        self._discovered = False
+
+    def register(self, form_class):
+        key = (form_class.Meta.app_label, form_class.__name__)
+        registered_form = RegisteredForm(form_class)
+        self._forms[key] = registered_form
+        return registered_form
+
+    def register_module(self, module):
+        """ register all preferences forms, defined in the given module """
+        from dbpreferences.forms import DBPreferencesBaseForm # import loop
+
+        for name, obj in vars(module).items():
+            if not inspect.isclass(obj) or obj.__module__ != module.__name__:
+                continue # e.g.: imported from other modules
+            if not issubclass(obj, DBPreferencesBaseForm):
+                continue
+            if not hasattr(getattr(obj, "Meta", None), "app_label"):
+                continue # a base class
+            self.register(obj)
+
+    def autodiscover(self):
+        """ import the preference_forms module of every installed app """
+        self._discovered = True
+        if apps is None: # Django < 1.7
+            app_modules = [(name, import_module(name)) for name in settings.INSTALLED_APPS]
+        else:
+            app_modules = [
+                (app_config.name, app_config.module) for app_config in apps.get_app_configs()
+            ]
+        for app_name, app_module in app_modules:
+            if module_has_submodule(app_module, PREF_FORM_FILENAME):
+                module = import_module("%s.%s" % (app_name, PREF_FORM_FILENAME))
+                self.register_module(module)
+
+    def _check_discovered(self):
+        """ Django < 1.7 doesn't call DBPreferencesConfig.ready(): discover on first use """
+        if apps is None and not self._discovered:
+            self.autodiscover()
+
+    def get(self, app_label, form_name):
+        """
+        returns the RegisteredForm.
+        Forms which are not discovered would be imported and registered.
+        """
+        try:
+            return self._forms[(app_label, form_name)]
+        except KeyError:
+            from_name = "%s.%s" % (app_label, PREF_FORM_FILENAME)
+            form_class = easy_import.import3(from_name, form_name)
+            return self.register(form_class)
+
+    def get_for_class(self, form_class):
+        """ returns the RegisteredForm of the given class, register it if needed """
+        registered_form = self._forms.get((form_class.Meta.app_label, form_class.__name__))
+        if registered_form is None:
+            return self.register(form_class)
+        if registered_form.form_class is not form_class:
+            # e.g.: a other class with the same name
+            return RegisteredForm(form_class)
+        return registered_form
+
+    def get_form_class(self, app_label, form_name):
+        return self.get(app_label, form_name).form_class
+
+    def __contains__(self, key):
+        self._check_discovered()
+        return key in self._forms
+
+    def __len__(self):
+        self._check_discovered()
+        return len(self._forms)
+
+    def keys(self):
+        self._check_discovered()
+        return self._forms.keys()
+
+    def items(self):
+        self._check_discovered()
+        return self._forms.items()
+
+
+form_registry = FormRegistry()
@@ -10,39 +10,238 @@
 """
 
 
+import copy
+import threading
 import warnings
 
 from django import forms
+from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.forms.fields import BooleanField
 from django.utils import six
 
+try:
+    from django.forms.utils import ErrorDict
+except ImportError: # Django < 1.7
+    from django.forms.util import ErrorDict
+
 from dbpreferences.models import Preference
 from dbpreferences.tools import forms_utils, easy_import
+from dbpreferences.tools.generation_cache import GenerationCache
+from dbpreferences.tools.shared_cache import SharedCache, model_snapshot
+from dbpreferences.tools.stale_cache import StaleWhileRevalidate, get_cache_version, \
+    set_if_current
 
 
-try:
-    # https://github.com/jedie/django-tools#local-sync-cache
-    from django_tools.local_sync_cache.local_sync_cache import LocalSyncCache
-except ImportError:
-    _PREFERENCES_CACHE = {}
+def to_snapshot(value):
+    """ Share only the Preference instance, the cleaned_data is local """
+    if isinstance(value, CachedPreferences):
+        return model_snapshot(value.instance)
+    return value # e.g.: the preload marker
+
+
+def from_snapshot(value):
+    if isinstance(value, Preference):
+        return CachedPreferences(value)
+    return value
+
+
+if getattr(settings, "DBPREFERENCES_CACHE_BACKEND", None) is not None:
+    _PREFERENCES_CACHE = SharedCache("form", settings.DBPREFERENCES_CACHE_BACKEND,
+        to_snapshot=to_snapshot, from_snapshot=from_snapshot
+    )
 else:
-    _PREFERENCES_CACHE = LocalSyncCache(id="DBPreferences_form")
+    _PREFERENCES_CACHE = GenerationCache(id="form")
+
+# sets the expire times of the _PREFERENCES_CACHE entries, if settings.DBPREFERENCES_CACHE_TTL is set
+_PREFERENCES_TTL = StaleWhileRevalidate()
+
+
+def get_cache_key(site_id, app_label, form_name):
+    return "%s.%s.%s" % (site_id, app_label, form_name)
+
+
+def get_preload_key(site_id):
+    """ cache key of the marker, that all preferences of the site are in the cache """
+    return "%s.preloaded" % site_id
+
+
+def invalidate_cache(cache_key):
+    """ remove only the given entry from the preferences cache """
+    try:
+        invalidate = _PREFERENCES_CACHE.invalidate
+    except AttributeError: # a normal dict
+        _PREFERENCES_CACHE.pop(cache_key, None)
+    else:
+        invalidate(cache_key)
+
+
+_INIT_LOCKS = {}
+_INIT_LOCKS_LOCK = threading.Lock()
+
+def get_init_lock(cache_key):
+    """
+    One lock per form key: Only one thread of this process would create the
+    missing entry, the others wait and read it.
+    """
+    with _INIT_LOCKS_LOCK:
+        try:
+            return _INIT_LOCKS[cache_key]
+        except KeyError:
+            lock = _INIT_LOCKS[cache_key] = threading.Lock()
+            return lock
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("Cached preferences are read-only!")
+
+
+class ReadOnlyDict(dict):
+    """
+    The cached cleaned_data, returned by get_cached_preferences() without
+    a copy, so it must not be changed. Created by read_only(), so the
+    nested values are read-only, too. Copies are normal dicts.
+
+    >>> d = read_only({"foo": "bar", "list": [1, {"a": 2}]})
+    >>> d["foo"]
+    'bar'
+    >>> d["foo"] = "new"
+    Traceback (most recent call last):
+    ...
+    TypeError: Cached preferences are read-only!
+    >>> d["list"][1]["a"] = 3
+    Traceback (most recent call last):
+    ...
+    TypeError: Cached preferences are read-only!
+    >>> d2 = copy.deepcopy(d)
+    >>> d2["list"][1]["a"] = 3
+    >>> d["list"] == [1, {"a": 2}]
+    True
+    """
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class ReadOnlyList(list):
+    """ A list in the cached cleaned_data, see ReadOnlyDict """
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+    __setslice__ = __delslice__ = _read_only # Python 2
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(self), memo)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def read_only(value):
+    """
+    returns the value with all dicts, lists and sets (also nested in tuples)
+    replaced by a ReadOnlyDict, ReadOnlyList or frozenset. They compare
+    equal to the originals. Other mutable objects are returned as they are.
+
+    >>> data = read_only([set([1]), (2, [3])])
+    >>> data == [set([1]), (2, [3])]
+    True
+    >>> data[1][1].append(4)
+    Traceback (most recent call last):
+    ...
+    TypeError: Cached preferences are read-only!
+    """
+    value_type = type(value)
+    if value_type is dict or value_type is ReadOnlyDict:
+        return ReadOnlyDict((key, read_only(item)) for key, item in value.items())
+    elif value_type is list or value_type is ReadOnlyList:
+        return ReadOnlyList(read_only(item) for item in value)
+    elif value_type is tuple:
+        return tuple(read_only(item) for item in value)
+    elif value_type is set:
+        return frozenset(value)
+    return value
+
+
+class CachedPreferences(object):
+    """
+    Entry in the preferences cache: The Preference instance and the
+    validated cleaned_data. The cleaned_data is only used for the same form
+    class and if the instance was not saved since the validation.
+    """
+    __slots__ = ("instance", "form_class", "lastupdatetime", "cleaned_data", "_cache_expires")
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.form_class = None
+        self.lastupdatetime = None
+        self.cleaned_data = None
+
+    def get_cleaned_data(self, form_class):
+        if self.form_class is form_class and self.lastupdatetime == self.instance.lastupdatetime:
+            return self.cleaned_data
+
+    def set_cleaned_data(self, form_class, cleaned_data):
+        self.form_class = form_class
+        self.lastupdatetime = self.instance.lastupdatetime
+        self.cleaned_data = read_only(dict(cleaned_data))
+
+
+def preload_cache(site):
+    """
+    Put all preferences of the given site into the cache, with one query.
+    Used on the first cache miss, if settings.DBPREFERENCES_PRELOAD is True
+    """
+    for instance in Preference.objects.get_site_preferences(site):
+        cache_key = get_cache_key(instance.site_id, instance.app_label, instance.form_name)
+        cache_entry = CachedPreferences(instance)
+        _PREFERENCES_TTL.stored(cache_entry)
+        _PREFERENCES_CACHE[cache_key] = cache_entry
+
+    # The marker would be removed with all entries, if the cache is cleared:
+    _PREFERENCES_CACHE[get_preload_key(site.id)] = True
+
+
+def refresh_cache_entry(cache_key, site_id, app_label, form_name):
+    """
+    Reload a expired entry in background.
+    The old entry (with the cached cleaned_data) is kept, if nothing changed.
+    The new entry is dropped, if the key was invalidated meanwhile.
+    """
+    version = get_cache_version(_PREFERENCES_CACHE, cache_key)
+    instance = Preference.objects.get(site=site_id, app_label=app_label, form_name=form_name)
+    old_entry = _PREFERENCES_CACHE.get(cache_key)
+    if old_entry is None or old_entry.instance.lastupdatetime != instance.lastupdatetime:
+        cache_entry = CachedPreferences(instance)
+        _PREFERENCES_TTL.stored(cache_entry)
+        set_if_current(_PREFERENCES_CACHE, cache_key, version, cache_entry)
+    else:
+        _PREFERENCES_TTL.stored(old_entry)
 
 
 class DBPreferencesBaseForm(forms.Form):
     preference_cache = {}
     def __init__(self, *args, **kwargs):
         assert(isinstance(self.Meta.app_label, six.string_types))
+        site = kwargs.pop("site", None)
         super(DBPreferencesBaseForm, self).__init__(*args, **kwargs)
 
-        self.current_site = Site.objects.get_current()
+        self.current_site = site or Site.objects.get_current()
         self.app_label = self.Meta.app_label
         self.form_name = self.__class__.__name__
-        self.cache_key = "%s.%s.%s" % (self.current_site.id, self.app_label, self.app_label)
+        self.cache_key = get_cache_key(self.current_site.id, self.app_label, self.form_name)
 
         for name, field in self.fields.items():
             if field.__class__.__name__.startswith("Model"):
@@ -52,21 +251,45 @@ class DBPreferencesBaseForm(forms.Form):
                 ) % (name, self.Meta.app_label)
                 raise AssertionError(msg)
 
-    def save_form_init(self):
+    @classmethod
+    def get_cached_preferences(cls, site=None):
+        """
+        returns the validated preferences of the given/current site as a
+        read-only dict, e.g.: UnittestForm.get_cached_preferences()["count"]
+
+        On a cache hit, the cached cleaned_data is returned without a form
+        instance and without a copy. On a miss: get_preferences() of a new
+        form instance fills the cache.
+        """
+        site_id = Site.objects.get_current().id if site is None else site.id
+        app_label = cls.Meta.app_label
+        form_name = cls.__name__
+        cache_key = get_cache_key(site_id, app_label, form_name)
         try:
-            Preference.objects.get(
-                site=self.current_site, app_label=self.app_label, form_name=self.form_name
-            ).delete()
-        except Preference.DoesNotExist:
+            cache_entry = _PREFERENCES_CACHE[cache_key]
+        except KeyError:
             pass
+        else:
+            cleaned_data = cache_entry.get_cleaned_data(cls)
+            if cleaned_data is not None:
+                _PREFERENCES_TTL.check(cache_key, cache_entry, refresh_cache_entry,
+                    cache_key, site_id, app_label, form_name
+                )
+                return cleaned_data
 
-        # Save initial form values into database
-        self.instance, form_dict = Preference.objects.save_form_init(
-            form=self,
-            site=self.current_site, app_label=self.app_label, form_name=self.form_name
-        )
+        return read_only(dict(cls(site=site).get_preferences()))
 
-        return form_dict
+    def save_form_init(self):
+        """
+        Save initial form values into database, if the entry doesn't exist.
+        Returns the preferences of the created or concurrently created entry.
+        """
+        with get_init_lock(self.cache_key):
+            self.instance, created = Preference.objects.get_or_create_form_init(
+                form=self,
+                site=self.current_site, app_label=self.app_label, form_name=self.form_name
+            )
+        return self.instance.preferences
 
     def __setitem__(self, key, value):
         if self.data == {}:
@@ -76,8 +299,13 @@ class DBPreferencesBaseForm(forms.Form):
         self.data[key] = value
 
     def save(self):
+        """
+        Save the preferences into the database, if they are changed.
+        (Unchanged data doesn't invalidate the cache.)
+        """
         self.instance.preferences = self.data
-        self.instance.save()
+        if self.instance.has_changed():
+            self.instance.save()
 
     def full_clean(self):
         """
@@ -105,10 +333,11 @@ class DBPreferencesBaseForm(forms.Form):
     def get_preferences(self):
         """
         return current preferences
-            1. get the dbpreferenced data from database
-            2. validate them
+            1. get the dbpreferenced data from cache or database
+            2. validate them, if not validated and cached before
             3. return cleaned_data dict
         """
+        cache_entry = None
         try:
             self.instance = self.get_db_instance()
         except Preference.DoesNotExist:
@@ -116,6 +345,15 @@ class DBPreferencesBaseForm(forms.Form):
         else:
             self.data = self.instance.preferences
 
+            cache_entry = self._cache_entry
+            cleaned_data = cache_entry.get_cleaned_data(self.__class__)
+            if cleaned_data is not None:
+                # Use the cached validation result
+                self.is_bound = True
+                self._errors = ErrorDict()
+                self.cleaned_data = dict(cleaned_data)
+                return self.cleaned_data
+
         # Cleans all of self.data and populates self._errors and self.cleaned_data
         self.is_bound = True
         self.full_clean()
@@ -142,21 +380,52 @@ class DBPreferencesBaseForm(forms.Form):
             )
 
         assert isinstance(self.cleaned_data, dict)
+        if cache_entry is not None:
+            cache_entry.set_cleaned_data(self.__class__, self.cleaned_data)
         return self.cleaned_data
 
+    def _load_cache_entry(self):
+        """ cache miss: preload all preferences of the site or get only this one """
+        if getattr(settings, "DBPREFERENCES_PRELOAD", False) \
+                and get_preload_key(self.current_site.id) not in _PREFERENCES_CACHE:
+            preload_cache(self.current_site)
+            try:
+                return _PREFERENCES_CACHE[self.cache_key]
+            except KeyError:
+                # Not in the preloaded rows -> doesn't exist, yet
+                raise Preference.DoesNotExist
+
+        instance = Preference.objects.get(
+            site=self.current_site, app_label=self.app_label, form_name=self.form_name
+        )
+        cache_entry = CachedPreferences(instance)
+        _PREFERENCES_TTL.stored(cache_entry)
+        _PREFERENCES_CACHE[self.cache_key] = cache_entry
+        return cache_entry
+
     def get_db_instance(self):
         """ returns the database entry instance """
         try:
-            self.instance = _PREFERENCES_CACHE[self.cache_key]
+            self._cache_entry = _PREFERENCES_CACHE[self.cache_key]
         except KeyError:
-            self.instance = Preference.objects.get(
-                site=self.current_site, app_label=self.app_label, form_name=self.form_name
+            self._cache_entry = self._load_cache_entry()
+        else:
+            # Serve the entry, but reload it in background, if it's expired:
+            _PREFERENCES_TTL.check(self.cache_key, self._cache_entry, refresh_cache_entry,
+                self.cache_key, self.current_site.id, self.app_label, self.form_name
             )
-            _PREFERENCES_CACHE[self.cache_key] = self.instance
 
+        self.instance = self._cache_entry.instance
         return self.instance
 
 
-@receiver(post_save, sender=Preference)
-def clear_cache(sender, **kwargs):
-    _PREFERENCES_CACHE.clear()
+@receiver(post_save)
+@receiver(post_delete)
+def clear_cache(sender, instance, **kwargs):
+    """
+    invalidate only the cache entry of the changed preferences.
+    Connected without a sender, because the preloaded instances (see
+    get_site_preferences()) are of a deferred Preference subclass.
+    """
+    if isinstance(instance, Preference):
+        invalidate_cache(get_cache_key(instance.site_id, instance.app_label, instance.form_name))
@@ -0,0 +1,110 @@
+# coding: utf-8
+
+"""
+    sync_preferences
+    ~~~~~~~~~~~~~~~~
+
+    Create the missing Preference entries of all registered preference forms
+    for all sites (e.g. at deploy time), so no request must create them.
+    Reports also the existing entries, which form has gained or lost fields.
+
+    e.g.:
+        ./manage.py sync_preferences
+        ./manage.py sync_preferences --site=1 --dry-run
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+from optparse import make_option
+
+import django
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+
+from dbpreferences.forms import get_preload_key, invalidate_cache
+from dbpreferences.form_registry import form_registry
+from dbpreferences.models import Preference
+
+
+class Command(BaseCommand):
+    help = "Create missing preferences entries of all registered forms for all sites"
+
+    if django.VERSION < (1, 8):
+        # Django < 1.8 doesn't call add_arguments()
+        option_list = BaseCommand.option_list + (
+            make_option("--site", action="append", type="int", dest="site_ids",
+                help="Only for the site with this id (can be used multiple times)"
+            ),
+            make_option("--batch-size", type="int", default=100, dest="batch_size",
+                help="Number of rows per INSERT query (default: 100)"
+            ),
+            make_option("--dry-run", action="store_true", dest="dry_run", default=False,
+                help="Only display what would be created"
+            ),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--site", action="append", type=int, dest="site_ids",
+            help="Only for the site with this id (can be used multiple times)"
+        )
+        parser.add_argument("--batch-size", type=int, default=100, dest="batch_size",
+            help="Number of rows per INSERT query (default: 100)"
+        )
+        parser.add_argument("--dry-run", action="store_true", dest="dry_run",
+            help="Only display what would be created"
+        )
+
+    def handle(self, *args, **options):
+        sites = Site.objects.all()
+        if options["site_ids"]:
+            sites = sites.filter(id__in=options["site_ids"])
+        sites = list(sites)
+        registered_forms = sorted(form_registry.items())
+
+        # The site is needed for the output of the instances:
+        existing = Preference.objects.filter(site__in=sites).select_related("site").only(
+            "site", "app_label", "form_name", "preferences"
+        )
+        existing_keys = set()
+        for instance in existing:
+            key = (instance.app_label, instance.form_name)
+            existing_keys.add((instance.site_id,) + key)
+            if key not in form_registry:
+                self.stdout.write("%s: form is not registered" % instance)
+                continue
+            self.check_fields(instance, form_registry.get(*key))
+
+        new_entries = []
+        for site in sites:
+            for (app_label, form_name), registered_form in registered_forms:
+                if (site.id, app_label, form_name) in existing_keys:
+                    continue
+                new_entries.append(Preference(
+                    site=site, app_label=app_label, form_name=form_name,
+                    preferences=registered_form.get_init_dict(),
+                ))
+                self.stdout.write("create: %s.%s for site %s" % (app_label, form_name, site))
+
+        if new_entries and not options["dry_run"]:
+            Preference.objects.bulk_create(new_entries, batch_size=options["batch_size"])
+            # bulk_create() sends no post_save signal:
+            for site_id in set(entry.site_id for entry in new_entries):
+                invalidate_cache(get_preload_key(site_id))
+
+        self.stdout.write("%i preferences entries %s, %i exists." % (
+            len(new_entries), "missing" if options["dry_run"] else "created", len(existing_keys)
+        ))
+
+    def check_fields(self, instance, registered_form):
+        """ report fields, that were added/removed in the form class """
+        form_fields = set(field.name for field in registered_form.fields)
+        stored_fields = set(instance.preferences.keys())
+        gained = sorted(form_fields - stored_fields)
+        if gained:
+            self.stdout.write("%s: new fields: %s" % (instance, ", ".join(gained)))
+        lost = sorted(stored_fields - form_fields)
+        if lost:
+            self.stdout.write("%s: removed fields: %s" % (instance, ", ".join(lost)))
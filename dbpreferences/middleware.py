@@ -1,16 +1,43 @@
 
+import copy
+from functools import partial, wraps
+
+from django.conf import settings
+from django.utils.decorators import available_attrs
+from django.utils.functional import SimpleLazyObject, empty
+
 from dbpreferences.models import UserSettings
+from dbpreferences.tools.generation_cache import check_caches_on_access
+
+
+# How many times SettingsDict.save() merges and retries on a VersionConflict:
+SAVE_RETRIES = getattr(settings, "DBPREFERENCES_USER_SETTINGS_SAVE_RETRIES", 3)
+
 
+def get_write_behind_queue():
+    """ returns the write-behind queue, or None if settings.DBPREFERENCES_WRITE_BEHIND is not enabled """
+    if not getattr(settings, "DBPREFERENCES_WRITE_BEHIND", False):
+        return None
+    # Imported only if enabled: The write-behind needs Django 1.8 (Case/When)
+    from dbpreferences import write_behind
+    return write_behind.get_write_behind_queue()
 
 
 class SettingsDict(dict):
     def __init__(self, user, *args, **kwargs):
         self.user = user
-        self.modified = False
+        self.modified_keys = set()
+        self._create = False
         self._loaded = False
         self._model_instance = None
+        self._loaded_settings = {} # The unchanged settings from the database/cache
         super(SettingsDict, self).__init__(*args, **kwargs)
 
+    @property
+    def modified(self):
+        """ True if settings must be created or values are really changed """
+        return self._create or bool(self.modified_keys)
+
     def get(self, key, default):
         self.load()
         if not key in self:
@@ -23,22 +50,45 @@ class SettingsDict(dict):
         return dict.__getitem__(self, key)
 
     def __setitem__(self, key, value):
-        self.modified = True
+        """
+        set the value and mark the key as modified, if the value is not the
+        same as the loaded one. Compared with the loaded settings, because a
+        mutable value can be changed in place before it's set again, e.g.:
+            values = settings["key"]; values.append(1); settings["key"] = values
+        """
+        self.load()
+        if key in self._loaded_settings:
+            old_value = self._loaded_settings[key]
+            if type(old_value) is type(value) and old_value == value:
+                self.modified_keys.discard(key)
+                dict.__setitem__(self, key, value)
+                return
+        self.modified_keys.add(key)
         dict.__setitem__(self, key, value)
 
     def load(self):
         if self._loaded:
             return
 
+        if not self.user.is_authenticated():
+            # Nothing stored for anonymous users, see save()
+            self._loaded = True
+            return
+
         try:
-            self._model_instance, settings_dict = UserSettings.objects.get_settings(self.user)
+            cached_instance, settings_dict = UserSettings.objects.get_settings(self.user)
         except UserSettings.DoesNotExist:
-            self.modified = True # Create it at the end
+            self._create = True # Create it at the end
         else:
-            # Use existing data
+            # The cached instance is shared by all threads: save() needs
+            # a own instance with the version we have read.
+            self._model_instance = copy.copy(cached_instance)
+            # Use existing data. A own copy: changed mutable values must
+            # not change the cached settings.
             settings_dict = self._model_instance.settings
             assert isinstance(settings_dict, dict)
-            dict.update(self, settings_dict)
+            self._loaded_settings = settings_dict
+            dict.update(self, copy.deepcopy(settings_dict))
 
         self._loaded = True
 
@@ -49,29 +99,118 @@ class SettingsDict(dict):
             return
 
         if self._model_instance == None:
-            self._model_instance, created = UserSettings.objects.get_or_create(user=self.user,
-                defaults={"settings": self, "createby": self.user, "lastupdateby": self.user}
-            )
-            if created:
+            created = self._get_or_create()
+        else:
+            created = False
+
+        if not created:
+            self._model_instance.settings = self
+            queue = get_write_behind_queue()
+            if queue is None or not queue.add(self._model_instance, self.modified_keys):
+                self._save_instance()
+
+        self.modified_keys.clear()
+        self._loaded_settings = copy.deepcopy(dict(self))
+        self._create = False
+
+    def _get_or_create(self):
+        """
+        Create the entry with the current settings. Returns False, if it was
+        created by a concurrent request: Our changed keys are merged into it.
+        """
+        self._model_instance, created = UserSettings.objects.get_or_create(user=self.user,
+            defaults={"settings": self, "createby": self.user, "lastupdateby": self.user}
+        )
+        if not created:
+            self._merge(self._model_instance)
+        return created
+
+    def _merge(self, instance):
+        """ Use the settings of the given instance, with only the keys changed by us """
+        settings_dict = dict(instance.settings)
+        for key in self.modified_keys:
+            settings_dict[key] = dict.__getitem__(self, key)
+        dict.clear(self)
+        dict.update(self, settings_dict)
+        self._loaded_settings = instance.settings
+        self._model_instance = instance
+
+    def _save_instance(self):
+        """
+        Optimistic concurrency: If the entry was saved concurrently, merge
+        our changed keys into the current entry and try again. If it was
+        deleted concurrently, create it again.
+        """
+        for retry in range(SAVE_RETRIES + 1):
+            try:
+                self._model_instance.save(skip_unchanged=True)
+            except UserSettings.VersionConflict:
+                if retry == SAVE_RETRIES:
+                    raise
+                try:
+                    self._merge(UserSettings.objects.get(pk=self._model_instance.pk))
+                except UserSettings.DoesNotExist:
+                    if self._get_or_create():
+                        return
+                self._model_instance.settings = self
+            else:
                 return
 
-        self._model_instance.settings = self
-        self._model_instance.save()
+
+def dbpreferences_exempt(view_func):
+    """
+    Mark a view, that doesn't use request.user_settings:
+    DBPreferencesMiddleware would not load or save anything for it.
+    """
+    def wrapped_view(*args, **kwargs):
+        return view_func(*args, **kwargs)
+    wrapped_view.dbpreferences_exempt = True
+    return wraps(view_func, assigned=available_attrs(view_func))(wrapped_view)
 
 
 class DBPreferencesMiddleware(object):
+    """
+    request.user_settings is a lazy SettingsDict: It's created and loaded
+    on the first access and saved after the view, if it was changed.
+    Requests that never access it cost only the attribute.
+
+    Works in settings.MIDDLEWARE_CLASSES and as new-style middleware in
+    settings.MIDDLEWARE. Nothing is done for request paths starting with
+    one of settings.DBPREFERENCES_MIDDLEWARE_EXCLUDE_PATHS (e.g. "/static/")
+    and for views decorated with dbpreferences_exempt.
+    """
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+        self.exclude_paths = tuple(getattr(settings, "DBPREFERENCES_MIDDLEWARE_EXCLUDE_PATHS", ()))
+
+    def __call__(self, request):
+        self.process_request(request)
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
     def process_request(self, request):
-        request.user_settings = SettingsDict(request.user)
+        if self.exclude_paths and request.path_info.startswith(self.exclude_paths):
+            return
+        check_caches_on_access() # drop cache entries, changed in other processes
+        request.user_settings = SimpleLazyObject(partial(SettingsDict, request.user))
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, "dbpreferences_exempt", False):
+            request.__dict__.pop("user_settings", None)
 
     def process_response(self, request, response):
         """ If user settings changes -> save it into database """
         try:
-            modified = request.user_settings.modified
+            user_settings = request.user_settings
         except AttributeError:
-            pass
-        else:
-            if modified:
-                # "was modified -> save"
-                request.user_settings.save()
+            return response
+
+        if isinstance(user_settings, SimpleLazyObject) and user_settings._wrapped is empty:
+            # Never accessed in this request
+            return response
+
+        if user_settings.modified:
+            # "was modified -> save"
+            user_settings.save()
 
         return response
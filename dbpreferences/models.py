@@ -15,35 +15,40 @@
 """
 
 import sys
-import pprint
+import time
 
 from django import forms
-from django.db import models
+from django.conf import settings
+from django.db import models, router, transaction
 from django.contrib.sites.models import Site
 from django.utils.translation import ugettext as _
 from django.contrib.auth.models import User, Group
 from django.core.exceptions import ValidationError
 from django.utils.encoding import python_2_unicode_compatible
 
-from dbpreferences.tools import forms_utils, easy_import, data_eval
+from dbpreferences.tools import dict_codec
+from dbpreferences.tools.data_repr import data_repr
 from dbpreferences.fields import DictModelField, DictField
-
-# The filename in witch the form should be stored:
-PREF_FORM_FILENAME = "preference_forms"
+from dbpreferences.tools.generation_cache import GenerationCache
+from dbpreferences.tools.lru_cache import LRUCache
+from dbpreferences.tools.shared_cache import SharedCache, model_snapshot
+from dbpreferences.tools.stale_cache import StaleWhileRevalidate, get_cache_version, \
+    set_if_current
+from dbpreferences.form_registry import PREF_FORM_FILENAME, form_registry
 
 
 def serialize(data):
-    return pprint.pformat(data)
+    return data_repr(data)
 
 def deserialize(stream):
-    return data_eval.data_eval(stream)
+    return dict_codec.loads(stream)
 
 
 class PreferencesManager(models.Manager):
     """ Manager class for Preference model """
     def save_form_init(self, form, site, app_label, form_name):
         """ save the initial form values as the preferences into the database """
-        form_dict = forms_utils.get_init_dict(form)
+        form_dict = form_registry.get_for_class(form.__class__).get_init_dict()
         new_entry = Preference(
             site=site,
             app_label=app_label,
@@ -53,6 +58,29 @@ class PreferencesManager(models.Manager):
         new_entry.save()
         return new_entry, form_dict
 
+    def get_or_create_form_init(self, form, site, app_label, form_name):
+        """
+        returns (instance, created). Creates the entry with the initial form
+        values, if not exist. Race-free: get_or_create() inserts in a savepoint
+        and reads the entry again on a IntegrityError, if it was created
+        concurrently by a other thread/process.
+        """
+        return self.get_or_create(
+            site=site, app_label=app_label, form_name=form_name,
+            defaults={
+                "preferences": form_registry.get_for_class(form.__class__).get_init_dict()
+            }
+        )
+
+    def get_site_preferences(self, site):
+        """
+        returns all preferences of the given site with one query.
+        Only the columns used by DBPreferencesBaseForm would be fetched.
+        """
+        return self.filter(site=site).only(
+            "id", "site", "app_label", "form_name", "preferences", "lastupdatetime"
+        )
+
     def get_pref(self, form):
         """
         returns the preferences for the given form
@@ -125,11 +153,13 @@ class Preference(models.Model):
         if message_dict:
             raise ValidationError(message_dict)
 
+    def has_changed(self):
+        """ Are the preferences changed since loaded/saved? """
+        return self._meta.get_field("preferences").has_changed(self)
+
     def get_form_class(self):
         """ returns the form class for this preferences item """
-        from_name = "%s.%s" % (self.app_label, PREF_FORM_FILENAME)
-        form = easy_import.import3(from_name, self.form_name)
-        return form
+        return form_registry.get_form_class(self.app_label, self.form_name)
 
     def __str__(self):
         return u"Preferences for %s.%s.%s" % (self.site, self.app_label, self.form_name)
@@ -144,33 +174,225 @@ class Preference(models.Model):
 #-----------------------------------------------------------------------------
 
 
-try:
-    # https://github.com/jedie/django-tools#local-sync-cache
-    from django_tools.local_sync_cache.local_sync_cache import LocalSyncCache
-except ImportError:
-    _USER_SETTINGS_CACHE = {}
+class CacheInvalidationManager(models.Manager):
+    def get_generation(self):
+        """ returns the current generation, 0 if the table is empty """
+        generations = self.order_by("-id").values_list("id", flat=True)[:1]
+        return generations[0] if generations else 0
+
+    def get_last_generations(self, count):
+        """ returns the ids of the last count generations, sorted """
+        return sorted(self.order_by("-id").values_list("id", flat=True)[:count])
+
+    def get_entries(self, generation, older_generations=()):
+        """
+        returns (generation, cache_id, key) of the given and all newer
+        generations and of the given older generations, sorted by generation.
+        """
+        query = models.Q(id__gte=generation)
+        if older_generations:
+            query |= models.Q(id__in=older_generations)
+        return list(
+            self.filter(query).order_by("id").values_list("id", "cache_id", "key")
+        )
+
+    def add_entry(self, cache_id, key):
+        """ bump the generation and returns it """
+        return self.create(cache_id=cache_id, key=key).id
+
+    def add_entries(self, cache_id, keys):
+        """
+        bump the generation for all keys with one INSERT and returns the
+        current generation (bulk_create() doesn't set the ids)
+        """
+        self.bulk_create([CacheInvalidation(cache_id=cache_id, key=key) for key in keys])
+        return self.get_generation()
+
+    def prune(self, generation):
+        """ delete the given and all older generations """
+        self.filter(id__lte=generation).delete()
+
+
+@python_2_unicode_compatible
+class CacheInvalidation(models.Model):
+    """
+    Log of the invalidated cache entries.
+    The id is the monotonically increasing generation number,
+    see dbpreferences.tools.generation_cache
+    """
+    objects = CacheInvalidationManager()
+
+    cache_id = models.CharField(max_length=64, help_text="id of the GenerationCache")
+    key = models.CharField(max_length=255, blank=True,
+        help_text="invalidated cache key, empty: the complete cache was cleared")
+    createtime = models.DateTimeField(auto_now_add=True, help_text="Create time",)
+
+    def __str__(self):
+        return u"Generation %s: %s %r" % (self.id, self.cache_id, self.key)
+
+    class Meta:
+        ordering = ("-id",)
+        verbose_name = verbose_name_plural = "cache invalidations"
+
+
+#-----------------------------------------------------------------------------
+
+
+def user_settings_snapshot(value):
+    user_settings_instance, user_settings = value
+    if user_settings_instance is None:
+        return value # negative entry
+    return model_snapshot(user_settings_instance)
+
+
+def user_settings_from_snapshot(snapshot):
+    if isinstance(snapshot, tuple):
+        return snapshot # negative entry
+    return (snapshot, snapshot.settings)
+
+
+def user_settings_size(value):
+    """
+    estimated memory usage of a cache entry: the length of the serialized
+    settings. The cached instances are loaded or saved, so the length of
+    the text in the database is known and nothing is serialized again.
+    """
+    user_settings_instance, user_settings = value
+    if user_settings_instance is not None: # not a negative entry
+        size = user_settings_instance._meta.get_field("settings").get_text_length(
+            user_settings_instance
+        )
+        if size is not None:
+            return size
+    return len(data_repr(user_settings))
+
+
+# Seconds to cache that a user has no UserSettings entry:
+USER_SETTINGS_NEGATIVE_TTL = getattr(settings, "DBPREFERENCES_USER_SETTINGS_NEGATIVE_TTL", 60)
+
+# Bounds of the user settings cache: max. number of users and memory usage:
+USER_SETTINGS_CACHE_SIZE = getattr(settings, "DBPREFERENCES_USER_SETTINGS_CACHE_SIZE", 10000)
+USER_SETTINGS_CACHE_MEMORY = getattr(settings,
+    "DBPREFERENCES_USER_SETTINGS_CACHE_MEMORY", 10 * 1024 * 1024
+)
+
+if getattr(settings, "DBPREFERENCES_CACHE_BACKEND", None) is not None:
+    _USER_SETTINGS_CACHE = SharedCache("user_settings", settings.DBPREFERENCES_CACHE_BACKEND,
+        to_snapshot=user_settings_snapshot, from_snapshot=user_settings_from_snapshot,
+        local=LRUCache(USER_SETTINGS_CACHE_SIZE, USER_SETTINGS_CACHE_MEMORY,
+            sizeof=lambda entry: user_settings_size(entry[1]) # entry: (versions, value, ...)
+        )
+    )
 else:
-    _USER_SETTINGS_CACHE = LocalSyncCache(id="DBPreferences_user_settings")
+    _USER_SETTINGS_CACHE = GenerationCache(id="user_settings",
+        maxsize=USER_SETTINGS_CACHE_SIZE, maxmemory=USER_SETTINGS_CACHE_MEMORY,
+        sizeof=user_settings_size,
+    )
+
+# sets the expire times of the _USER_SETTINGS_CACHE entries, if settings.DBPREFERENCES_CACHE_TTL is set
+_USER_SETTINGS_TTL = StaleWhileRevalidate()
+
+
+def get_user_settings_cache_key(user_id):
+    # The GenerationCache gets the invalidated keys as strings from the database
+    return "%s" % user_id
+
+
+def invalidate_user_settings_cache(user_id):
+    """ remove only the entry of the given user from the user settings cache """
+    cache_key = get_user_settings_cache_key(user_id)
+    try:
+        invalidate = _USER_SETTINGS_CACHE.invalidate
+    except AttributeError: # a normal dict
+        _USER_SETTINGS_CACHE.pop(cache_key, None)
+    else:
+        invalidate(cache_key)
+
+
+def invalidate_user_settings_cache_many(user_ids):
+    """ invalidate_user_settings_cache() for many users, with one INSERT into the log """
+    cache_keys = [get_user_settings_cache_key(user_id) for user_id in user_ids]
+    try:
+        invalidate_many = _USER_SETTINGS_CACHE.invalidate_many
+    except AttributeError: # a normal dict
+        for cache_key in cache_keys:
+            _USER_SETTINGS_CACHE.pop(cache_key, None)
+    else:
+        invalidate_many(cache_keys)
+
+
+def update_user_settings_cache(user_settings_instance):
+    """ put the given instance into the user settings cache of this process """
+    _USER_SETTINGS_TTL.stored(user_settings_instance)
+    _USER_SETTINGS_CACHE[get_user_settings_cache_key(user_settings_instance.user_id)] = (
+        user_settings_instance, user_settings_instance.settings
+    )
+
+
+def refresh_user_settings(user_id):
+    """ Reload a expired entry in background, dropped if it's invalidated meanwhile """
+    cache_key = get_user_settings_cache_key(user_id)
+    version = get_cache_version(_USER_SETTINGS_CACHE, cache_key)
+    user_settings_instance = UserSettings.objects.get(user=user_id)
+    _USER_SETTINGS_TTL.stored(user_settings_instance)
+    set_if_current(_USER_SETTINGS_CACHE, cache_key, version,
+        (user_settings_instance, user_settings_instance.settings)
+    )
 
 
 class UserSettingsManager(models.Manager):
     def get_settings(self, user):
-        """ Cached access for getting UserSettings instance and settings. """
+        """
+        Cached access for getting UserSettings instance and settings.
+        Users without a UserSettings entry are cached, too: The cache entry
+        is (None, expire time) and would be removed by saving a new entry.
+        """
         if not user.is_authenticated():
             raise UserSettings.DoesNotExist("No settings for anonymous!")
 
+        cache_key = get_user_settings_cache_key(user.pk)
         try:
-            (user_settings_instance, user_settings) = _USER_SETTINGS_CACHE[user.pk]
+            (user_settings_instance, user_settings) = _USER_SETTINGS_CACHE[cache_key]
         except KeyError:
-            user_settings_instance = self.get(user=user)
+            user_settings_instance = None
+        else:
+            if user_settings_instance is None: # negative entry
+                if user_settings > time.time():
+                    raise UserSettings.DoesNotExist("No settings for %r (cached)" % user)
+            else:
+                # Serve the entry, but reload it in background, if it's expired:
+                _USER_SETTINGS_TTL.check(cache_key, user_settings_instance,
+                    refresh_user_settings, user.pk
+                )
+
+        if user_settings_instance is None:
+            try:
+                user_settings_instance = self.get(user=user)
+            except UserSettings.DoesNotExist:
+                _USER_SETTINGS_CACHE[cache_key] = (None, time.time() + USER_SETTINGS_NEGATIVE_TTL)
+                raise
             user_settings = user_settings_instance.settings
-            _USER_SETTINGS_CACHE[user.pk] = (user_settings_instance, user_settings)
+            update_user_settings_cache(user_settings_instance)
+
         assert isinstance(user_settings, dict)
         return user_settings_instance, user_settings
 
+    def get_cache_info(self):
+        """ returns the statistics (e.g. the evictions) of the user settings cache """
+        try:
+            return _USER_SETTINGS_CACHE.info()
+        except AttributeError: # e.g.: SharedCache
+            return _USER_SETTINGS_CACHE._local.info()
+
+class VersionConflict(Exception):
+    """ The UserSettings entry was changed (or deleted) concurrently """
+    pass
+
+
 @python_2_unicode_compatible
 class UserSettings(models.Model):
     objects = UserSettingsManager()
+    VersionConflict = VersionConflict
 
     user = models.OneToOneField(User, related_name="%(class)s_user")
     settings = DictModelField(null=False, blank=False,
@@ -182,11 +404,76 @@ class UserSettings(models.Model):
     lastupdatetime = models.DateTimeField(auto_now=True, help_text="Time of the last change.",)
     lastupdateby = models.ForeignKey(User, editable=False,
         related_name="%(class)s_lastupdateby", help_text="User how has last edit this entry.",)
+    version = models.PositiveIntegerField(default=0, editable=False,
+        help_text="Incremented on every change, for optimistic concurrency control.",)
+
+    def has_changed(self):
+        return self._meta.get_field("settings").has_changed(self)
 
     def save(self, *args, **kwargs):
-        """ save and update the cache """
-        _USER_SETTINGS_CACHE.clear()
-        return super(UserSettings, self).save(*args, **kwargs)
+        """
+        save and update the cache.
+        With skip_unchanged=True a existing entry is not saved, if the
+        settings are not changed. Other fields are not compared, so it's only
+        for callers which change only the settings, e.g. SettingsDict.
+
+        A existing entry is only updated, if the version in the database is
+        the same as in this instance. Otherwise nothing is saved and
+        VersionConflict is raised, see middleware.SettingsDict.save()
+        """
+        skip_unchanged = kwargs.pop("skip_unchanged", False)
+        if self._state.adding:
+            result = super(UserSettings, self).save(*args, **kwargs)
+        else:
+            field = self._meta.get_field("settings")
+            if skip_unchanged:
+                # Serialized only once, for the check and the UPDATE:
+                if not field.has_changed(self, field.prepare(self)):
+                    del self.__dict__[field.prepared_attname]
+                    return
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = set(kwargs["update_fields"]) | set(["version"])
+
+            fingerprint_attname = field.fingerprint_attname
+            old_fingerprint = self.__dict__.get(fingerprint_attname)
+            self._expected_version = self.version
+            self.version += 1
+            using = kwargs.get("using") or router.db_for_write(self.__class__, instance=self)
+            try:
+                # A own savepoint: the outer transaction is usable after a conflict
+                with transaction.atomic(using=using):
+                    result = super(UserSettings, self).save(*args, **kwargs)
+            except VersionConflict:
+                self.version = self._expected_version
+                self.__dict__[fingerprint_attname] = old_fingerprint
+                raise
+            finally:
+                del self._expected_version
+                self.__dict__.pop(field.prepared_attname, None)
+
+        invalidate_user_settings_cache(self.user_id)
+        return result
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        """ conditional UPDATE: only if nobody else has saved the entry since we read it """
+        expected_version = getattr(self, "_expected_version", None)
+        if expected_version is None:
+            return super(UserSettings, self)._do_update(
+                base_qs, using, pk_val, values, update_fields, forced_update
+            )
+        updated = super(UserSettings, self)._do_update(
+            base_qs.filter(version=expected_version), using, pk_val, values, update_fields, forced_update
+        )
+        if not updated:
+            raise VersionConflict(
+                "UserSettings %r: version %r is outdated" % (pk_val, expected_version)
+            )
+        return updated
+
+    def delete(self, *args, **kwargs):
+        result = super(UserSettings, self).delete(*args, **kwargs)
+        invalidate_user_settings_cache(self.user_id)
+        return result
 
     def __str__(self):
         return u"UserSettings for %r: %r" % (self.user, self.settings)
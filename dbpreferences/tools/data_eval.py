@@ -3,14 +3,30 @@
     ~~~~~~~~~
 
     Evaluate a Python expression string, but only Python data type objects:
-        - Constants, Dicts, Lists, Tuples
+        - Constants, Dicts, Lists, Tuples, Sets
+        - set() and frozenset() with none or one set/list/tuple argument
         - from datetime: datetime and timedelta
 
+    The pprint output subset (what dbpreferences stores) would be parsed
+    directly with a single pass scanner. Everything else would be parsed via
+    the ast module and converted by a AST walker.
+
+    data_eval() holds the parsed results in a LRU cache, keyed by a hash of
+    the source string. The cache size can be set via
+    settings.DBPREFERENCES_DATA_EVAL_CACHE_SIZE (0 disables the cache).
+
+    The parse costs are bounded by limits for the source length, the number
+    of nodes, the nesting depth, the length of a single string/number literal
+    and the number of datetime/timedelta arguments. See DEFAULT_LIMITS,
+    the values can be changed via settings.DBPREFERENCES_DATA_EVAL_LIMITS
+    (None disables a limit). Breaking a limit raise DataEvalLimitError.
+
     Error class hierarchy:
 
         DataEvalError
          +-- EvalSyntaxError (compiler SyntaxError)
          +-- UnsafeSourceError (errors from the AST walker)
+         +-- DataEvalLimitError (a limit from DEFAULT_LIMITS was exceeded)
 
     A full featured "safe data eval" can be found here:
         https://github.com/newville/asteval/
@@ -21,17 +37,46 @@
 
 import ast
 import datetime
+import hashlib
+import operator
+import re
+import sys
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils import six
+from django.utils.encoding import force_bytes
+
+from dbpreferences.tools.lru_cache import LRUCache
 
 NAME_MAP = {"none": None, "true": True, "false": False}
 
+# Calls without a module name, e.g.: "set()" and "frozenset({1, 2})"
+BUILTIN_CALLS = ("set", "frozenset")
+# Calls of the datetime module, e.g.: "datetime.timedelta(1)"
+DATETIME_CALLS = ("datetime", "timedelta")
+
+# Default max. number of parsed sources in the data_eval() cache:
+DEFAULT_CACHE_SIZE = 512
+
+# Default limits, can be changed via settings.DBPREFERENCES_DATA_EVAL_LIMITS
+DEFAULT_LIMITS = {
+    "max_length": 10 * 1024 * 1024, # characters of the complete source
+    "max_nodes": 1000000, # values and containers
+    "max_depth": 100, # nested containers
+    "max_string_length": 1024 * 1024, # characters of a single string/number literal
+    "max_call_args": 7, # arguments of a datetime.datetime()/datetime.timedelta() call
+}
+
 
 if six.PY2:
     AST_TEXT_NODES = ast.Str
 else:
     AST_TEXT_NODES = (ast.Str, ast.Bytes)
 
+# ast.Constant is used since Python 3.8 for all constant values
+AST_CONSTANT = getattr(ast, "Constant", None)
+
 
 def pprint_node(node):
     for attr in dir(node):
@@ -53,68 +98,359 @@ class UnsafeSourceError(DataEvalError):
     pass
 
 
+class DataEvalLimitError(DataEvalError):
+    """ The source exceeds one of the limits, see DEFAULT_LIMITS """
+    pass
+
+
+def get_limits(**overrides):
+    """
+    returns the DEFAULT_LIMITS updated with settings.DBPREFERENCES_DATA_EVAL_LIMITS
+    and the given keyword arguments.
+
+    >>> get_limits(max_depth=None)["max_depth"] is None
+    True
+    """
+    limits = DEFAULT_LIMITS.copy()
+    for source in (getattr(settings, "DBPREFERENCES_DATA_EVAL_LIMITS", {}), overrides):
+        for name, value in source.items():
+            if name not in DEFAULT_LIMITS:
+                raise ImproperlyConfigured(
+                    "Unknown data eval limit %r (existing limits: %s)" % (
+                        name, ", ".join(sorted(DEFAULT_LIMITS))
+                    )
+                )
+            limits[name] = value
+    return limits
+
+
+# Operators allowed in number expressions like "-1" or "1+2j"
+UNARY_OPERATORS = {
+    ast.UAdd: lambda args: + args[0],
+    ast.USub: lambda args: - args[0],
+}
+BINARY_OPERATORS = {
+    ast.Add: lambda args: args[0] + args[1],
+    ast.Sub: lambda args: args[0] - args[1],
+}
+
+# The value types of ast.Constant (used since Python 3.8) we accept:
+CONSTANT_TYPES = (
+    six.text_type, six.binary_type, bool, float, complex, type(None)
+) + six.integer_types
+NUMBER_TYPES = (float, complex) + six.integer_types
+TEXT_TYPES = (six.text_type, six.binary_type)
+
+
+def is_number_node(node):
+    """ Only numbers can be used as operands in unary and binary operations """
+    node_type = type(node)
+    if node_type in (ast.Num, ast.UnaryOp, ast.BinOp):
+        return True
+    if node_type is AST_CONSTANT:
+        return isinstance(node.value, NUMBER_TYPES) and not isinstance(node.value, bool)
+    return False
+
+
+def convert_name(node):
+    try:
+        return NAME_MAP[node.id.lower()]
+    except KeyError:
+        raise UnsafeSourceError("Name '%s' not supported." % node.id)
+
+
+def convert_constant(node):
+    if not isinstance(node.value, CONSTANT_TYPES):
+        raise KeyError # not a leaf -> DataEval._constant() raise the error
+    return node.value
+
+
+def convert_number_constant(node):
+    if not is_number_node(node):
+        raise KeyError # not a number -> not usable as operand
+    return node.value
+
+
+def convert_negative_number(node):
+    operand = node.operand
+    if type(node.op) is not ast.USub or type(operand) not in NUMBER_LEAVES:
+        raise KeyError # not a leaf -> use DataEval._unary_op()
+    return - NUMBER_LEAVES[type(operand)](operand)
+
+
+def build_list(args):
+    return args # args is always a new list
+
+
+def build_dict(args):
+    return dict(zip(args[::2], args[1::2]))
+
+
+# Tokens of the pprint subset, used in DataEval.scan()
+# Every token can start with whitespace and values can end with a separator.
+# Raw line breaks and null bytes in strings and ints with leading zeros are
+# rejected by the compiler, so they are not matched here (-> AST fallback).
+TEXT_PATTERN = r"""[uU]?(?:'[^'\\\r\n\x00]*(?:\\.[^'\\\r\n\x00]*)*'|"[^"\\\r\n\x00]*(?:\\.[^"\\\r\n\x00]*)*")"""
+INT_PATTERN = r"(?:0|[1-9]\d*)"
+TOKEN_RE = re.compile(r"""\s*(?:
+    (%(text)s)\s*(:)
+    |(%(text)s)(\s*,)?
+    |(%(int)s(?![\w.]))(\s*,)?
+    |((?:\d+\.\d*|\.\d+|\d+(?=[eE]))(?:[eE][-+]?\d+)?(?![\w.]))(\s*,)?
+    |(datetime\.[a-z]+\(\s*-?%(int)s(?:\s*,\s*-?%(int)s)*\s*\))(\s*,)?
+    |([A-Za-z_][\w.]*\s*\()
+    |([A-Za-z_]\w*\s*=)
+    |([A-Za-z_]\w*)(\s*,)?
+    |([\[({])
+    |([\])}])(\s*,)?
+    |([,:])
+    |([+-])
+)|(\s+)|(.)
+""" % {"text": TEXT_PATTERN, "int": INT_PATTERN}, re.VERBOSE | re.DOTALL)
+
+# match.lastindex -> (token kind, token group index, separator)
+TOKEN_KINDS = {
+    2: ("text", 1, ":"),
+    3: ("text", 3, None), 4: ("text", 3, ","),
+    5: ("int", 5, None), 6: ("int", 5, ","),
+    7: ("float", 7, None), 8: ("float", 7, ","),
+    9: ("int call", 9, None), 10: ("int call", 9, ","), # e.g.: datetime.datetime(2015, 1, 2)
+    11: ("call", 11, None),
+    12: ("keyword", 12, None),
+    13: ("name", 13, None), 14: ("name", 13, ","),
+    15: ("open", 15, None),
+    16: ("close", 16, None), 17: ("close", 16, ","),
+    18: ("separator", 18, None),
+    19: ("sign", 19, None),
+    20: ("space", 20, None),
+    21: ("unknown", 21, None),
+}
+
+CLOSING_BRACKETS = {"]": ("[",), ")": ("(", "call"), "}": ("{", "set", "dict")}
+
+
+class ScanFallback(Exception):
+    """ DataEval.scan() doesn't support the source -> use the AST """
+    pass
+
+
+def scan_text(token):
+    """ returns the string object of a text token """
+    if "\\" in token:
+        return ast.literal_eval(token)
+    if token[0] in "uU":
+        return six.text_type(token[2:-1])
+    if six.PY2 and isinstance(token, six.text_type):
+        # The same as in the AST: a unicode source contains utf-8 byte strings
+        return token[1:-1].encode("utf-8")
+    return token[1:-1]
+
+
 class DataEval(object):
-    def convert(self, node):
-        if isinstance(node, ast.Expression):
+    """
+    Converts a AST into Python objects.
+
+    The tree is walked iterative with a explicit stack, so deep nested data
+    doesn't hit the recursion limit: The stack contains AST nodes and
+    (build function, argument count) tuples. A node handler pushes a build
+    tuple and the child nodes. The build function would be called with the
+    converted child values, after all children are processed.
+
+    The node handler would be looked up in DISPATCH by the node type.
+    Every node type that is not in DISPATCH raise a UnsafeSourceError.
+    Containers with only leaf children (see LEAF_CONVERTERS) would be
+    build directly, without using the stack.
+
+    The limits (see DEFAULT_LIMITS) are taken from the settings and can be
+    changed with keyword arguments, e.g.: DataEval(max_depth=10)
+    The current nesting depth is the number of build tuples on the stack.
+    The node count and string length limits are only checked per node, if
+    the length of the source doesn't already bound them, see convert().
+    """
+    def __init__(self, **limits):
+        for name, value in get_limits(**limits).items():
+            if value is None:
+                value = sys.maxsize
+            setattr(self, name, value)
+        self._count_nodes = self._check_strings = True
+        self._leaf_converters = LEAF_CONVERTERS
+
+    def _limit_error(self, name, value):
+        raise DataEvalLimitError("%s %i exceeds the limit %i" % (
+            name, value, getattr(self, name)
+        ))
+
+    def convert(self, node, source_length=None):
+        """
+        source_length: the length of the parsed source. A string can't be
+        longer than the source and every counted node needs at least one
+        character, so these limits are not checked for short sources.
+        """
+        if type(node) is ast.Expression:
             node = node.body
 
-        if isinstance(node, AST_TEXT_NODES):
-            return node.s
-        elif isinstance(node, ast.Num):
-            return node.n
-        elif isinstance(node, ast.Tuple):
-            return tuple(map(self.convert, node.elts))
-        elif isinstance(node, ast.List):
-            return list(map(self.convert, node.elts))
-        elif isinstance(node, ast.Set):
-            return set(map(self.convert, node.elts))
-        elif isinstance(node, ast.Dict):
-            return dict((self.convert(k), self.convert(v)) for k, v
-                in zip(node.keys, node.values))
-        elif not six.PY2 and isinstance(node, ast.NameConstant):
-            # ast.NameConstant exists only in Py3 !
-            return node.value
-        elif isinstance(node, ast.UnaryOp) and \
-                isinstance(node.op, (ast.UAdd, ast.USub)) and \
-                isinstance(node.operand, (ast.Num, ast.UnaryOp, ast.BinOp)):
-            operand = self.convert(node.operand)
-            if isinstance(node.op, ast.UAdd):
-                return + operand
-            else:
-                return - operand
-        elif isinstance(node, ast.BinOp) and \
-                isinstance(node.op, (ast.Add, ast.Sub)) and \
-                isinstance(node.right, (ast.Num, ast.UnaryOp, ast.BinOp)) and \
-                isinstance(node.left, (ast.Num, ast.UnaryOp, ast.BinOp)):
-            left = self.convert(node.left)
-            right = self.convert(node.right)
-            if isinstance(node.op, ast.Add):
-                return left + right
-            else:
-                return left - right
-        elif isinstance(node, ast.Call):
-            return self._call(node)
-        elif isinstance(node, ast.Name):
-            key = node.id
-            key = key.lower()
+        self._count_nodes = source_length is None or source_length > self.max_nodes
+        self._check_strings = source_length is None or source_length > self.max_string_length
+        if self._check_strings:
+            self._leaf_converters = self._checked_leaf_converters()
+        else:
+            self._leaf_converters = LEAF_CONVERTERS
+        self._node_count = 1
+        self._depth = 0
+        dispatch = self.DISPATCH
+        values = []
+        stack = [node]
+        while stack:
+            item = stack.pop()
+            if type(item) is tuple:
+                self._depth -= 1
+                build, count = item
+                if count:
+                    args = values[-count:]
+                    del values[-count:]
+                else:
+                    args = []
+                values.append(build(args))
+                continue
+
             try:
-                return NAME_MAP[key]
-            except KeyError as err:
-                raise UnsafeSourceError("Name '%s' not supported." % node.id)
+                handler = dispatch[type(item)]
+            except KeyError:
+                self._unsafe(item)
+            handler(self, item, stack, values)
+
+        assert len(values) == 1
+        return values[0]
 
+    def _unsafe(self, node):
         raise UnsafeSourceError(
             "malformed node or string! repr: %r - dump %s" % (
                 repr(node), ast.dump(node)
             )
         )
 
-    def _call(self, node):
+    def _push_build(self, stack, build, nodes):
+        """ push the build tuple and the child nodes onto the stack """
+        self._depth += 1
+        if self._depth > self.max_depth:
+            self._limit_error("max_depth", self._depth)
+        stack.append((build, len(nodes)))
+        stack.extend(reversed(nodes))
+
+    def _push_items(self, stack, values, build, nodes):
+        if self._count_nodes:
+            self._node_count += len(nodes)
+            if self._node_count > self.max_nodes:
+                self._limit_error("max_nodes", self._node_count)
+        converters = self._leaf_converters
+        try:
+            # fast path: convert leaf nodes without the stack
+            args = [converters[type(node)](node) for node in nodes]
+        except KeyError:
+            self._push_build(stack, build, nodes)
+        else:
+            if self._depth >= self.max_depth:
+                self._limit_error("max_depth", self._depth + 1)
+            values.append(build(args))
+
+    def _checked_leaf_converters(self):
+        """ LEAF_CONVERTERS, the string leaves checked against max_string_length """
+        max_string_length = self.max_string_length
+
+        def convert_text(node):
+            value = node.s
+            if len(value) > max_string_length:
+                self._limit_error("max_string_length", len(value))
+            return value
+
+        def convert_checked_constant(node):
+            value = convert_constant(node)
+            self._check_string(value)
+            return value
+
+        converters = LEAF_CONVERTERS.copy()
+        for node_type in TEXT_LEAVES:
+            converters[node_type] = convert_text
+        if AST_CONSTANT is not None:
+            converters[AST_CONSTANT] = convert_checked_constant
+        return converters
+
+    def _check_string(self, value):
+        if isinstance(value, TEXT_TYPES) and len(value) > self.max_string_length:
+            self._limit_error("max_string_length", len(value))
+
+    def _text(self, node, stack, values):
+        value = node.s
+        if self._check_strings and len(value) > self.max_string_length:
+            self._limit_error("max_string_length", len(value))
+        values.append(value)
+
+    def _num(self, node, stack, values):
+        values.append(node.n)
+
+    def _name_constant(self, node, stack, values):
+        values.append(node.value)
+
+    def _constant(self, node, stack, values):
+        if not isinstance(node.value, CONSTANT_TYPES):
+            self._unsafe(node)
+        if self._check_strings:
+            self._check_string(node.value)
+        values.append(node.value)
+
+    def _tuple(self, node, stack, values):
+        self._push_items(stack, values, tuple, node.elts)
+
+    def _list(self, node, stack, values):
+        self._push_items(stack, values, build_list, node.elts)
+
+    def _set(self, node, stack, values):
+        self._push_items(stack, values, set, node.elts)
+
+    def _dict(self, node, stack, values):
+        nodes = []
+        for key, value in zip(node.keys, node.values):
+            if key is None: # {**foo} dict unpacking
+                self._unsafe(node)
+            nodes.append(key)
+            nodes.append(value)
+        self._push_items(stack, values, build_dict, nodes)
+
+    def _unary_op(self, node, stack, values):
+        try:
+            build = UNARY_OPERATORS[type(node.op)]
+        except KeyError:
+            self._unsafe(node)
+        if not is_number_node(node.operand):
+            self._unsafe(node)
+        self._push_build(stack, build, [node.operand])
+
+    def _bin_op(self, node, stack, values):
         try:
-            callable_name = node.func.attr
-        except AttributeError as err:
-            raise UnsafeSourceError(err)
+            build = BINARY_OPERATORS[type(node.op)]
+        except KeyError:
+            self._unsafe(node)
+        if not (is_number_node(node.left) and is_number_node(node.right)):
+            self._unsafe(node)
+        self._push_build(stack, build, [node.left, node.right])
+
+    def _name(self, node, stack, values):
+        values.append(convert_name(node))
+
+    def _call(self, node, stack, values):
+        if isinstance(node.func, ast.Name) and node.func.id in BUILTIN_CALLS:
+            callable_name = node.func.id
+            if node.keywords:
+                self._unsafe(node)
+        else:
+            try:
+                callable_name = node.func.attr
+            except AttributeError as err:
+                raise UnsafeSourceError(err)
 
-        callable_name = callable_name.lower()
+            callable_name = callable_name.lower()
+            if callable_name not in DATETIME_CALLS:
+                self._unsafe(node)
 
         method_name = "call_%s" % callable_name
         func = getattr(self, method_name, None)
@@ -122,15 +458,233 @@ class DataEval(object):
             raise ValueError("Func '%s' not exists for node: %s" % (
                 method_name, repr(node)
             ))
-        return func(node)
-
-    def call_datetime(self, node):
-        args = list(map(self.convert, node.args))
-        return datetime.datetime(*args)
 
-    def call_timedelta(self, node):
-        args = list(map(self.convert, node.args))
-        return datetime.timedelta(*args)
+        if getattr(node, "starargs", None) or getattr(node, "kwargs", None):
+            # *args and **kwargs in Python < 3.5
+            self._unsafe(node)
+        keyword_names = []
+        nodes = list(node.args)
+        for keyword in node.keywords:
+            if keyword.arg is None: # **kwargs in Python >= 3.5
+                self._unsafe(node)
+            keyword_names.append(keyword.arg)
+            nodes.append(keyword.value)
+        if len(nodes) > self.max_call_args:
+            self._limit_error("max_call_args", len(nodes))
+
+        positional_count = len(node.args)
+        def build(args):
+            kwargs = dict(zip(keyword_names, args[positional_count:]))
+            return func(*args[:positional_count], **kwargs)
+
+        self._push_items(stack, values, build, nodes)
+
+    def call_datetime(self, *args, **kwargs):
+        return datetime.datetime(*args, **kwargs)
+
+    def call_timedelta(self, *args, **kwargs):
+        return datetime.timedelta(*args, **kwargs)
+
+    def _set_items(self, name, args):
+        if not args:
+            return ()
+        if len(args) > 1 or not isinstance(args[0], (set, list, tuple)):
+            raise UnsafeSourceError("%s() needs none or one set, list or tuple argument" % name)
+        return args[0]
+
+    def call_set(self, *args):
+        return set(self._set_items("set", args))
+
+    def call_frozenset(self, *args):
+        return frozenset(self._set_items("frozenset", args))
+
+    def scan(self, source):
+        """
+        Parse the pprint output subset directly into Python objects, without
+        building a AST: dicts, lists, tuples, sets, strings, numbers,
+        NAME_MAP names, set(...)/frozenset(...) and
+        datetime.datetime(...)/datetime.timedelta(...)
+
+        The source would be parsed in a single pass with TOKEN_RE. The open
+        containers are hold in a explicit stack of [kind, items, extra] lists.
+        Raise ScanFallback for everything that is not supported.
+        """
+        max_nodes = self.max_nodes
+        max_depth = self.max_depth
+        max_string_length = self.max_string_length
+        node_count = 0
+
+        stack = []
+        frame = None
+        value = None
+        have_value = False
+        value_is_text = False # used for implicit string concatenation
+        sign = None
+
+        for match in TOKEN_RE.finditer(source):
+            kind, group, separator = TOKEN_KINDS[match.lastindex]
+            if kind == "space":
+                continue
+            token = match.group(group)
+
+            node_count += 1
+            if node_count > max_nodes:
+                self._limit_error("max_nodes", node_count)
+            if kind == "int" or kind == "float":
+                if len(token) > max_string_length:
+                    self._limit_error("max_string_length", len(token))
+
+            if sign is not None:
+                if kind == "int":
+                    value = int(token)
+                elif kind == "float":
+                    value = float(token)
+                else:
+                    raise ScanFallback
+                if sign == "-":
+                    value = - value
+                sign = None
+                have_value = True
+            elif kind == "text":
+                if not have_value:
+                    value = scan_text(token)
+                    have_value = value_is_text = True
+                elif value_is_text:
+                    value += scan_text(token)
+                else:
+                    raise ScanFallback
+                if len(value) > max_string_length:
+                    self._limit_error("max_string_length", len(value))
+            elif kind == "close":
+                if frame is None:
+                    raise ScanFallback
+                if have_value:
+                    self._scan_add(frame, value)
+                value = self._scan_close(frame, token)
+                have_value = True
+                value_is_text = False
+                stack.pop()
+                frame = stack[-1] if stack else None
+            elif kind == "separator":
+                if not have_value:
+                    raise ScanFallback
+                separator = token
+            elif have_value:
+                raise ScanFallback
+            elif kind == "int":
+                value = int(token)
+                have_value = True
+            elif kind == "float":
+                value = float(token)
+                have_value = True
+            elif kind == "name":
+                try:
+                    value = NAME_MAP[token.lower()]
+                except KeyError:
+                    raise ScanFallback
+                have_value = True
+            elif kind == "open":
+                if len(stack) >= max_depth:
+                    self._limit_error("max_depth", len(stack) + 1)
+                frame = [token, [], False]
+                stack.append(frame)
+            elif kind == "sign":
+                sign = token
+            elif kind == "int call":
+                name, _, args = token[:-1].partition("(")
+                if name[9:] not in DATETIME_CALLS:
+                    raise ScanFallback
+                func = getattr(self, "call_%s" % name[9:])
+                args = args.split(",")
+                if len(args) > self.max_call_args:
+                    self._limit_error("max_call_args", len(args))
+                for arg in args:
+                    if len(arg) > max_string_length:
+                        self._limit_error("max_string_length", len(arg))
+                value = func(*[int(arg) for arg in args])
+                have_value = True
+            elif kind == "call":
+                module_name, _, callable_name = token.rstrip("( \t\r\n").rpartition(".")
+                if module_name == "datetime" and callable_name.lower() in DATETIME_CALLS:
+                    func = getattr(self, "call_%s" % callable_name.lower())
+                elif not module_name and callable_name in BUILTIN_CALLS:
+                    func = getattr(self, "call_%s" % callable_name)
+                else:
+                    raise ScanFallback
+                if len(stack) >= max_depth:
+                    self._limit_error("max_depth", len(stack) + 1)
+                frame = ["call", [], [func, {}, None]]
+                stack.append(frame)
+            elif kind == "keyword" and frame is not None and frame[0] == "call" \
+                    and frame[2][2] is None:
+                frame[2][2] = token.rstrip("= \t\r\n")
+            else:
+                raise ScanFallback
+
+            if separator is not None:
+                if frame is None:
+                    raise ScanFallback
+                if separator == ",":
+                    if frame[0] == "[":
+                        frame[1].append(value)
+                    else:
+                        self._scan_add(frame, value)
+                        if frame[0] == "(":
+                            frame[2] = True # it's a tuple
+                else: # ":" after a dict key
+                    if frame[0] == "{" and not frame[1]:
+                        frame[0] = "dict"
+                    elif frame[0] != "dict" or len(frame[1]) % 2:
+                        raise ScanFallback
+                    frame[1].append(value)
+                have_value = value_is_text = False
+
+        if stack or sign is not None or not have_value:
+            raise ScanFallback
+        return value
+
+    def _scan_add(self, frame, value):
+        """ add a value to the container """
+        kind = frame[0]
+        if kind == "dict":
+            if not len(frame[1]) % 2: # value without key
+                raise ScanFallback
+        elif kind == "{":
+            frame[0] = "set"
+        elif kind == "call":
+            keywords = frame[2]
+            if keywords[2] is not None:
+                keywords[1][keywords[2]] = value
+                keywords[2] = None
+                return
+            elif keywords[1]: # positional argument after keyword argument
+                raise ScanFallback
+        frame[1].append(value)
+
+    def _scan_close(self, frame, token):
+        """ returns the object of a closed container """
+        kind, items, extra = frame
+        if kind not in CLOSING_BRACKETS[token]:
+            raise ScanFallback
+        if kind == "[":
+            return items
+        elif kind == "(":
+            if len(items) == 1 and not extra:
+                return items[0] # not a tuple, only in parentheses
+            return tuple(items)
+        elif kind == "{" or kind == "dict":
+            if len(items) % 2: # key without value
+                raise ScanFallback
+            return build_dict(items)
+        elif kind == "set":
+            return set(items)
+        else: # call
+            func, kwargs, keyword = extra
+            if keyword is not None:
+                raise ScanFallback
+            if len(items) + len(kwargs) > self.max_call_args:
+                self._limit_error("max_call_args", len(items) + len(kwargs))
+            return func(*items, **kwargs)
 
     def parse(self, source):
         if isinstance(source, dict):
@@ -139,17 +693,125 @@ class DataEval(object):
             raise DataEvalError(
                 "source must be string/unicode! (It's type: %r)" % type(source))
 
+        if len(source) > self.max_length:
+            self._limit_error("max_length", len(source))
+
+        try:
+            return self.scan(source)
+        except (ScanFallback, ValueError, TypeError, SyntaxError, OverflowError):
+            # Not supported by the scanner or a error -> use the AST
+            pass
+
         try:
             node = ast.parse(source, mode='eval')
         except SyntaxError as err:
             raise EvalSyntaxError(err)
         except Exception as err:
             raise DataEvalError(err)
-        return self.convert(node)
+
+        return self.convert(node, len(source))
+
+
+_PARSE_CACHE = None
+
+
+def get_parse_cache():
+    """ returns the LRU cache used in data_eval(), create it on first call """
+    global _PARSE_CACHE
+    if _PARSE_CACHE is None:
+        maxsize = getattr(settings, "DBPREFERENCES_DATA_EVAL_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+        _PARSE_CACHE = LRUCache(maxsize)
+    return _PARSE_CACHE
+
+
+def copy_data(data):
+    """
+    Copy all mutable containers in the given data structure.
+    All other objects returned by DataEval are immutable and would be reused.
+
+    >>> data = {"a": [1, {"b": set([2])}], "c": (3, [4])}
+    >>> data2 = copy_data(data)
+    >>> data2 == data
+    True
+    >>> data2["a"] is data["a"] or data2["a"][1] is data["a"][1]
+    False
+    >>> data2["c"][1] is data["c"][1]
+    False
+    """
+    data_type = type(data)
+    if data_type is dict:
+        return dict((k, copy_data(v)) for k, v in data.items())
+    elif data_type is list:
+        return [copy_data(item) for item in data]
+    elif data_type is set:
+        return set(data) # set items are always hashable -> immutable
+    elif data_type is tuple:
+        return tuple(copy_data(item) for item in data)
+    return data
+
+
+DataEval.DISPATCH = {
+    ast.Num: DataEval._num,
+    ast.Tuple: DataEval._tuple,
+    ast.List: DataEval._list,
+    ast.Set: DataEval._set,
+    ast.Dict: DataEval._dict,
+    ast.UnaryOp: DataEval._unary_op,
+    ast.BinOp: DataEval._bin_op,
+    ast.Call: DataEval._call,
+    ast.Name: DataEval._name,
+}
+if six.PY2:
+    DataEval.DISPATCH[AST_TEXT_NODES] = DataEval._text
+else:
+    for node_type in AST_TEXT_NODES:
+        DataEval.DISPATCH[node_type] = DataEval._text
+    # ast.NameConstant exists only in Py3 !
+    DataEval.DISPATCH[ast.NameConstant] = DataEval._name_constant
+if AST_CONSTANT is not None:
+    DataEval.DISPATCH[AST_CONSTANT] = DataEval._constant
+
+
+# Functions to convert leaf nodes directly, they raise a KeyError
+# if the node can't be converted as leaf:
+NUMBER_LEAVES = {ast.Num: operator.attrgetter("n")}
+LEAF_CONVERTERS = {
+    ast.Num: operator.attrgetter("n"),
+    ast.Name: convert_name,
+    ast.UnaryOp: convert_negative_number,
+}
+# The text leaves, see DataEval._checked_leaf_converters():
+TEXT_LEAVES = []
+if AST_CONSTANT is not None:
+    NUMBER_LEAVES[AST_CONSTANT] = convert_number_constant
+    LEAF_CONVERTERS[AST_CONSTANT] = convert_constant
+if six.PY2:
+    LEAF_CONVERTERS[AST_TEXT_NODES] = operator.attrgetter("s")
+    TEXT_LEAVES.append(AST_TEXT_NODES)
+else:
+    for node_type in AST_TEXT_NODES:
+        LEAF_CONVERTERS[node_type] = operator.attrgetter("s")
+        TEXT_LEAVES.append(node_type)
+    LEAF_CONVERTERS[ast.NameConstant] = operator.attrgetter("value")
 
 
 def data_eval(data_string):
-    return DataEval().parse(data_string)
+    """
+    Cached DataEval().parse(): Every call returns a new copy of the data,
+    so the caller can change it without corrupting the cache.
+    """
+    if not isinstance(data_string, six.string_types):
+        return DataEval().parse(data_string)
+
+    cache = get_parse_cache()
+    key = hashlib.sha1(force_bytes(data_string)).digest()
+    try:
+        data = cache[key]
+    except KeyError:
+        data = DataEval().parse(data_string)
+        cache[key] = copy_data(data)
+        return data
+    return copy_data(data)
 
 
 if __name__ == '__main__':
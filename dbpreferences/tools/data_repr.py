@@ -0,0 +1,164 @@
+# coding: utf-8
+
+"""
+    data repr
+    ~~~~~~~~~
+
+    A canonical serializer for the data types data_eval can read back.
+
+    Unlike pprint.pformat() the output is always a single line and dict keys
+    and set items are sorted. So equal data results in a byte identical text,
+    usable for content hashes and change detection.
+
+    >>> data_repr({"b": [1, -2.5, None], "a": (True, set([3, 1, 2]))})
+    "{'a': (True, {1, 2, 3}), 'b': [1, -2.5, None]}"
+    >>> data_repr({"td": datetime.timedelta(days=1, seconds=2)})
+    "{'td': datetime.timedelta(1, 2)}"
+    >>> data_repr({(2, 1): 1, 1: 2, "a": 3})
+    "{1: 2, 'a': 3, (2, 1): 1}"
+    >>> data_repr([set(), frozenset([2, 1]), frozenset()])
+    '[set(), frozenset({1, 2}), frozenset()]'
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import datetime
+
+from django.utils import six
+
+
+def _fallback_sort_key(item):
+    # Used if items can't be compared (e.g.: int and text keys with Python 3)
+    return (type(item).__name__, data_repr(item))
+
+
+def _sorted(items, key=None):
+    try:
+        return sorted(items, key=key)
+    except TypeError:
+        if key is None:
+            return sorted(items, key=_fallback_sort_key)
+        return sorted(items, key=lambda item: _fallback_sort_key(key(item)))
+
+
+def _item_key(item):
+    return item[0]
+
+
+def _write_dict(data, append):
+    append("{")
+    first = True
+    for key, value in _sorted(data.items(), key=_item_key):
+        if first:
+            first = False
+        else:
+            append(", ")
+        _write(key, append)
+        append(": ")
+        _write(value, append)
+    append("}")
+
+
+def _write_items(items, append):
+    first = True
+    for item in items:
+        if first:
+            first = False
+        else:
+            append(", ")
+        _write(item, append)
+
+
+def _write_list(data, append):
+    append("[")
+    _write_items(data, append)
+    append("]")
+
+
+def _write_tuple(data, append):
+    append("(")
+    _write_items(data, append)
+    if len(data) == 1:
+        append(",")
+    append(")")
+
+
+def _write_set(data, append):
+    if not data:
+        append("set()") # There is no literal for a empty set
+        return
+    append("{")
+    _write_items(_sorted(data), append)
+    append("}")
+
+
+def _write_frozenset(data, append):
+    append("frozenset(")
+    if data:
+        _write_set(data, append)
+    append(")")
+
+
+def _write_timedelta(td, append):
+    # Always positional arguments, because the repr() changed in Python 3.7
+    args = [td.days, td.seconds, td.microseconds]
+    while len(args) > 1 and not args[-1]:
+        args.pop()
+    append("datetime.timedelta(%s)" % ", ".join(str(arg) for arg in args))
+
+
+def _write_repr(data, append):
+    append(repr(data))
+
+
+def _write_int(data, append):
+    append(str(data)) # Python 2 repr() of a long has a "L" suffix
+
+
+WRITERS = {
+    dict: _write_dict,
+    list: _write_list,
+    tuple: _write_tuple,
+    set: _write_set,
+    frozenset: _write_frozenset,
+    datetime.timedelta: _write_timedelta,
+    float: _write_repr,
+    bool: _write_repr,
+    type(None): _write_repr,
+    datetime.datetime: _write_repr,
+}
+for _type in six.integer_types:
+    WRITERS[_type] = _write_int
+for _type in (six.text_type, six.binary_type):
+    WRITERS[_type] = _write_repr
+
+
+def _write(data, append):
+    try:
+        writer = WRITERS[type(data)]
+    except KeyError:
+        # subclasses, e.g.: DictData or SafeText
+        for base in type(data).__mro__[1:]:
+            if base in WRITERS:
+                writer = WRITERS[base]
+                break
+        else:
+            writer = _write_repr
+    writer(data, append)
+
+
+def data_repr(data):
+    """
+    Returns the canonical Python literal text of the given data.
+
+    >>> data_repr({"foo": "bar"})
+    "{'foo': 'bar'}"
+    >>> data_repr([(1,), ()])
+    '[(1,), ()]'
+    """
+    parts = []
+    _write(data, parts.append)
+    return "".join(parts)
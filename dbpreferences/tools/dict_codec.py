@@ -0,0 +1,281 @@
+# coding: utf-8
+
+"""
+    dict codec
+    ~~~~~~~~~~
+
+    Serialize a DictModelField dict into a text and back.
+
+    There are two codecs for writing:
+
+        "python" - Python literals via data_repr, read back with data_eval
+        "json"   - JSON, read back with the C accelerated json decoder.
+                   Types JSON can't hold are stored as a object with a
+                   single type tag key, e.g.: {"$t": [1, 2]} for (1, 2)
+
+    The codec for new writes can be set via settings.DBPREFERENCES_DICT_CODEC
+    (default: "python"). dumps() prefix JSON with JSON_MARKER, so loads()
+    can detect the format and rows written with both codecs can be read.
+    Without the marker, a Python literal like {"a": 1} would be ambiguous.
+
+    >>> data = {"t": (1, 2), "dt": datetime.datetime(2015, 8, 11, 12, 13, 14)}
+    >>> text = json_dumps(data)
+    >>> text
+    '{"dt":{"$dt":[2015,8,11,12,13,14,0]},"t":{"$t":[1,2]}}'
+    >>> loads(JSON_MARKER + text) == data
+    True
+    >>> loads("{'t': (1, 2)}") == {"t": (1, 2)}
+    True
+
+    Large texts can be compressed with zlib (stored base64 encoded with
+    ZLIB_MARKER prefix), if settings.DBPREFERENCES_DICT_COMPRESS_THRESHOLD
+    is set to a text length. Compressed and plain rows can be mixed.
+
+    >>> text = compress("{'foo': '%s'}" % ("bar" * 100))
+    >>> text.startswith(ZLIB_MARKER), len(text) < 100
+    (True, True)
+    >>> loads(text) == {"foo": "bar" * 100}
+    True
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import datetime
+import json
+import threading
+import zlib
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
+from django.utils.encoding import force_bytes, force_text
+
+from dbpreferences.tools.data_eval import data_eval, get_limits, \
+    DataEvalError, DataEvalLimitError
+from dbpreferences.tools.data_repr import data_repr
+
+
+DEFAULT_CODEC = "python"
+
+# Prefix of JSON serialized data (Can't be the start of a Python literal)
+JSON_MARKER = "json:"
+
+# Prefix of zlib compressed and base64 encoded data
+ZLIB_MARKER = "zlib:"
+
+
+def _encode_dict(data):
+    if len(data) == 1:
+        key = next(iter(data))
+        if key in JSON_TAGS: # a normal dict looks like a tag -> escape it
+            return {"$d": [[_json_encode(k), _json_encode(v)] for k, v in data.items()]}
+
+    for key in data:
+        if not isinstance(key, six.string_types):
+            # JSON object keys must be strings
+            return {"$d": [[_json_encode(k), _json_encode(v)] for k, v in data.items()]}
+
+    return dict((k, _json_encode(v)) for k, v in data.items())
+
+
+def _encode_datetime(dt):
+    if dt.tzinfo is not None:
+        raise TypeError("Only naive datetime objects are supported: %r" % dt)
+    return {"$dt": [
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond
+    ]}
+
+
+JSON_ENCODERS = {
+    dict: _encode_dict,
+    list: lambda data: [_json_encode(item) for item in data],
+    tuple: lambda data: {"$t": [_json_encode(item) for item in data]},
+    set: lambda data: {"$s": [_json_encode(item) for item in data]},
+    frozenset: lambda data: {"$s": [_json_encode(item) for item in data]},
+    datetime.datetime: _encode_datetime,
+    datetime.timedelta: lambda td: {"$td": [td.days, td.seconds, td.microseconds]},
+}
+
+
+def _json_encode(data):
+    """ Replace all objects that JSON can't hold with tagged dicts """
+    try:
+        encoder = JSON_ENCODERS[type(data)]
+    except KeyError:
+        if isinstance(data, dict): # e.g.: DictData
+            return _encode_dict(data)
+        return data
+    return encoder(data)
+
+
+JSON_TAGS = {
+    "$d": lambda items: dict(items),
+    "$t": tuple,
+    "$s": set,
+    "$dt": lambda args: datetime.datetime(*args),
+    "$td": lambda args: datetime.timedelta(*args),
+}
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1:
+        tag, value = next(iter(obj.items()))
+        try:
+            decoder = JSON_TAGS[tag]
+        except KeyError:
+            pass
+        else:
+            return decoder(value)
+    return obj
+
+
+def json_dumps(data):
+    return json.dumps(_json_encode(data), sort_keys=True, separators=(",", ":"))
+
+
+def json_loads(text):
+    return json.loads(text, object_hook=_json_object_hook)
+
+
+def python_dumps(data):
+    return data_repr(data)
+
+
+CODECS = {
+    "python": python_dumps,
+    "json": lambda data: JSON_MARKER + json_dumps(data),
+}
+
+
+class CompressionStats(object):
+    """
+    Counters for the zlib compression of DictModelField values.
+    Get the current values via dict_codec.compression_stats.info()
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.compress_count = 0
+            self.compress_time = 0.0
+            self.plain_size = 0
+            self.compressed_size = 0
+            self.decompress_count = 0
+            self.decompress_time = 0.0
+
+    def add_compress(self, duration, plain_size, compressed_size):
+        with self._lock:
+            self.compress_count += 1
+            self.compress_time += duration
+            self.plain_size += plain_size
+            self.compressed_size += compressed_size
+
+    def add_decompress(self, duration):
+        with self._lock:
+            self.decompress_count += 1
+            self.decompress_time += duration
+
+    def info(self):
+        """ returns a dict with the compression statistics """
+        if self.plain_size:
+            ratio = self.compressed_size / float(self.plain_size)
+        else:
+            ratio = None
+        return {
+            "compress_count": self.compress_count,
+            "compress_time": self.compress_time,
+            "plain_size": self.plain_size,
+            "compressed_size": self.compressed_size,
+            "ratio": ratio,
+            "decompress_count": self.decompress_count,
+            "decompress_time": self.decompress_time,
+        }
+
+    def __repr__(self):
+        return "<CompressionStats %r>" % self.info()
+
+
+compression_stats = CompressionStats()
+
+
+def compress(text):
+    start_time = default_timer()
+    data = force_bytes(text)
+    compressed = ZLIB_MARKER + force_text(base64.b64encode(zlib.compress(data)))
+    compression_stats.add_compress(default_timer() - start_time, len(data), len(compressed))
+    return compressed
+
+
+def decompress(text, max_length=None):
+    """
+    Raise DataEvalLimitError if the uncompressed data is longer than
+    max_length bytes, without uncompressing more than that.
+    """
+    start_time = default_timer()
+    data = base64.b64decode(force_bytes(text[len(ZLIB_MARKER):]))
+    if max_length is None:
+        data = zlib.decompress(data)
+    else:
+        data = zlib.decompressobj().decompress(data, max_length + 1)
+        if len(data) > max_length:
+            raise DataEvalLimitError("uncompressed data exceeds the limit %i" % max_length)
+    text = force_text(data)
+    compression_stats.add_decompress(default_timer() - start_time)
+    return text
+
+
+def dumps(data):
+    """
+    serialize with the codec from settings.DBPREFERENCES_DICT_CODEC
+    and compress it, if it's longer than settings.DBPREFERENCES_DICT_COMPRESS_THRESHOLD
+    """
+    codec = getattr(settings, "DBPREFERENCES_DICT_CODEC", DEFAULT_CODEC)
+    try:
+        func = CODECS[codec]
+    except KeyError:
+        raise ImproperlyConfigured(
+            "Unknown DBPREFERENCES_DICT_CODEC %r (existing codecs: %s)" % (
+                codec, ", ".join(sorted(CODECS))
+            )
+        )
+    text = func(data)
+
+    threshold = getattr(settings, "DBPREFERENCES_DICT_COMPRESS_THRESHOLD", None)
+    if threshold is not None and len(text) >= threshold:
+        compressed = compress(text)
+        if len(compressed) < len(text):
+            return compressed
+    return text
+
+
+def loads(text):
+    """
+    Deserialize a text written by dumps() with any codec.
+    The "max_length" data eval limit is also used for compressed and JSON data.
+    """
+    if isinstance(text, six.string_types):
+        if text.startswith(ZLIB_MARKER):
+            max_length = get_limits()["max_length"]
+            try:
+                text = decompress(text, max_length)
+            except (TypeError, ValueError, zlib.error) as err:
+                raise DataEvalError("Can't decompress: %s" % err)
+
+        if text.startswith(JSON_MARKER):
+            max_length = get_limits()["max_length"]
+            if max_length is not None and len(text) > max_length:
+                raise DataEvalLimitError(
+                    "max_length %i exceeds the limit %i" % (len(text), max_length)
+                )
+            try:
+                return json_loads(text[len(JSON_MARKER):])
+            except ValueError as err:
+                raise DataEvalError("Can't deserialize JSON: %s" % err)
+    return data_eval(text)
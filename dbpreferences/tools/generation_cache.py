@@ -0,0 +1,275 @@
+# coding: utf-8
+
+"""
+    generation cache
+    ~~~~~~~~~~~~~~~~
+
+    A in-process cache, synchronised between processes via the database:
+
+    Every invalidate(key) / clear() inserts a row into the CacheInvalidation
+    table. The auto increment id of the row is the generation number.
+    check_state() reads all rows newer than the last seen generation with one
+    query on the primary key index and drops only the invalidated keys.
+
+    When check_state() would be called:
+
+        Once per request: dbpreferences.middleware.DBPreferencesMiddleware
+        calls check_caches_on_access(), so the check is done on the first
+        access in the request. Requests without a access make no query.
+
+        settings.DBPREFERENCES_CACHE_CHECK_INTERVAL = 5 # seconds (default)
+            Also on cache access, but at most once in the given seconds.
+            So the caches are synced without the middleware, too.
+            None: only once per request.
+
+    So a process reads stale entries at most until the next request / interval.
+
+    The rows are inserted in the transaction of the caller, so a row with a
+    lower id can be committed after a higher one. The ids missing between
+    the seen rows are watched for GAP_TIMEOUT seconds and read again on
+    every check, so a late committed row is not skipped.
+
+    The local entries are hold in a LRUCache, so the cache can be bounded
+    by the number of entries and their memory usage, see LRUCache.
+
+    A entry loaded in background (see stale_cache) is stored with
+    set_if_version(): it's dropped, if anything was invalidated in this
+    process since the get_version() before the database query.
+
+    The table would be pruned to the last settings.DBPREFERENCES_CACHE_LOG_SIZE
+    entries. If the last seen generation was pruned, the complete cache
+    would be cleared.
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import threading
+import time
+
+from django.conf import settings
+
+from dbpreferences.tools.lru_cache import LRUCache
+
+
+# Delete old CacheInvalidation entries only every n generations:
+PRUNE_EVERY = 100
+
+# Default of settings.DBPREFERENCES_CACHE_CHECK_INTERVAL in seconds:
+DEFAULT_CHECK_INTERVAL = 5
+
+# Seconds to wait for the commit of a missing id (a open transaction):
+GAP_TIMEOUT = 300
+# Max. number of watched missing ids, the complete cache is cleared if there are more:
+MAX_GAPS = 500
+# Number of rows read on the first check, to find the missing ids:
+FIRST_CHECK_ROWS = 100
+
+# All caches, synced by check_caches() / check_caches_on_access(),
+# the GenerationCache and SharedCache instances:
+CACHES = []
+
+
+def get_check_interval():
+    return getattr(settings, "DBPREFERENCES_CACHE_CHECK_INTERVAL", DEFAULT_CHECK_INTERVAL)
+
+
+class GenerationCache(LRUCache):
+    CACHES = CACHES
+
+    def __init__(self, id, check_interval=None, log_size=None, maxsize=None, maxmemory=None, sizeof=None):
+        super(GenerationCache, self).__init__(maxsize, maxmemory, sizeof)
+        self.id = id
+        if check_interval is None:
+            check_interval = get_check_interval()
+        self.check_interval = check_interval
+        if log_size is None:
+            log_size = getattr(settings, "DBPREFERENCES_CACHE_LOG_SIZE", 1000)
+        self.log_size = log_size
+
+        self.generation = None # The last seen generation
+        self._last_pruned = None # The generation of the last prune() of this process
+        self._gaps = {} # missing id -> time it was found missing
+        self._last_check = 0
+        self._check_pending = False # check on the next access, see check_on_access()
+        self._check_lock = threading.Lock() # one check at a time, see check_state()
+        self._invalidations = 0 # incremented by every dropped key, see get_version()
+        self.CACHES.append(self)
+
+    @property
+    def _log(self):
+        from dbpreferences.models import CacheInvalidation # import loop
+        return CacheInvalidation.objects
+
+    def check_state(self, force=False):
+        """
+        Drop all entries, that are invalidated in other processes.
+        Without force: only if check_on_access() was called or the
+        settings.DBPREFERENCES_CACHE_CHECK_INTERVAL is reached.
+        """
+        if not force and not self._is_check_due(time.time()):
+            return
+        with self._check_lock:
+            now = time.time()
+            # A other thread may have done the check, while we waited:
+            if not force and not self._is_check_due(now):
+                return
+            self._check_pending = False
+            self._last_check = now
+            self._check_log(now)
+
+    def _is_check_due(self, now):
+        return self._check_pending or (
+            self.check_interval is not None and now - self._last_check >= self.check_interval
+        )
+
+    def _check_log(self, now):
+        """ read the new log entries and drop the invalidated entries """
+        if self.generation is None:
+            # first check: entries cached before are of unknown generation
+            self._drop_all()
+            generations = self._log.get_last_generations(FIRST_CHECK_ROWS)
+            self.generation = generations[-1] if generations else 0
+            if len(generations) < FIRST_CHECK_ROWS:
+                generations.insert(0, 0) # all rows read, the ids start at 1
+            self._add_gaps(generations, now)
+            return
+
+        entries = self._log.get_entries(self.generation, list(self._gaps))
+        late_entries = [entry for entry in entries if entry[0] < self.generation]
+        entries = entries[len(late_entries):]
+        for generation, cache_id, key in late_entries:
+            # committed after a newer one
+            del self._gaps[generation]
+            self._apply(cache_id, key)
+
+        if self.generation and (not entries or entries[0][0] != self.generation):
+            # Our last seen generation was pruned -> we may have missed some
+            self._drop_all()
+            if not entries: # the table was flushed
+                self.generation = 0
+                return
+        else:
+            for generation, cache_id, key in entries:
+                if generation != self.generation:
+                    self._apply(cache_id, key)
+
+        if entries:
+            self._add_gaps([self.generation] + [entry[0] for entry in entries], now)
+            self.generation = entries[-1][0]
+
+        for generation, found in list(self._gaps.items()):
+            if now - found > GAP_TIMEOUT: # e.g.: a rolled back transaction
+                del self._gaps[generation]
+
+    def _apply(self, cache_id, key):
+        """ drop the entry of the given invalidation log row """
+        if cache_id != self.id:
+            return
+        if key:
+            self._drop(key)
+        else:
+            self._drop_all()
+
+    def _add_gaps(self, generations, now):
+        """ watch the ids missing in the given sorted generations """
+        for previous, generation in zip(generations, generations[1:]):
+            for missing in range(previous + 1, generation):
+                self._gaps[missing] = now
+        if len(self._gaps) > MAX_GAPS:
+            self._drop_all()
+            self._gaps.clear()
+
+    def __getitem__(self, key):
+        self.check_state()
+        return LRUCache.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.check_state()
+        return LRUCache.__contains__(self, key)
+
+    def check_on_access(self):
+        """ check_state() would be done on the next access of this cache """
+        self._check_pending = True
+
+    def _drop(self, key):
+        """ remove a invalidated key from this cache only """
+        with self._lock:
+            self._invalidations += 1
+            if key in self._data:
+                self._remove(key)
+
+    def _drop_all(self):
+        with self._lock:
+            self._invalidations += 1
+        LRUCache.clear(self)
+
+    def get_version(self, key):
+        """
+        returns a token for set_if_version(), to be taken before the value
+        is read from the database. Not per key: any invalidation changes it.
+        """
+        self.check_state()
+        return self._invalidations
+
+    def set_if_version(self, key, version, value):
+        """
+        Store the value, only if nothing was invalidated since get_version().
+        Returns False if the value is dropped, because it may be stale.
+        """
+        with self._lock:
+            if self._invalidations != version:
+                return False
+            self._set(key, value)
+        return True
+
+    def _add_entry(self, key):
+        self._prune(self._log.add_entry(self.id, key))
+
+    def _prune(self, generation):
+        # Not "generation % PRUNE_EVERY": the ids of other processes and
+        # rolled back transactions are skipped.
+        if self._last_pruned is None or generation - self._last_pruned >= PRUNE_EVERY:
+            self._log.prune(generation - self.log_size)
+            self._last_pruned = generation
+
+    def invalidate(self, key):
+        """ remove the key from this cache and from the caches in all other processes """
+        self._drop(key)
+        self._add_entry(key)
+
+    def invalidate_many(self, keys):
+        """ invalidate() all given keys, with one INSERT """
+        keys = list(keys)
+        if not keys:
+            return
+        for key in keys:
+            self._drop(key)
+        self._prune(self._log.add_entries(self.id, keys))
+
+    def clear(self):
+        """ remove all entries from this cache and from the caches in all other processes """
+        self._drop_all()
+        self._add_entry("")
+
+    def __repr__(self):
+        return "<GenerationCache %r generation=%r: %r>" % (
+            self.id, self.generation, self.info()
+        )
+
+
+def check_caches():
+    """ sync all caches now """
+    for cache in CACHES:
+        cache.check_state(force=True)
+
+
+def check_caches_on_access():
+    """
+    Called once per request: sync every cache on its next access,
+    so requests that don't use a cache make no query.
+    """
+    for cache in CACHES:
+        cache.check_on_access()
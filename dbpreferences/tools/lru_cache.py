@@ -0,0 +1,160 @@
+# coding: utf-8
+
+"""
+    LRU cache
+    ~~~~~~~~~
+
+    A small, thread safe and size bounded dict-like cache, that discards the
+    least recently used items first.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache["a"] = 1
+    >>> cache["b"] = 2
+    >>> cache["a"]
+    1
+    >>> cache["c"] = 3 # "b" is the least recently used item
+    >>> "b" in cache
+    False
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    >>> cache.get("b") is None
+    True
+    >>> cache.hits, cache.misses, cache.evictions
+    (1, 1, 1)
+
+    A maxsize of 0 disables the cache, None means: unbounded.
+
+    >>> cache = LRUCache(maxsize=0)
+    >>> cache["a"] = 1
+    >>> len(cache)
+    0
+
+    The memory usage can be bounded, too. sizeof(value) returns the
+    (estimated) size of a value:
+
+    >>> cache = LRUCache(maxsize=None, maxmemory=10, sizeof=len)
+    >>> cache["a"] = "12345"
+    >>> cache["b"] = "1234"
+    >>> cache["c"] = "123" # "a" must be discarded
+    >>> sorted(cache.keys()), cache.memory, cache.evictions
+    (['b', 'c'], 7, 1)
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    def __init__(self, maxsize, maxmemory=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxmemory = maxmemory
+        self.sizeof = sizeof
+        self._bounded = maxsize is not None or maxmemory is not None
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                if self._bounded:
+                    value = self._data.pop(key)
+                    self._data[key] = value # mark as most recently used
+                else:
+                    value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _remove(self, key):
+        """ remove the key, must be called with the lock """
+        value = self._data.pop(key)
+        self.memory -= self._sizes.pop(key, 0)
+        return value
+
+    def _is_full(self):
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            return True
+        return self.maxmemory is not None and self.memory > self.maxmemory
+
+    def _set(self, key, value):
+        """ store the value and evict the oldest entries, must be called with the lock """
+        if self.maxsize is not None and self.maxsize <= 0:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = value
+        if self.maxmemory is not None:
+            size = self.sizeof(value)
+            self._sizes[key] = size
+            self.memory += size
+        while self._data and self._is_full():
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def pop(self, key, *default):
+        with self._lock:
+            try:
+                return self._remove(key)
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def items(self):
+        return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.memory = 0
+
+    def info(self):
+        """ returns a dict with the cache statistics """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "memory": self.memory,
+            "maxmemory": self.maxmemory,
+        }
+
+    def __repr__(self):
+        return "<LRUCache %r>" % self.info()
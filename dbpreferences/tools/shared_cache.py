@@ -0,0 +1,244 @@
+# coding: utf-8
+
+"""
+    shared cache
+    ~~~~~~~~~~~~
+
+    A in-process dict, layered on top of a django cache alias, so all
+    processes see the same data:
+
+        settings.DBPREFERENCES_CACHE_BACKEND = "default" # a settings.CACHES alias
+
+    Every entry in the django cache is stored under a versioned key:
+
+        dbpreferences:<SNAPSHOT_VERSION>:<cache id>:<generation>:<key>:<key version>
+
+    The generation is incremented by clear(), the key version by
+    invalidate(key). Both are stored in the django cache without timeout and
+    fetched with one get_many() call. A local entry is used only if it was
+    stored with the current versions. Otherwise the snapshot would be taken
+    from the django cache and the local entry is updated.
+
+    The versions of a local entry are checked only once per request (see
+    check_on_access(), called by DBPreferencesMiddleware) and after
+    settings.DBPREFERENCES_CACHE_CHECK_INTERVAL seconds, like in the
+    GenerationCache. Between the checks the local entry is used without a
+    round trip to the django cache.
+
+    The local values are converted with to_snapshot() before they are stored
+    into the django cache (pickled by the cache backend) and with
+    from_snapshot() after they are read back.
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import copy
+import time
+
+try:
+    from django.core.cache import caches
+except ImportError: # Django < 1.7
+    from django.core.cache import get_cache
+    caches = None
+
+from dbpreferences.fields import DictModelField
+from dbpreferences.tools import generation_cache
+
+
+# Increment if the format of the snapshots changed:
+SNAPSHOT_VERSION = 1
+
+
+def new_version():
+    """
+    Start value of a new generation/key version. It's a timestamp, so a
+    evicted version key would not reuse the version of older snapshots.
+    """
+    return int(time.time() * 1000)
+
+
+def model_snapshot(instance):
+    """
+    returns a copy of the model instance with all DictModelField values
+    serialized, so the dicts would be deserialized lazy after unpickling.
+    """
+    snapshot = copy.copy(instance)
+    for field in instance._meta.concrete_fields:
+        if isinstance(field, DictModelField) and field.attname in snapshot.__dict__:
+            value = snapshot.__dict__[field.attname]
+            if value is not None:
+                snapshot.__dict__[field.attname] = field.get_prep_value(value)
+    return snapshot
+
+
+def _no_conversion(value):
+    return value
+
+
+class SharedCache(object):
+    def __init__(self, id, alias, to_snapshot=_no_conversion, from_snapshot=_no_conversion,
+                local=None, check_interval=None):
+        self.id = id
+        self.alias = alias
+        self.to_snapshot = to_snapshot
+        self.from_snapshot = from_snapshot
+        if check_interval is None:
+            check_interval = generation_cache.get_check_interval()
+        self.check_interval = check_interval
+        # key -> (versions, value, check epoch, check time),
+        # e.g. a LRUCache to bound the local entries:
+        self._local = {} if local is None else local
+        self._prefix = "dbpreferences:%i:%s" % (SNAPSHOT_VERSION, id)
+        self._generation_key = "%s:generation" % self._prefix
+        self._epoch = 0 # incremented by check_on_access()
+        self._django_cache = None # Django < 1.7 only
+        generation_cache.CACHES.append(self)
+
+    @property
+    def django_cache(self):
+        if caches is None:
+            # Django < 1.7: get_cache() returns a new instance on every call
+            if self._django_cache is None:
+                self._django_cache = get_cache(self.alias)
+            return self._django_cache
+        return caches[self.alias]
+
+    def _version_key(self, key):
+        return "%s:version:%s" % (self._prefix, key)
+
+    def _data_key(self, key, versions):
+        return "%s:%s:%s:%s" % (self._prefix, versions[0], key, versions[1])
+
+    def _increment(self, version_key):
+        try:
+            self.django_cache.incr(version_key)
+        except ValueError: # key doesn't exist
+            self.django_cache.set(version_key, new_version(), timeout=None)
+
+    def _get_versions(self, key, create=False):
+        """ returns the current (generation, key version) """
+        django_cache = self.django_cache
+        version_key = self._version_key(key)
+        versions = django_cache.get_many([self._generation_key, version_key])
+        generation = versions.get(self._generation_key)
+        key_version = versions.get(version_key)
+        if not create or (generation is not None and key_version is not None):
+            return generation, key_version
+
+        if generation is None:
+            django_cache.add(self._generation_key, new_version(), timeout=None)
+            generation = django_cache.get(self._generation_key)
+        if key_version is None:
+            django_cache.add(version_key, new_version(), timeout=None)
+            key_version = django_cache.get(version_key)
+        return generation, key_version
+
+    def _is_checked(self, epoch, checked):
+        """ True if the versions of a local entry needn't be checked again """
+        if epoch != self._epoch:
+            return False
+        return self.check_interval is None or time.time() - checked < self.check_interval
+
+    def _store_local(self, key, versions, value):
+        self._local[key] = (versions, value, self._epoch, time.time())
+
+    def __getitem__(self, key):
+        try:
+            local_versions, value, epoch, checked = self._local[key]
+        except KeyError:
+            local_versions = None
+        else:
+            if self._is_checked(epoch, checked):
+                return value
+
+        versions = self._get_versions(key)
+        if None in versions:
+            self._local.pop(key, None)
+            raise KeyError(key)
+
+        if local_versions == versions:
+            self._store_local(key, versions, value)
+            return value
+
+        snapshot = self.django_cache.get(self._data_key(key, versions))
+        if snapshot is None:
+            self._local.pop(key, None)
+            raise KeyError(key)
+        value = self.from_snapshot(snapshot)
+        self._store_local(key, versions, value)
+        return value
+
+    def __setitem__(self, key, value):
+        versions = self._get_versions(key, create=True)
+        self.django_cache.set(self._data_key(key, versions), self.to_snapshot(value))
+        self._store_local(key, versions, value)
+
+    def get_version(self, key):
+        """ returns a token for set_if_version(): the current versions of the key """
+        return self._get_versions(key)
+
+    def set_if_version(self, key, version, value):
+        """
+        Store the value, only if the key was not invalidated since get_version().
+        If it's invalidated right after the check, the value is stored under
+        the old versions: Not seen by other processes and dropped by the next
+        check of the local entry.
+        """
+        if None in version or self._get_versions(key) != version:
+            return False
+        self.django_cache.set(self._data_key(key, version), self.to_snapshot(value))
+        self._store_local(key, version, value)
+        return True
+
+    def check_on_access(self):
+        """ check the versions of the local entries again on their next access """
+        self._epoch += 1
+
+    def check_state(self, force=False):
+        """ Used by check_caches(): the same as check_on_access() """
+        self.check_on_access()
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.invalidate(key)
+        return value
+
+    def invalidate(self, key):
+        """ remove the key in all processes """
+        self._local.pop(key, None)
+        self._increment(self._version_key(key))
+
+    def invalidate_many(self, keys):
+        for key in keys:
+            self.invalidate(key)
+
+    def clear(self):
+        """ remove all entries in all processes """
+        self._local.clear()
+        self._increment(self._generation_key)
+
+    def keys(self):
+        """ returns the keys of the local entries """
+        return list(self._local.keys())
+
+    def __len__(self):
+        return len(self._local)
+
+    def __repr__(self):
+        return "<SharedCache %r alias=%r>" % (self.id, self.alias)
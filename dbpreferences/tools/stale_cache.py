@@ -0,0 +1,201 @@
+# coding: utf-8
+
+"""
+    stale-while-revalidate
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Optional TTL for the entries of the preferences and user settings caches:
+
+        settings.DBPREFERENCES_CACHE_TTL = 300 # seconds, None: disabled
+        settings.DBPREFERENCES_CACHE_TTL_JITTER = 0.1 # +-10% of the TTL
+        settings.DBPREFERENCES_REFRESH_WORKERS = 2 # background threads
+
+    A expired entry is still served, but one background thread reloads it
+    from the database. So the reload is not in the request latency and a
+    popular entry is reloaded only once, not by every request at the same
+    time. The jitter spreads the expire times of entries stored together
+    (e.g. by the preload).
+
+    The expire time is a attribute of the cache entry itself, so it's gone
+    with the entry, if it's invalidated or evicted.
+
+    A entry invalidated while it's reloaded would be overwritten with the
+    stale row. So the refresh takes get_cache_version() before the query and
+    stores the result with set_if_current(), which drops it in this case.
+
+    The background threads are limited by the RefreshPool. If all workers
+    are busy and the queue is full, the stale entry is served until a later
+    access can start the refresh.
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils.six.moves import queue
+
+
+log = logging.getLogger(__name__)
+
+
+class RefreshPool(object):
+    """
+    A fixed number of daemon threads, started on demand.
+    Every job runs with its own database connection, which is closed afterwards.
+    """
+    def __init__(self, max_workers=2, max_queue=100):
+        self.max_workers = max_workers
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """ returns False, if the queue is full """
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            return False
+
+        with self._lock:
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name="dbpreferences refresh")
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        return True
+
+    def _work(self):
+        while True:
+            func, args = self._queue.get()
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Error in background refresh %r", func)
+            finally:
+                try:
+                    # connections.close_all() is new in Django 1.8
+                    for connection in connections.all():
+                        connection.close()
+                except Exception:
+                    log.exception("Error closing the database connections")
+                finally:
+                    # A failed cleanup must not block join():
+                    self._queue.task_done()
+
+    def join(self):
+        """ wait until all submitted jobs are done """
+        self._queue.join()
+
+
+_REFRESH_POOL = None
+
+def get_refresh_pool():
+    global _REFRESH_POOL
+    if _REFRESH_POOL is None:
+        _REFRESH_POOL = RefreshPool(
+            max_workers=getattr(settings, "DBPREFERENCES_REFRESH_WORKERS", 2)
+        )
+    return _REFRESH_POOL
+
+
+def get_cache_version(cache, key):
+    """
+    returns the state of the key, to be taken before the database query
+    of a refresh, see set_if_current()
+    """
+    try:
+        get_version = cache.get_version
+    except AttributeError: # a normal dict: the current entry itself
+        return cache.get(key)
+    return get_version(key)
+
+
+def set_if_current(cache, key, version, value):
+    """
+    Store the refreshed value, only if the key was not invalidated since
+    get_cache_version(). Returns False if the value is dropped.
+    """
+    try:
+        set_if_version = cache.set_if_version
+    except AttributeError: # a normal dict
+        if cache.get(key) is not version:
+            return False
+        cache[key] = value
+        return True
+    return set_if_version(key, version, value)
+
+
+class StaleWhileRevalidate(object):
+    """
+    Sets and checks the expire times of the entries of one cache.
+    Disabled (does nothing), if the ttl is None.
+    """
+    attname = "_cache_expires"
+
+    def __init__(self, ttl=None, jitter=None, pool=None):
+        if ttl is None:
+            ttl = getattr(settings, "DBPREFERENCES_CACHE_TTL", None)
+        self.ttl = ttl
+        if jitter is None:
+            jitter = getattr(settings, "DBPREFERENCES_CACHE_TTL_JITTER", 0.1)
+        self.jitter = jitter
+        self._pool = pool
+
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = get_refresh_pool()
+        return self._pool
+
+    def get_expires(self, entry):
+        return getattr(entry, self.attname, None)
+
+    def stored(self, entry):
+        """ The entry was (re-)loaded from the database right now """
+        if self.ttl is None:
+            return
+        ttl = self.ttl * (1 + random.uniform(-self.jitter, self.jitter))
+        setattr(entry, self.attname, time.time() + ttl)
+
+    def check(self, key, entry, refresh, *args):
+        """
+        Called on cache hit: start the refresh(*args) in background, if the
+        entry is expired and the key is not refreshed, yet.
+        refresh() must call stored() for the new or the kept entry.
+        """
+        if self.ttl is None:
+            return
+        expires = self.get_expires(entry)
+        if expires is None:
+            # e.g.: stored by a other process in a shared cache
+            self.stored(entry)
+            return
+        if expires > time.time():
+            return
+
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        if not self.pool.submit(self._refresh, key, refresh, args):
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh(self, key, refresh, args):
+        try:
+            refresh(*args)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
@@ -0,0 +1,247 @@
+# coding: utf-8
+
+"""
+    write-behind user settings
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Optional: DBPreferencesMiddleware doesn't save changed UserSettings in
+    the request. The serialized settings are queued and written by a
+    background thread:
+
+        settings.DBPREFERENCES_WRITE_BEHIND = True
+        settings.DBPREFERENCES_WRITE_BEHIND_MAX_SIZE = 1000 # queued users
+        settings.DBPREFERENCES_WRITE_BEHIND_INTERVAL = 1.0 # seconds
+        settings.DBPREFERENCES_WRITE_BEHIND_BATCH_SIZE = 100 # rows per UPDATE
+
+    Needs Django 1.8 or newer (conditional expressions). The module is
+    imported only if the write-behind is enabled.
+
+    The queue holds only the latest state of every user. It is flushed every
+    interval or if a batch is full. Every batch is written with one UPDATE
+    query and invalidated in the other processes with one INSERT into the
+    CacheInvalidation log. If the queue is full, the settings are saved in
+    the request, as without write-behind. On interpreter exit the queue would
+    be flushed.
+
+    The user settings cache of this process holds the new settings at once.
+    Other processes see them after the flush.
+
+    Every queued state holds the version it is based on and the keys changed
+    by this process. A batch UPDATE writes only rows which still have that
+    version. Rows saved by someone else in the meantime are re-read, the
+    changed keys are merged into them and saved with the version check of
+    UserSettings.save(), see settings.DBPREFERENCES_USER_SETTINGS_SAVE_RETRIES
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import copy
+import logging
+import operator
+import threading
+from collections import OrderedDict
+from functools import reduce
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, F, Q, When, Value
+from django.utils import timezone
+
+from dbpreferences.fields import get_fingerprint
+from dbpreferences.middleware import SAVE_RETRIES
+from dbpreferences.models import UserSettings, invalidate_user_settings_cache_many, \
+    update_user_settings_cache
+
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindQueue(object):
+    def __init__(self, max_size=1000, flush_interval=1.0, batch_size=100, background=True):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.background = background
+
+        # UserSettings pk -> (user_id, version, serialized settings, changed keys):
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, instance, modified_keys=None):
+        """
+        Queue the current settings of the saved UserSettings instance.
+        modified_keys: the keys changed since the instance was read (default:
+        all keys). Only these are merged into a concurrently saved entry.
+        Returns False if the queue is full: The caller must save it.
+        """
+        field = instance._meta.get_field("settings")
+        settings_dict = dict(instance.settings)
+        text = instance_text = field.get_prep_value(settings_dict)
+        if not field.has_changed(instance, text):
+            return True
+
+        if modified_keys is None:
+            modified_keys = settings_dict.keys()
+        modified_keys = set(modified_keys)
+        with self._lock:
+            old_entry = self._pending.get(instance.pk)
+            if old_entry is None and len(self._pending) >= self.max_size:
+                return False
+            if old_entry is not None:
+                # Keep the changes of the not written state, e.g. if the
+                # instance was reloaded, because someone else has saved it:
+                old_text, old_keys = old_entry[2:]
+                missing_keys = old_keys - modified_keys
+                if missing_keys:
+                    old_settings = field.to_python(old_text)
+                    for key in missing_keys:
+                        settings_dict[key] = old_settings[key]
+                    text = field.get_prep_value(settings_dict)
+                    modified_keys |= missing_keys
+            self._pending[instance.pk] = (instance.user_id, instance.version, text, modified_keys)
+            batch_full = len(self._pending) >= self.batch_size
+
+        # The instance is "saved" now: don't queue the same state again
+        instance.__dict__[field.fingerprint_attname] = get_fingerprint(instance_text)
+
+        # This process sees the queued state at once:
+        cached_instance = copy.copy(instance)
+        cached_instance.settings = settings_dict
+        update_user_settings_cache(cached_instance)
+
+        if self.background:
+            self._start_thread()
+            if batch_full:
+                self._wakeup.set()
+        return True
+
+    def flush(self):
+        """ Write all queued settings into the database """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+
+            items = list(pending.items())
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                try:
+                    self._write(batch)
+                except Exception:
+                    log.exception("Error writing %i queued user settings", len(batch))
+                    self._requeue(batch)
+
+    def _write(self, batch):
+        """ One UPDATE for all rows with the expected version, merge the others """
+        updated = UserSettings.objects.filter(reduce(operator.or_, [
+            Q(pk=pk, version=version) for pk, (user_id, version, text, keys) in batch
+        ])).update(
+            settings=Case(*[When(pk=pk, then=Value(text)) for pk, (user_id, version, text, keys) in batch]),
+            lastupdatetime=timezone.now(),
+            version=F("version") + 1,
+        )
+        if updated < len(batch):
+            self._merge_conflicts(batch)
+        invalidate_user_settings_cache_many([user_id for pk, (user_id, version, text, keys) in batch])
+
+    def _merge_conflicts(self, batch):
+        """
+        Re-read the rows of the batch and merge the changed keys into the ones,
+        which are not in the queued state, e.g. saved by a other process.
+        """
+        field = UserSettings._meta.get_field("settings")
+        instances = UserSettings.objects.in_bulk([pk for pk, entry in batch])
+        for pk, (user_id, version, text, keys) in batch:
+            instance = instances.get(pk)
+            if instance is None:
+                continue # deleted
+            if instance.__dict__.get(field.fingerprint_attname) == get_fingerprint(text):
+                continue # written by the batch UPDATE
+            queued_settings = field.to_python(text)
+            for retry in range(SAVE_RETRIES + 1):
+                settings_dict = dict(instance.settings)
+                for key in keys:
+                    settings_dict[key] = queued_settings[key]
+                instance.settings = settings_dict
+                try:
+                    instance.save(skip_unchanged=True)
+                except UserSettings.VersionConflict:
+                    if retry == SAVE_RETRIES:
+                        raise
+                    try:
+                        instance = UserSettings.objects.get(pk=pk)
+                    except UserSettings.DoesNotExist:
+                        break
+                else:
+                    break
+
+    def _requeue(self, batch):
+        """ Try it again on the next flush, if not replaced by a newer state """
+        with self._lock:
+            for pk, entry in batch:
+                self._pending.setdefault(pk, entry)
+
+    def _start_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="dbpreferences write-behind")
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.shutdown)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                try:
+                    # the same as connections.close_all() of Django 1.8
+                    for connection in connections.all():
+                        connection.close()
+                except Exception:
+                    log.exception("Error closing the database connections")
+
+    def shutdown(self, timeout=10):
+        """ Stop the background thread and write the rest of the queue """
+        self._stopped = True
+        if self._thread is not None:
+            self._wakeup.set()
+            self._thread.join(timeout)
+        self.flush()
+
+
+_WRITE_BEHIND_QUEUE = None
+
+def get_write_behind_queue():
+    """ returns the queue, or None if settings.DBPREFERENCES_WRITE_BEHIND is not enabled """
+    global _WRITE_BEHIND_QUEUE
+    if not getattr(settings, "DBPREFERENCES_WRITE_BEHIND", False):
+        return None
+    if _WRITE_BEHIND_QUEUE is None:
+        _WRITE_BEHIND_QUEUE = WriteBehindQueue(
+            max_size=getattr(settings, "DBPREFERENCES_WRITE_BEHIND_MAX_SIZE", 1000),
+            flush_interval=getattr(settings, "DBPREFERENCES_WRITE_BEHIND_INTERVAL", 1.0),
+            batch_size=getattr(settings, "DBPREFERENCES_WRITE_BEHIND_BATCH_SIZE", 100),
+        )
+    return _WRITE_BEHIND_QUEUE
+
+
+def flush_write_behind():
+    """ Write all queued user settings now, e.g. in tests or a shutdown handler """
+    if _WRITE_BEHIND_QUEUE is not None:
+        _WRITE_BEHIND_QUEUE.flush()
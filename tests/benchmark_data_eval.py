@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    benchmark for the data eval AST walker
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares DataEval.convert() (type dispatch table and explicit stack)
+    with the old recursive isinstance() chain on 5k and 10k-key documents.
+    The source length is passed like in DataEval.parse(): The node count and
+    string length limits are checked per node only for sources longer than
+    these limits (the 10k mixed document).
+
+    run e.g.:
+        .../django-dbpreferences $ python tests/benchmark_data_eval.py
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import ast
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_project.settings")
+
+import django
+if hasattr(django, "setup"): # new in Django 1.7
+    django.setup()
+
+from django.utils import six
+
+from dbpreferences.tools.data_eval import DataEval, UnsafeSourceError, \
+    AST_TEXT_NODES, NAME_MAP
+
+
+class RecursiveDataEval(DataEval):
+    """ The old recursive isinstance() chain, used as reference """
+    def convert(self, node):
+        if isinstance(node, ast.Expression):
+            node = node.body
+
+        if isinstance(node, AST_TEXT_NODES):
+            return node.s
+        elif isinstance(node, ast.Num):
+            return node.n
+        elif isinstance(node, ast.Tuple):
+            return tuple(map(self.convert, node.elts))
+        elif isinstance(node, ast.List):
+            return list(map(self.convert, node.elts))
+        elif isinstance(node, ast.Set):
+            return set(map(self.convert, node.elts))
+        elif isinstance(node, ast.Dict):
+            return dict((self.convert(k), self.convert(v)) for k, v
+                in zip(node.keys, node.values))
+        elif not six.PY2 and isinstance(node, ast.NameConstant):
+            return node.value
+        elif isinstance(node, ast.UnaryOp) and \
+                isinstance(node.op, (ast.UAdd, ast.USub)) and \
+                isinstance(node.operand, (ast.Num, ast.UnaryOp, ast.BinOp)):
+            operand = self.convert(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return + operand
+            else:
+                return - operand
+        elif isinstance(node, ast.BinOp) and \
+                isinstance(node.op, (ast.Add, ast.Sub)) and \
+                isinstance(node.right, (ast.Num, ast.UnaryOp, ast.BinOp)) and \
+                isinstance(node.left, (ast.Num, ast.UnaryOp, ast.BinOp)):
+            left = self.convert(node.left)
+            right = self.convert(node.right)
+            if isinstance(node.op, ast.Add):
+                return left + right
+            else:
+                return left - right
+        elif isinstance(node, ast.Call):
+            args = list(map(self.convert, node.args))
+            return getattr(self, "call_%s" % node.func.attr.lower())(*args)
+        elif isinstance(node, ast.Name):
+            return NAME_MAP[node.id.lower()]
+        raise UnsafeSourceError(ast.dump(node))
+
+
+def get_documents(key_count):
+    now = datetime.datetime(2015, 8, 11, 12, 13, 14, 15)
+    flat = dict(
+        ("key %i" % no, no) for no in range(key_count)
+    )
+    mixed = dict(
+        ("key %i" % no, {
+            "text": "value %i" % no,
+            "numbers": [no, -no, no * 0.5],
+            "flags": (True, False, None),
+            "date": now,
+        })
+        for no in range(key_count)
+    )
+    return (
+        ("%i flat keys" % key_count, flat),
+        ("%i mixed keys" % key_count, mixed),
+    )
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def main(number=5):
+    print("Python v%s" % sys.version.split()[0])
+    walker = DataEval()
+    for key_count in (5000, 10000):
+        for name, data in get_documents(key_count):
+            source = repr(data)
+            tree = ast.parse(source, mode="eval")
+            assert walker.convert(tree, len(source)) == RecursiveDataEval().convert(tree) == data
+
+            old = bench(lambda: RecursiveDataEval().convert(tree), number)
+            new = bench(lambda: walker.convert(tree, len(source)), number)
+            checked = len(source) > min(walker.max_nodes, walker.max_string_length)
+            print("%-18s old: %6.1fms  new: %6.1fms  speedup: %.2fx%s" % (
+                name, old * 1000, new * 1000, old / new,
+                "  (limits checked per node)" if checked else ""
+            ))
+
+
+if __name__ == "__main__":
+    main()
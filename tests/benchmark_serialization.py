@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+    benchmark for the serialization stack
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Times serialize/deserialize round-trips of DictModelField values with the
+    dbpreferences codecs and compare them with ast.literal_eval() and json.
+    Reports throughput and peak memory (needs tracemalloc, Python 3.4+).
+
+    The documents are: a small preferences form, 10k keys dicts, deep nested
+    data and many datetime objects.
+
+    run e.g.:
+        .../django-dbpreferences $ python tests/benchmark_serialization.py
+        .../django-dbpreferences $ python tests/benchmark_serialization.py --output=v0.6.0.json
+
+    The JSON output can be compared with a older one:
+        .../django-dbpreferences $ python tests/benchmark_serialization.py --compare=v0.6.0.json
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import ast
+import datetime
+import json
+import os
+import platform
+import pprint
+import sys
+import timeit
+
+try:
+    import tracemalloc # new in Python 3.4
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_project.settings")
+
+import django
+if hasattr(django, "setup"): # new in Django 1.7
+    django.setup()
+
+import dbpreferences
+from dbpreferences.fields import DictModelField
+from dbpreferences.tools import dict_codec
+from dbpreferences.tools import data_eval as data_eval_module
+from dbpreferences.tools.data_eval import DataEval, data_eval
+from dbpreferences.tools.data_repr import data_repr
+from dbpreferences.tools.lru_cache import LRUCache
+
+
+# Min. time for one timeit run:
+MIN_RUN_TIME = 0.1
+
+
+def get_documents(quick=False):
+    key_count = 1000 if quick else 10000
+    now = datetime.datetime(2015, 8, 11, 12, 13, 14, 15)
+
+    small_form = {
+        "subject": "foobar", "foo_bool": True, "count": 10, "font_size": 0.7,
+    }
+
+    flat = dict(("key %i" % no, no) for no in range(key_count))
+
+    mixed = dict(
+        ("key %i" % no, {
+            "text": u"value %i \xe4" % no,
+            "numbers": [no, -no, no * 0.5],
+            "flags": (True, False, None),
+        })
+        for no in range(key_count)
+    )
+
+    deep = {"level": 0}
+    for no in range(1, 90): # below the default DataEval max_depth
+        deep = {"level": no, "child": deep, "items": [no]}
+
+    datetimes = {
+        "dates": [now + datetime.timedelta(hours=no) for no in range(key_count)],
+        "durations": [datetime.timedelta(seconds=no) for no in range(key_count)],
+    }
+
+    return (
+        ("small form", small_form),
+        ("%i flat keys" % key_count, flat),
+        ("%i mixed keys" % key_count, mixed),
+        ("deep nested", deep),
+        ("%i datetimes" % key_count, datetimes),
+    )
+
+
+def get_codecs():
+    """
+    returns (name, dumps, loads, use the data_eval() cache)
+    The cache is disabled for all other codecs, so the parsing would be measured.
+    """
+    field = DictModelField()
+    return (
+        ("data_repr + DataEval", data_repr, lambda text: DataEval().parse(text), False),
+        ("data_repr + data_eval cached", data_repr, data_eval, True),
+        ("pformat + DataEval", pprint.pformat, lambda text: DataEval().parse(text), False),
+        ("dict_codec json", dict_codec.json_dumps, dict_codec.json_loads, False),
+        ("dict_codec zlib", lambda data: dict_codec.compress(data_repr(data)), dict_codec.loads, False),
+        ("DictModelField", field.get_prep_value, field.to_python, False),
+        # references:
+        ("repr + ast.literal_eval", repr, ast.literal_eval, False),
+        ("json", json.dumps, json.loads, False),
+    )
+
+
+def get_peak_memory(func, arg):
+    """ returns the peak of allocated memory in bytes while func(arg) runs """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(func, arg, repeat):
+    """ returns the best time in seconds for one func(arg) call """
+    duration = timeit.timeit(lambda: func(arg), number=1)
+    number = max(1, int(MIN_RUN_TIME / max(duration, 1e-9)))
+    timings = timeit.repeat(lambda: func(arg), number=number, repeat=repeat)
+    return min(timings) / number
+
+
+def run(quick=False, repeat=3):
+    results = []
+    for document_name, data in get_documents(quick):
+        for codec_name, dumps, loads, cached in get_codecs():
+            maxsize = data_eval_module.DEFAULT_CACHE_SIZE if cached else 0
+            data_eval_module._PARSE_CACHE = LRUCache(maxsize)
+
+            result = {"document": document_name, "codec": codec_name}
+            results.append(result)
+            try:
+                text = dumps(data)
+                supported = loads(text) == data
+            except Exception as err:
+                supported = False
+                result["error"] = "%s: %s" % (err.__class__.__name__, err)
+            if not supported:
+                result["supported"] = False
+                continue
+
+            size = len(text)
+            dumps_time = bench(dumps, data, repeat)
+            loads_time = bench(loads, text, repeat)
+            result.update({
+                "supported": True,
+                "size": size,
+                "dumps_time": dumps_time,
+                "loads_time": loads_time,
+                "dumps_throughput": size / dumps_time,
+                "loads_throughput": size / loads_time,
+                "dumps_peak_memory": get_peak_memory(dumps, data),
+                "loads_peak_memory": get_peak_memory(loads, text),
+            })
+
+    data_eval_module._PARSE_CACHE = None # recreate it with the settings size
+    return results
+
+
+def format_memory(value):
+    if value is None:
+        return "-"
+    return "%.1fKB" % (value / 1024)
+
+
+def print_results(results, old_results=None):
+    if old_results is not None:
+        old_results = dict(
+            ((result["document"], result["codec"]), result) for result in old_results
+        )
+
+    document_name = None
+    for result in results:
+        if result["document"] != document_name:
+            document_name = result["document"]
+            print()
+            print(document_name)
+            print("-" * 79)
+
+        if not result["supported"]:
+            print("%-30s not supported" % result["codec"])
+            continue
+
+        line = "%-30s dumps: %8.2fms %7s  loads: %8.2fms %7s  %5.1fMB/s" % (
+            result["codec"],
+            result["dumps_time"] * 1000, format_memory(result["dumps_peak_memory"]),
+            result["loads_time"] * 1000, format_memory(result["loads_peak_memory"]),
+            result["loads_throughput"] / 1024 / 1024,
+        )
+        if old_results is not None:
+            old = old_results.get((result["document"], result["codec"]))
+            if old is not None and old["supported"]:
+                line += "  (%+.0f%% / %+.0f%%)" % (
+                    (result["dumps_time"] / old["dumps_time"] - 1) * 100,
+                    (result["loads_time"] / old["loads_time"] - 1) * 100,
+                )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the serialization stack")
+    parser.add_argument("--quick", action="store_true", help="use smaller documents")
+    parser.add_argument("--repeat", type=int, default=3, help="timeit repeat count")
+    parser.add_argument("--output", help="save the results as JSON into this file")
+    parser.add_argument("--compare", help="JSON file of a older run to compare with")
+    args = parser.parse_args()
+
+    print("dbpreferences v%s - Python v%s - Django v%s" % (
+        dbpreferences.__version__, platform.python_version(), django.get_version()
+    ))
+    results = run(quick=args.quick, repeat=args.repeat)
+
+    old_results = None
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)["results"]
+    print_results(results, old_results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "dbpreferences": dbpreferences.__version__,
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "quick": args.quick,
+                "results": results,
+            }, f, indent=4, sort_keys=True)
+        print("\nResults saved into %r" % args.output)
+
+
+if __name__ == "__main__":
+    main()
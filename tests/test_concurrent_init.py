@@ -0,0 +1,131 @@
+# coding: utf-8
+
+"""
+    concurrent first access of preferences
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Runs many threads against a file based sqlite database, because every
+    thread needs its own connection to the same database.
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import django
+from django.contrib.sites.models import Site
+from django.db import connections
+from django.db.models import signals
+from django.test import TransactionTestCase
+
+from dbpreferences import forms
+from dbpreferences.models import Preference, CacheInvalidation
+
+from test_project.preference_forms import UnittestForm
+
+
+THREAD_COUNT = 10
+
+
+@contextlib.contextmanager
+def file_database():
+    """ Use a new sqlite database file as "default" in all threads """
+    temp_dir = tempfile.mkdtemp(prefix="dbpreferences_")
+    old_settings = connections.databases["default"]
+    old_connection = getattr(connections._connections, "default")
+    connections.databases["default"] = dict(old_settings,
+        NAME=os.path.join(temp_dir, "db.sqlite3"), TEST={}
+    )
+    delattr(connections._connections, "default")
+    try:
+        with connections["default"].schema_editor() as schema_editor:
+            for model in (Site, Preference, CacheInvalidation):
+                schema_editor.create_model(model)
+        Site.objects.create(id=1, domain="example.com", name="example.com")
+        yield
+    finally:
+        connections["default"].close()
+        connections.databases["default"] = old_settings
+        setattr(connections._connections, "default", old_connection)
+        shutil.rmtree(temp_dir)
+
+
+# Django 1.6 has no schema editor, the one of Django 1.7 can't create the
+# DictModelField column (it calls get_prep_value(None) for the default).
+@unittest.skipIf(django.VERSION < (1, 8), "file_database() needs Django 1.8 or newer")
+class TestConcurrentInit(TransactionTestCase):
+    def setUp(self):
+        self.old_preferences_cache = forms._PREFERENCES_CACHE
+        forms._PREFERENCES_CACHE = {}
+        self.insert_count = 0
+        signals.pre_save.connect(self.count_insert, sender=Preference)
+
+    def tearDown(self):
+        signals.pre_save.disconnect(self.count_insert, sender=Preference)
+        forms._PREFERENCES_CACHE = self.old_preferences_cache
+
+    def count_insert(self, instance, **kwargs):
+        if instance.pk is None:
+            self.insert_count += 1
+
+    def run_threads(self, func):
+        """ call func() in many threads at the same time """
+        start = threading.Event()
+        results = []
+        errors = []
+        def run():
+            start.wait()
+            try:
+                results.append(func())
+            except Exception:
+                errors.append(sys.exc_info()[1])
+            finally:
+                # connections.close_all() is new in Django 1.8
+                for connection in connections.all():
+                    connection.close()
+
+        threads = [threading.Thread(target=run) for no in range(THREAD_COUNT)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_get_preferences(self):
+        with file_database():
+            results = self.run_threads(lambda: UnittestForm().get_preferences())
+            self.assertEqual(Preference.objects.count(), 1)
+
+        self.assertEqual(len(results), THREAD_COUNT)
+        for result in results:
+            self.assertEqual(result,
+                {'count': 10, 'foo_bool': True, 'font_size': 0.7, 'subject': 'foobar'}
+            )
+        # The form lock: only one thread tried to insert:
+        self.assertEqual(self.insert_count, 1)
+
+    def test_get_or_create_without_lock(self):
+        site = Site(id=1)
+        def get_or_create():
+            return Preference.objects.get_or_create_form_init(
+                UnittestForm(), site=site, app_label="test_project", form_name="UnittestForm"
+            )
+
+        with file_database():
+            results = self.run_threads(get_or_create)
+            self.assertEqual(Preference.objects.count(), 1)
+
+        self.assertEqual(len(results), THREAD_COUNT)
+        self.assertEqual(len([created for instance, created in results if created]), 1)
+        self.assertEqual(len(set(instance.pk for instance, created in results)), 1)
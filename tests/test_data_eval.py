@@ -8,12 +8,20 @@
 """
 
 
+import ast
 import datetime
+import pprint
+import sys
 import unittest
 
 
+from dbpreferences.tools import data_eval
 from dbpreferences.tools.data_eval import DataEval, DataEvalError, \
-    UnsafeSourceError, EvalSyntaxError
+    UnsafeSourceError, EvalSyntaxError, ScanFallback, DataEvalLimitError
+from dbpreferences.tools.lru_cache import LRUCache
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
 
 
 class TestDataEval(unittest.TestCase):
@@ -65,6 +73,27 @@ class TestDataEval(unittest.TestCase):
         self.assert_eval({"dt": datetime.datetime.now()})
         self.assert_eval(datetime.timedelta(seconds=2))
 
+    def test_timedelta_keywords(self):
+        self.assertEqual(
+            self.literal_eval("datetime.timedelta(days=1, seconds=2)"),
+            datetime.timedelta(days=1, seconds=2)
+        )
+
+    def test_nested(self):
+        self.assert_eval({"a": [1, {"b": (2, [3, [4, 5]])}], "c": {"d": {}}})
+        self.assert_eval([[-1, 2.5], [], ((),)])
+
+    def test_deep_nested_tree(self):
+        """ The AST walker doesn't recurse, so the recursion limit doesn't matter """
+        node = ast.Num(n=1)
+        for no in range(sys.getrecursionlimit() * 2):
+            node = ast.List(elts=[node], ctx=ast.Load())
+        self.assertRaises(DataEvalLimitError, DataEval().convert, node)
+        result = DataEval(max_depth=None).convert(node)
+        for no in range(sys.getrecursionlimit() * 2):
+            result = result[0]
+        self.assertEqual(result, 1)
+
     def test_line_endings(self):
         self.literal_eval("\r\n{\r\n'foo'\r\n:\r\n1\r\n}\r\n")
         self.literal_eval("\r{\r'foo'\r:\r1\r}\r")
@@ -80,6 +109,13 @@ class TestDataEval(unittest.TestCase):
         self.assertRaises(UnsafeSourceError, self.literal_eval, "a+2")
         self.assertRaises(UnsafeSourceError, self.literal_eval, "eval()")
         self.assertRaises(DataEvalError, self.literal_eval, "eval()")
+        self.assertRaises(UnsafeSourceError, self.literal_eval, "[1] + [2]")
+        self.assertRaises(UnsafeSourceError, self.literal_eval, "-'a'")
+        self.assertRaises(UnsafeSourceError, self.literal_eval, "datetime.datetime(*a)")
+        self.assertRaises(UnsafeSourceError, self.literal_eval, "datetime.set()")
+        self.assertRaises(UnsafeSourceError, self.literal_eval, "set('abc')")
+        self.assertRaises(UnsafeSourceError, self.literal_eval, "frozenset(1)")
+        self.assertRaises(DataEvalError, self.literal_eval, "set(items=[1])")
 
     def test_syntax_error(self):
         self.assertRaises(EvalSyntaxError, self.literal_eval, ":")
@@ -87,5 +123,163 @@ class TestDataEval(unittest.TestCase):
         self.assertRaises(DataEvalError, self.literal_eval, "import os")
 
 
+class TestDataEvalScan(unittest.TestCase):
+    """ Tests for the pprint subset scanner, that doesn't use the AST """
+    def assert_scan(self, data):
+        for data_string in (repr(data), pprint.pformat(data), pprint.pformat(data, width=1)):
+            result = DataEval().scan(data_string)
+            self.assertEqual(result, data)
+
+    def test_scan(self):
+        self.assert_scan(None)
+        self.assert_scan([True, False, "FooBar", u"FooBar", "it's", "a\nb", 0, -1, 1.5, -2.02, 1e-10])
+        self.assert_scan({"a": (1,), "b": (), "c": [], "d": {}, 1: {"e": [(1, 2)]}})
+        if sys.version_info[0] >= 3: # Python 2 repr is: "set([1, 2, 3])"
+            self.assert_scan(set([1, 2, 3]))
+        self.assert_scan("x" * 200) # splitted by pprint in py3
+        self.assert_scan({
+            "dt": datetime.datetime(2015, 1, 2, 3, 4, 5, 6),
+            "td": datetime.timedelta(days=-1, seconds=2, microseconds=3),
+        })
+
+    def test_keywords(self):
+        self.assertEqual(
+            DataEval().scan("datetime.timedelta(days=1, seconds=2)"),
+            datetime.timedelta(days=1, seconds=2)
+        )
+
+    def test_sets(self):
+        data_eval = DataEval()
+        self.assertEqual(data_eval.scan("set()"), set())
+        self.assertEqual(data_eval.scan("[set(), set([1])]"), [set(), set([1])])
+        result = data_eval.scan("{'a': frozenset({1, 2}), 'b': frozenset()}")
+        self.assertEqual(result, {"a": frozenset([1, 2]), "b": frozenset()})
+        self.assertIsInstance(result["a"], frozenset)
+        self.assertRaises(ScanFallback, data_eval.scan, "foo.set()")
+
+    def test_fallback(self):
+        for data_string in ("1+2j", "a", "eval()", "[1, ]]", "{1: 2, 3}", "1, 2", "007", "-'a'"):
+            self.assertRaises(ScanFallback, DataEval().scan, data_string)
+
+    def test_compiler_errors(self):
+        # Rejected by the compiler, so the scanner must not accept them either:
+        for data_string in ("datetime.datetime(2015, 010, 2)", "'a\rb'", "u'a\rb'", "'a\x00b'"):
+            self.assertRaises(ScanFallback, DataEval().scan, data_string)
+        self.assertRaises(DataEvalError, DataEval().parse, "'a\rb'")
+        self.assertRaises(DataEvalError, DataEval().parse, "'a\x00b'")
+        # Escaped, it's ok:
+        self.assertEqual(DataEval().scan(repr("a\rb\x00")), "a\rb\x00")
+        self.assertEqual(
+            DataEval().scan("datetime.datetime(2015, 10, 2, 0)"), datetime.datetime(2015, 10, 2, 0)
+        )
+
+    def test_parse_use_fallback(self):
+        self.assertEqual(DataEval().parse("1+2j"), 1+2j)
+        self.assertEqual(DataEval().parse("1, 2"), (1, 2))
+        self.assertRaises(UnsafeSourceError, DataEval().parse, "[1, a]")
+        self.assertRaises(EvalSyntaxError, DataEval().parse, "{1: 2, 3}")
+
+
+class TestDataEvalLimits(unittest.TestCase):
+    def assert_limit(self, source, **limits):
+        """ The scanner and the AST walker must raise DataEvalLimitError """
+        self.assertRaises(DataEvalLimitError, DataEval(**limits).scan, source)
+        node = ast.parse(source, mode="eval")
+        self.assertRaises(DataEvalLimitError, DataEval(**limits).convert, node)
+        self.assertRaises(DataEvalLimitError, DataEval(**limits).convert, node, len(source))
+        self.assertRaises(DataEvalLimitError, DataEval(**limits).parse, source)
+
+        # Without the limit, it's ok:
+        unlimited = dict((name, None) for name in limits)
+        self.assertEqual(DataEval(**unlimited).scan(source), DataEval(**unlimited).convert(node))
+
+    def test_max_length(self):
+        self.assertRaises(DataEvalLimitError, DataEval(max_length=10).parse, "'%s'" % ("x" * 10))
+        self.assertEqual(DataEval(max_length=10).parse("'%s'" % ("x" * 8)), "x" * 8)
+
+    def test_max_nodes(self):
+        self.assert_limit(repr(list(range(10))), max_nodes=5)
+        self.assert_limit(repr({"a": [1, 2], "b": (3, 4)}), max_nodes=5)
+
+    def test_max_depth(self):
+        self.assert_limit("[[[1]]]", max_depth=2)
+        self.assert_limit("[[[]]]", max_depth=2)
+        self.assert_limit("{'a': {'b': {'c': 1}}}", max_depth=2)
+        self.assertEqual(DataEval(max_depth=3).parse("[[[1]]]"), [[[1]]])
+
+    def test_default_max_depth(self):
+        source = "[" * 101 + "]" * 101
+        self.assertRaises(DataEvalLimitError, DataEval().parse, source)
+
+    def test_max_string_length(self):
+        self.assert_limit(repr(["x" * 11]), max_string_length=10)
+        self.assert_limit("['x' 'y']", max_string_length=1)
+        self.assertRaises(DataEvalLimitError, DataEval(max_string_length=10).scan, "[%s]" % ("1" * 11))
+        self.assertEqual(DataEval(max_string_length=10).parse(repr(["x" * 10])), ["x" * 10])
+
+    def test_source_length(self):
+        # Not checked per node: a source of this length can't exceed the limits
+        node = ast.parse(repr(["x" * 11, 1, 2]), mode="eval")
+        self.assertEqual(
+            DataEval(max_string_length=10, max_nodes=10).convert(node, 10), ["x" * 11, 1, 2]
+        )
+
+    def test_max_call_args(self):
+        dt = datetime.datetime(2015, 8, 11, 12, 13, 14, 15)
+        self.assert_limit(repr(dt), max_call_args=6)
+        self.assert_limit("datetime.timedelta(1, seconds=2)", max_call_args=1)
+        self.assertEqual(DataEval(max_call_args=7).parse(repr(dt)), dt)
+
+    def test_error_class(self):
+        self.assertTrue(issubclass(DataEvalLimitError, DataEvalError))
+
+    def test_settings(self):
+        with override_settings(DBPREFERENCES_DATA_EVAL_LIMITS={"max_depth": 1}):
+            self.assertRaises(DataEvalLimitError, DataEval().parse, "[[1]]")
+            self.assertEqual(DataEval(max_depth=2).parse("[[1]]"), [[1]])
+
+        with override_settings(DBPREFERENCES_DATA_EVAL_LIMITS={"unknown": 1}):
+            self.assertRaises(ImproperlyConfigured, DataEval)
+
+
+class TestDataEvalCache(unittest.TestCase):
+    def setUp(self):
+        self._old_cache = data_eval._PARSE_CACHE
+        data_eval._PARSE_CACHE = LRUCache(maxsize=2)
+
+    def tearDown(self):
+        data_eval._PARSE_CACHE = self._old_cache
+
+    def test_hit_and_miss(self):
+        cache = data_eval.get_parse_cache()
+        self.assertEqual(data_eval.data_eval("{'a': [1]}"), {"a": [1]})
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(data_eval.data_eval("{'a': [1]}"), {"a": [1]})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_returns_copies(self):
+        data = data_eval.data_eval("{'a': [1], 'b': {'c': 2}}")
+        data["a"].append(2)
+        data["b"]["c"] = 3
+        data = data_eval.data_eval("{'a': [1], 'b': {'c': 2}}")
+        self.assertEqual(data, {"a": [1], "b": {"c": 2}})
+        data["a"].append(2)
+        self.assertEqual(
+            data_eval.data_eval("{'a': [1], 'b': {'c': 2}}"),
+            {"a": [1], "b": {"c": 2}}
+        )
+
+    def test_bounded(self):
+        cache = data_eval.get_parse_cache()
+        for no in range(5):
+            data_eval.data_eval(repr({"no": no}))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 3)
+
+    def test_errors_not_cached(self):
+        self.assertRaises(UnsafeSourceError, data_eval.data_eval, "a")
+        self.assertEqual(len(data_eval.get_parse_cache()), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,91 @@
+# coding: utf-8
+
+"""
+    unittests for data repr
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import unittest
+
+from django.utils import six
+from django.utils.safestring import mark_safe
+
+from dbpreferences.fields import DictData
+from dbpreferences.tools.data_eval import data_eval
+from dbpreferences.tools.data_repr import data_repr
+
+
+class TestDataRepr(unittest.TestCase):
+    def assert_round_trip(self, data):
+        text = data_repr(data)
+        self.assertEqual(data_eval(text), data)
+        return text
+
+    def test_round_trip(self):
+        self.assert_round_trip({
+            "text": u"foo \xe4 'quotes' \"double\"",
+            "numbers": [0, 1, -2, 3.5, -0.1, 2 ** 70, None, True, False],
+            "tuples": ((), (1,), (1, (2, 3))),
+            "set": set([3, 1, 2]),
+            "nested": {"a": {"b": [{"c": ()}]}},
+            "keys": {1: "one", (2, 3): "tuple", None: "none"},
+            "dt": datetime.datetime(2015, 8, 11, 12, 13, 14, 15),
+            "timedelta": [
+                datetime.timedelta(days=-1, seconds=2, microseconds=3),
+                datetime.timedelta(seconds=2), datetime.timedelta(0),
+            ],
+        })
+
+    def test_deterministic(self):
+        keys = ["key %i" % no for no in range(100)]
+        data1 = dict((key, set(range(10))) for key in keys)
+        data2 = dict((key, set(range(9, -1, -1))) for key in reversed(keys))
+        self.assertEqual(data_repr(data1), data_repr(data2))
+
+    def test_single_line(self):
+        data = dict(("key %i" % no, "value %i" % no) for no in range(100))
+        text = self.assert_round_trip(data)
+        self.assertNotIn("\n", text)
+
+    def test_pprint_compatible(self):
+        """ short data results in the same text pprint.pformat() creates """
+        self.assertEqual(data_repr({"foo": "bar"}), "{'foo': 'bar'}")
+        self.assertEqual(data_repr({"a": [1, 2], "b": (1,)}), "{'a': [1, 2], 'b': (1,)}")
+
+    def test_timedelta(self):
+        self.assertEqual(data_repr(datetime.timedelta(0)), "datetime.timedelta(0)")
+        self.assertEqual(
+            data_repr(datetime.timedelta(days=-1, microseconds=3)),
+            "datetime.timedelta(-1, 0, 3)"
+        )
+
+    def test_long(self):
+        self.assertEqual(data_repr(2 ** 70), "1180591620717411303424")
+
+    def test_subclasses(self):
+        self.assertEqual(data_repr(DictData({"foo": "bar"})), "{'foo': 'bar'}")
+        self.assertEqual(data_repr(mark_safe(six.text_type("<b>"))), repr(six.text_type("<b>")))
+
+    def test_empty_set(self):
+        self.assertEqual(data_repr(set()), "set()")
+        self.assert_round_trip(set())
+        self.assert_round_trip({"a": set(), "b": [set()]})
+
+    def test_frozenset(self):
+        self.assertEqual(data_repr(frozenset([3, 1, 2])), "frozenset({1, 2, 3})")
+        self.assertEqual(data_repr(frozenset()), "frozenset()")
+        for data in (frozenset([3, 1, 2]), frozenset(), {frozenset([1]): [frozenset(["a"])]}):
+            text = self.assert_round_trip(data)
+            self.assertEqual(type(data_eval(text)), type(data))
+
+    def test_mixed_keys(self):
+        """ keys which can't be compared with Python 3 """
+        data = {"a": 1, 2: 2, (1, 2): 3}
+        self.assertEqual(data_repr(data), "{2: 2, 'a': 1, (1, 2): 3}")
+        self.assert_round_trip(data)
@@ -5,6 +5,9 @@
     INFO: dbpreferences should be exist in python path!
 """
 
+import copy
+import time
+
 from django.utils import six
 
 if __name__ == "__main__":
@@ -12,10 +15,14 @@ if __name__ == "__main__":
     import os
     os.environ["DJANGO_SETTINGS_MODULE"] = "test_settings"
 
+from django import forms as django_forms
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
+from django.contrib.sites.models import Site
+from django.db import connection
 from django.db.models import signals
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from django_tools.unittest_utils.unittest_base import BaseTestCase
 
@@ -24,6 +31,7 @@ from dbpreferences.fields import DictModelField, DictData, DictFormField
 from dbpreferences.forms import DBPreferencesBaseForm
 from dbpreferences.middleware import SettingsDict
 from dbpreferences.models import Preference, UserSettings
+from dbpreferences.tools import dict_codec
 
 from test_project.preference_forms import UnittestForm, TestModelChoiceForm
 
@@ -36,6 +44,30 @@ class FormMetaWithoutAppLabel(DBPreferencesBaseForm):
     class Meta:
         pass
 
+class SecondUnittestForm(DBPreferencesBaseForm):
+    """ A other form in the same app as UnittestForm """
+    color = django_forms.CharField(initial="red")
+
+    class Meta:
+        app_label = 'test_project'
+
+
+class CountFullCleanForm(UnittestForm):
+    full_clean_count = 0
+
+    def full_clean(self):
+        CountFullCleanForm.full_clean_count += 1
+        super(CountFullCleanForm, self).full_clean()
+
+
+class ListForm(DBPreferencesBaseForm):
+    colors = django_forms.MultipleChoiceField(
+        choices=(("red", "red"), ("blue", "blue")), initial=["red"]
+    )
+
+    class Meta:
+        app_label = 'test_project'
+
 
 class GetItemCountDict(dict):
     def __init__(self):
@@ -99,6 +131,194 @@ class TestDBPref(BaseTestCase):
         self.failUnlessEqual(pref_data,
             {'count': 20, 'foo_bool': False, 'font_size': 0.7, 'subject': 'foobar'})
 
+    def test_save_unchanged(self):
+        form = UnittestForm()
+        form.get_preferences()
+
+        saved = []
+        def post_save_handler(**kwargs):
+            saved.append(kwargs["instance"])
+        signals.post_save.connect(post_save_handler, sender=Preference)
+        try:
+            form = UnittestForm()
+            form["count"] = 10 # the initial value
+            form.save()
+            self.assertEqual(saved, [])
+
+            form["count"] = 20
+            form.save()
+            self.assertEqual(len(saved), 1)
+        finally:
+            signals.post_save.disconnect(post_save_handler, sender=Preference)
+
+        form = UnittestForm()
+        self.assertEqual(form.get_preferences()["count"], 20)
+
+    def test_cache_key(self):
+        self.assertNotEqual(UnittestForm().cache_key, SecondUnittestForm().cache_key)
+
+    def test_targeted_invalidation(self):
+        UnittestForm().get_preferences() # create the db entries
+        SecondUnittestForm().get_preferences()
+
+        form1 = UnittestForm()
+        form1.get_preferences()
+        form2 = SecondUnittestForm()
+        self.assertEqual(form2.get_preferences(), {"color": "red"})
+        self.assertEqual(
+            sorted(forms._PREFERENCES_CACHE.keys()), sorted([form1.cache_key, form2.cache_key])
+        )
+
+        form1["count"] = 20
+        form1.save()
+        self.assertEqual(list(forms._PREFERENCES_CACHE.keys()), [form2.cache_key])
+
+        # The entry for the second form is still used:
+        with self.assertNumQueries(0):
+            self.assertEqual(SecondUnittestForm().get_preferences(), {"color": "red"})
+
+        form1.instance.delete()
+        form2.instance.delete()
+        self.assertEqual(len(forms._PREFERENCES_CACHE), 0)
+
+    def test_cached_cleaned_data(self):
+        CountFullCleanForm.full_clean_count = 0
+        CountFullCleanForm().get_preferences() # create the db entry
+        CountFullCleanForm().get_preferences() # validate and cache the cleaned_data
+        self.assertEqual(CountFullCleanForm.full_clean_count, 2)
+
+        with self.assertNumQueries(0):
+            for no in range(3):
+                form = CountFullCleanForm()
+                pref_data = form.get_preferences()
+                self.assertTrue(form.is_valid())
+        self.assertEqual(CountFullCleanForm.full_clean_count, 2)
+        self.assertEqual(pref_data,
+            {'count': 10, 'foo_bool': True, 'font_size': 0.7, 'subject': 'foobar'})
+
+        # Every call returns a copy:
+        pref_data["count"] = 99
+        self.assertEqual(CountFullCleanForm().get_preferences()["count"], 10)
+
+        # Validate again after the preferences are changed:
+        form = CountFullCleanForm()
+        form["count"] = 20
+        form.save()
+        self.assertEqual(CountFullCleanForm().get_preferences()["count"], 20)
+        self.assertEqual(CountFullCleanForm.full_clean_count, 3)
+
+        # Validate again with a other form class with the same name:
+        OtherClass = type("CountFullCleanForm", (CountFullCleanForm,), {})
+        self.assertEqual(OtherClass().get_preferences()["count"], 20)
+        self.assertEqual(CountFullCleanForm.full_clean_count, 4)
+
+    def test_get_cached_preferences(self):
+        CountFullCleanForm.full_clean_count = 0
+        pref_data = CountFullCleanForm.get_cached_preferences() # create the db entry
+        self.assertEqual(pref_data,
+            {'count': 10, 'foo_bool': True, 'font_size': 0.7, 'subject': 'foobar'})
+        CountFullCleanForm.get_cached_preferences() # validate and cache the cleaned_data
+        self.assertEqual(CountFullCleanForm.full_clean_count, 2)
+
+        with self.assertNumQueries(0):
+            pref_data = CountFullCleanForm.get_cached_preferences()
+            self.assertIs(CountFullCleanForm.get_cached_preferences(), pref_data)
+        self.assertEqual(CountFullCleanForm.full_clean_count, 2)
+        self.assertEqual(pref_data["count"], 10)
+        self.assertRaises(TypeError, pref_data.__setitem__, "count", 99)
+
+        form = CountFullCleanForm()
+        form["count"] = 20
+        form.save()
+        self.assertEqual(CountFullCleanForm.get_cached_preferences()["count"], 20)
+
+        # A other site has its own preferences:
+        site2 = Site.objects.create(domain="two.example.com", name="two")
+        self.assertEqual(CountFullCleanForm.get_cached_preferences(site=site2)["count"], 10)
+        self.assertEqual(
+            Preference.objects.filter(form_name="CountFullCleanForm", site=site2).count(), 1
+        )
+
+    def test_get_cached_preferences_current_site(self):
+        site2 = Site.objects.create(domain="two.example.com", name="two")
+        form = UnittestForm(site=site2)
+        form["count"] = 30
+        form.save()
+        for site in (None, site2, None, site2): # validate and cache both entries
+            UnittestForm.get_cached_preferences(site=site)
+
+        # e.g. a SITE_ID-less setup, where the current site comes from the request:
+        Site.objects.get_current = lambda *args, **kwargs: site2
+        try:
+            self.assertEqual(UnittestForm.get_cached_preferences()["count"], 30)
+        finally:
+            del Site.objects.get_current
+        self.assertEqual(UnittestForm.get_cached_preferences()["count"], 10)
+
+    def test_get_cached_preferences_nested(self):
+        ListForm.get_cached_preferences() # create the db entry
+        ListForm.get_cached_preferences() # validate and cache the cleaned_data
+        pref_data = ListForm.get_cached_preferences()
+        self.assertEqual(pref_data, {"colors": ["red"]})
+        # The cached list is shared, too:
+        self.assertRaises(TypeError, pref_data["colors"].append, "blue")
+        self.assertEqual(ListForm.get_cached_preferences()["colors"], ["red"])
+
+        # Copies are normal containers:
+        list(pref_data["colors"]).append("blue")
+        copy.deepcopy(pref_data)["colors"].append("blue")
+        copy.copy(pref_data)["new"] = True
+        self.assertEqual(pref_data, {"colors": ["red"]})
+
+    def test_preload(self):
+        for form_class in (UnittestForm, SecondUnittestForm, CountFullCleanForm):
+            form_class().get_preferences() # create the db entries
+        forms._PREFERENCES_CACHE = GetItemCountDict()
+
+        with override_settings(DBPREFERENCES_PRELOAD=True):
+            with CaptureQueriesContext(connection) as queries:
+                for form_class in (UnittestForm, SecondUnittestForm, CountFullCleanForm):
+                    form_class().get_preferences()
+            self.assertEqual(len(queries), 1)
+            self.assertNotIn("createtime", queries[0]["sql"])
+
+            # A not existing entry would be created without a extra query:
+            Preference.objects.filter(form_name="SecondUnittestForm").delete()
+            forms._PREFERENCES_CACHE = GetItemCountDict()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(SecondUnittestForm().get_preferences(), {"color": "red"})
+            selects = [query for query in queries if "SELECT" in query["sql"]]
+            # The preload and the Preference.objects.get() in save_form_init():
+            self.assertEqual(len(selects), 2)
+
+    def test_save_preloaded(self):
+        """ A preloaded entry is a deferred instance, saving it must invalidate the cache """
+        UnittestForm().get_preferences() # create the db entry
+        forms._PREFERENCES_CACHE = GetItemCountDict()
+
+        with override_settings(DBPREFERENCES_PRELOAD=True):
+            form = UnittestForm()
+            form.get_preferences()
+            self.assertTrue(form.instance._deferred)
+            self.assertIn(form.cache_key, forms._PREFERENCES_CACHE)
+
+            form["count"] = 99
+            form.save()
+            self.assertNotIn(form.cache_key, forms._PREFERENCES_CACHE)
+            self.assertEqual(UnittestForm().get_preferences()["count"], 99)
+
+    def test_get_site_preferences(self):
+        UnittestForm().get_preferences()
+        SecondUnittestForm().get_preferences()
+        site = Site.objects.get_current()
+        with self.assertNumQueries(1):
+            preferences = dict(
+                (instance.form_name, instance.preferences)
+                for instance in Preference.objects.get_site_preferences(site)
+            )
+        self.assertEqual(preferences["SecondUnittestForm"], {"color": "red"})
+        self.assertEqual(len(preferences), 2)
+
     def test_admin_edit(self):
         # Create one db entry
         form = UnittestForm()
@@ -262,7 +482,10 @@ class TestUserSettings(BaseTestCase):
 
         self.failUnlessEqual(self._init, 0)
         self.failUnlessEqual(self._saved, 0)
-        self.failUnlessEqual(len(models._USER_SETTINGS_CACHE), 0)
+        # The missing entry is cached as negative entry:
+        self.failUnlessEqual(
+            [instance for instance, expires in models._USER_SETTINGS_CACHE.values()], [None]
+        )
 
         user_settings.save() # increment: pre_init + post_save
 
@@ -297,6 +520,59 @@ class TestUserSettings(BaseTestCase):
         user_settings["foo"]
         self.failUnlessEqual(models._USER_SETTINGS_CACHE.cache_hit, 1)
 
+    def test_modified_keys(self):
+        user = self._get_user(usertype="staff")
+        user_settings = SettingsDict(user)
+        user_settings["Foo"] = "Bar"
+        user_settings["Count"] = 1
+        user_settings.save()
+        self.failUnlessEqual(self._saved, 1)
+        self.failIf(user_settings.modified)
+
+        user_settings = SettingsDict(user)
+        user_settings["Foo"] = "Bar" # the same value
+        self.failUnlessEqual(user_settings.modified_keys, set())
+        self.failIf(user_settings.modified)
+        user_settings["Count"] = True # equal, but not the same type
+        self.failUnlessEqual(user_settings.modified_keys, set(["Count"]))
+        user_settings.save()
+        self.failUnlessEqual(self._saved, 2)
+
+        # UserSettings.save() skips the query, if nothing changed:
+        user_settings_instance = UserSettings.objects.get(user=user)
+        user_settings_instance.settings["Foo"] = "Bar"
+        with self.assertNumQueries(0):
+            user_settings_instance.save(skip_unchanged=True)
+        self.failUnlessEqual(self._saved, 2)
+
+        # ...but only if requested, other fields are not compared:
+        other_user = self._get_user(usertype="normal")
+        user_settings_instance.lastupdateby = other_user
+        user_settings_instance.save()
+        self.failUnlessEqual(self._saved, 3)
+        self.assertEqual(UserSettings.objects.get(user=user).lastupdateby, other_user)
+
+    def test_serialize_once(self):
+        user = self._get_user(usertype="staff")
+        user_settings = SettingsDict(user)
+        user_settings["Foo"] = "Bar"
+        user_settings.save()
+
+        instance = UserSettings.objects.get(user=user)
+        instance.settings["Foo"] = "new"
+        calls = []
+        old_dumps = dict_codec.dumps
+        def dumps(data):
+            calls.append(data)
+            return old_dumps(data)
+        dict_codec.dumps = dumps
+        try:
+            instance.save(skip_unchanged=True) # check and UPDATE
+        finally:
+            dict_codec.dumps = old_dumps
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(UserSettings.objects.get(user=user).settings, {"Foo": "new"})
+
     def test_view_base(self):
         url = reverse("test_user_settings", kwargs={"test_name": "base_test", "key": "Foo", "value": "Bar"})
         response = self.client.get(url)
@@ -342,6 +618,49 @@ class TestUserSettings(BaseTestCase):
         self.failUnlessEqual(self._saved, 2)
         self.failUnlessEqual(models._USER_SETTINGS_CACHE.cache_hit, 10)
 
+    def test_per_user_invalidation(self):
+        staff_user = self._get_user(usertype="staff")
+        normal_user = self._get_user(usertype="normal")
+        for user in (staff_user, normal_user):
+            user_settings = SettingsDict(user)
+            user_settings["Foo"] = "Bar"
+            user_settings.save()
+            UserSettings.objects.get_settings(user) # put it into the cache
+        self.failUnlessEqual(len(models._USER_SETTINGS_CACHE), 2)
+
+        # Saving the settings of one user doesn't drop the other users entry:
+        user_settings = SettingsDict(staff_user)
+        user_settings["Foo"] = "new value"
+        user_settings.save()
+        self.failUnlessEqual(list(models._USER_SETTINGS_CACHE.keys()),
+            [models.get_user_settings_cache_key(normal_user.pk)]
+        )
+        with self.assertNumQueries(0):
+            UserSettings.objects.get_settings(normal_user)
+
+        UserSettings.objects.get(user=normal_user).delete()
+        self.failUnlessEqual(len(models._USER_SETTINGS_CACHE), 0)
+        self.failUnlessRaises(UserSettings.DoesNotExist, UserSettings.objects.get_settings, normal_user)
+
+    def test_negative_cache(self):
+        user = self._get_user(usertype="staff")
+        self.failUnlessRaises(UserSettings.DoesNotExist, UserSettings.objects.get_settings, user)
+        with self.assertNumQueries(0):
+            self.failUnlessRaises(UserSettings.DoesNotExist, UserSettings.objects.get_settings, user)
+            user_settings = SettingsDict(user)
+            self.failUnlessEqual(user_settings.get("Foo", "initial value"), "initial value")
+
+        # The negative entry expires:
+        cache_key = models.get_user_settings_cache_key(user.pk)
+        models._USER_SETTINGS_CACHE[cache_key] = (None, time.time() - 1)
+        with self.assertNumQueries(1):
+            self.failUnlessRaises(UserSettings.DoesNotExist, UserSettings.objects.get_settings, user)
+
+        # Creating the entry removes the negative entry:
+        user_settings.save()
+        instance, settings_dict = UserSettings.objects.get_settings(user)
+        self.failUnlessEqual(settings_dict, {"Foo": "initial value"})
+
     def test_anonymous(self):
         """
         The settings would be not saved for anonymous users.
@@ -354,6 +673,14 @@ class TestUserSettings(BaseTestCase):
         # in a request, we get values set in the past
         self.failUnlessEqual(user_settings["Foo"], "bar")
 
+        # Nothing would be loaded for anonymous user:
+        with self.assertNumQueries(0):
+            user_settings = SettingsDict(user)
+            self.failUnlessEqual(user_settings.get("Foo", "initial value"), "initial value")
+        user_settings = SettingsDict(user)
+        self.failIf(user_settings.modified)
+        user_settings["Foo"] = "bar"
+
         # For anonymous user, save() does nothing:
         user_settings.save()
         self.failUnlessEqual(self._saved, 0)
@@ -362,6 +689,167 @@ class TestUserSettings(BaseTestCase):
         user_settings = SettingsDict(user)
         self.failUnlessEqual(user_settings.get("Foo", "not the initial value"), "not the initial value")
 
+    def test_change_mutable_value(self):
+        """ A list changed in place and set again must be saved """
+        user = self._get_user(usertype="staff")
+        user_settings = SettingsDict(user)
+        user_settings["list"] = [1]
+        user_settings.save()
+
+        user_settings = SettingsDict(user)
+        values = user_settings["list"]
+        values.append(2)
+        user_settings["list"] = values
+        self.failUnless(user_settings.modified)
+        user_settings.save()
+        self.failUnlessEqual(UserSettings.objects.get(user=user).settings, {"list": [1, 2]})
+
+        # Changing a value doesn't change the cached settings before save:
+        user_settings = SettingsDict(user)
+        user_settings["list"].append(3)
+        self.failUnlessEqual(SettingsDict(user)["list"], [1, 2])
+
+        # Set back to the loaded value -> nothing to save:
+        user_settings = SettingsDict(user)
+        user_settings["list"] = [1, 2, 3]
+        user_settings["list"] = [1, 2]
+        self.failIf(user_settings.modified)
+
+    def test_merge_mutable_value(self):
+        user = self._get_user(usertype="staff")
+        user_settings = SettingsDict(user)
+        user_settings["list"] = [1]
+        user_settings["Foo"] = "initial"
+        user_settings.save()
+
+        request1 = SettingsDict(user)
+        request2 = SettingsDict(user)
+        request1.load()
+        request2.load()
+
+        request1["Foo"] = "request 1"
+        request1.save()
+        values = request2["list"]
+        values.append(2)
+        request2["list"] = values
+        request2.save()
+
+        instance = UserSettings.objects.get(user=user)
+        self.failUnlessEqual(instance.settings, {"Foo": "request 1", "list": [1, 2]})
+
+    def test_version_conflict(self):
+        user = self._get_user(usertype="staff")
+        UserSettings.objects.create(user=user, settings={"Foo": 1}, createby=user, lastupdateby=user)
+        instance1 = UserSettings.objects.get(user=user)
+        instance2 = UserSettings.objects.get(user=user)
+
+        instance1.settings = {"Foo": 2}
+        instance1.save()
+        self.failUnlessEqual(instance1.version, 1)
+
+        instance2.settings = {"Foo": 3}
+        self.failUnlessRaises(UserSettings.VersionConflict, instance2.save)
+        # Nothing changed, so the save can be retried after a merge:
+        self.failUnlessEqual(instance2.version, 0)
+        self.failUnless(instance2.has_changed())
+        instance = UserSettings.objects.get(user=user)
+        self.failUnlessEqual((instance.version, instance.settings), (1, {"Foo": 2}))
+
+    def test_concurrent_merge(self):
+        """ Two parallel requests of the same user change different keys """
+        user = self._get_user(usertype="staff")
+        user_settings = SettingsDict(user)
+        user_settings["Foo"] = "initial"
+        user_settings["Bar"] = "initial"
+        user_settings.save()
+
+        request1 = SettingsDict(user)
+        request2 = SettingsDict(user)
+        request1.load()
+        request2.load()
+
+        request1["Foo"] = "request 1"
+        request1.save()
+        request2["Bar"] = "request 2"
+        request2.save()
+
+        instance = UserSettings.objects.get(user=user)
+        self.failUnlessEqual(instance.settings, {"Foo": "request 1", "Bar": "request 2"})
+        self.failUnlessEqual(instance.version, 2)
+        # The request sees the merged settings, too:
+        self.failUnlessEqual(dict(request2), {"Foo": "request 1", "Bar": "request 2"})
+
+        # The same key: the last save wins
+        request1 = SettingsDict(user)
+        request2 = SettingsDict(user)
+        request1.load()
+        request2.load()
+        request1["Foo"] = "first"
+        request1.save()
+        request2["Foo"] = "last"
+        request2.save()
+        instance = UserSettings.objects.get(user=user)
+        self.failUnlessEqual(instance.settings, {"Foo": "last", "Bar": "request 2"})
+
+    def test_concurrent_create(self):
+        user = self._get_user(usertype="staff")
+        request1 = SettingsDict(user)
+        request2 = SettingsDict(user)
+        request1["Foo"] = "request 1"
+        request2["Bar"] = "request 2"
+        request1.save()
+        request2.save()
+
+        instance = UserSettings.objects.get(user=user)
+        self.failUnlessEqual(instance.settings, {"Foo": "request 1", "Bar": "request 2"})
+
+    def test_concurrent_delete(self):
+        user = self._get_user(usertype="staff")
+        user_settings = SettingsDict(user)
+        user_settings["Foo"] = "initial"
+        user_settings.save()
+
+        user_settings = SettingsDict(user)
+        user_settings.load()
+        UserSettings.objects.filter(user=user).delete()
+        user_settings["Bar"] = "new"
+        user_settings.save()
+        instance = UserSettings.objects.get(user=user)
+        self.failUnlessEqual(instance.settings, {"Foo": "initial", "Bar": "new"})
+
+        # Deleted, created again and saved by a other request. (Without
+        # the save it may have the same pk and version on SQLite.)
+        user_settings = SettingsDict(user)
+        user_settings.load()
+        UserSettings.objects.filter(user=user).delete()
+        instance = UserSettings.objects.create(user=user, settings={}, createby=user, lastupdateby=user)
+        instance.settings = {"Other": 1}
+        instance.save()
+        user_settings["Bar"] = "changed"
+        user_settings.save()
+        instance = UserSettings.objects.get(user=user)
+        self.failUnlessEqual(instance.settings, {"Other": 1, "Bar": "changed"})
+
+    def test_conflict_retries(self):
+        """ VersionConflict is raised, if every retry conflicts again """
+        user = self._get_user(usertype="staff")
+        UserSettings.objects.create(user=user, settings={}, createby=user, lastupdateby=user)
+
+        merges = []
+        class ConflictingSettingsDict(SettingsDict):
+            def _merge(self, instance):
+                merges.append(instance.version)
+                super(ConflictingSettingsDict, self)._merge(instance)
+                # The next save conflicts again:
+                UserSettings.objects.filter(pk=instance.pk).update(version=instance.version + 1)
+
+        user_settings = ConflictingSettingsDict(user)
+        user_settings.load()
+        UserSettings.objects.filter(user=user).update(version=1)
+        user_settings["Foo"] = "Bar"
+        self.failUnlessRaises(UserSettings.VersionConflict, user_settings.save)
+        self.failUnlessEqual(merges, [1, 2, 3])
+
     def test_issues1(self):
         """ https://github.com/jedie/django-dbpreferences/issues/1 """
         user = self._get_user(usertype="staff")
@@ -0,0 +1,162 @@
+# coding: utf-8
+
+"""
+    unittests for dict codec
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import unittest
+
+import django.test
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+
+from dbpreferences.fields import DictModelField, DictData
+from dbpreferences.tools import dict_codec
+from dbpreferences.tools.data_eval import DataEvalError, DataEvalLimitError
+
+from test_project.models import UnittestDictModelFieldModel
+
+
+DATA = {
+    "text": u"foo \xe4",
+    "numbers": [1, -2, 3.5, None, True, False],
+    "tuple": (1, (2, 3)),
+    "set": set([1, 2]),
+    "nested": {"a": {"b": [{"c": ()}]}},
+    "int keys": {1: "one", (2, 3): "tuple"},
+    "dt": datetime.datetime(2015, 8, 11, 12, 13, 14, 15),
+    "td": datetime.timedelta(days=-1, seconds=2, microseconds=3),
+    "tag like": {"$t": [1, 2]},
+}
+
+
+class TestDictCodec(unittest.TestCase):
+    def test_json_round_trip(self):
+        text = dict_codec.json_dumps(DATA)
+        self.assertEqual(dict_codec.json_loads(text), DATA)
+        self.assertEqual(dict_codec.loads(dict_codec.JSON_MARKER + text), DATA)
+
+    def test_python_round_trip(self):
+        text = dict_codec.python_dumps(DATA)
+        self.assertEqual(dict_codec.loads(text), DATA)
+
+    def test_json_is_compact(self):
+        self.assertEqual(
+            dict_codec.json_dumps({"b": [1, 2], "a": None}),
+            '{"a":null,"b":[1,2]}'
+        )
+
+    def test_python_literal_like_json(self):
+        self.assertEqual(dict_codec.loads('''{"foo":"bar"}'''), {"foo": "bar"})
+        self.assertEqual(dict_codec.loads('''{"foo": {"$t": [1]}}'''), {"foo": {"$t": [1]}})
+
+    def test_json_error(self):
+        self.assertRaises(DataEvalError, dict_codec.loads, "json:{'foo': 1}")
+
+    def test_aware_datetime(self):
+        class UTC(datetime.tzinfo):
+            def utcoffset(self, dt):
+                return datetime.timedelta(0)
+
+        data = {"dt": datetime.datetime(2015, 1, 1, tzinfo=UTC())}
+        self.assertRaises(TypeError, dict_codec.json_dumps, data)
+
+    def test_codec_setting(self):
+        with override_settings(DBPREFERENCES_DICT_CODEC="json"):
+            self.assertEqual(dict_codec.dumps({"foo": (1,)}), 'json:{"foo":{"$t":[1]}}')
+            text = DictModelField().get_prep_value(DictData({"foo": "bar"}))
+            self.assertEqual(text, 'json:{"foo":"bar"}')
+
+        with override_settings(DBPREFERENCES_DICT_CODEC="python"):
+            self.assertEqual(dict_codec.dumps({"foo": (1,)}), "{'foo': (1,)}")
+
+        with override_settings(DBPREFERENCES_DICT_CODEC="unknown"):
+            self.assertRaises(ImproperlyConfigured, dict_codec.dumps, {})
+
+    def test_dict_data(self):
+        self.assertEqual(DictData('json:{"foo":{"$t":[1]}}'), {"foo": (1,)})
+        self.assertEqual(DictData("{'foo': (1,)}"), {"foo": (1,)})
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        dict_codec.compression_stats.reset()
+
+    def test_threshold(self):
+        big = {"text": "foo bar " * 100}
+        small = {"text": "foo"}
+        with override_settings(DBPREFERENCES_DICT_COMPRESS_THRESHOLD=200):
+            text = dict_codec.dumps(big)
+            self.assertTrue(text.startswith(dict_codec.ZLIB_MARKER))
+            self.assertLess(len(text), 200)
+            self.assertEqual(dict_codec.loads(text), big)
+
+            self.assertEqual(dict_codec.dumps(small), "{'text': 'foo'}")
+
+        with override_settings(DBPREFERENCES_DICT_COMPRESS_THRESHOLD=None):
+            self.assertFalse(dict_codec.dumps(big).startswith(dict_codec.ZLIB_MARKER))
+
+        info = dict_codec.compression_stats.info()
+        self.assertEqual(info["compress_count"], 1)
+        self.assertEqual(info["decompress_count"], 1)
+        self.assertEqual(info["plain_size"], len(dict_codec.python_dumps(big)))
+        self.assertLess(info["ratio"], 0.2)
+
+    def test_not_smaller(self):
+        """ Store the plain text, if the compressed one is not smaller """
+        data = {"a": 1}
+        with override_settings(DBPREFERENCES_DICT_COMPRESS_THRESHOLD=0):
+            self.assertEqual(dict_codec.dumps(data), "{'a': 1}")
+
+    def test_json(self):
+        data = {"tuple": tuple(range(100))}
+        with override_settings(DBPREFERENCES_DICT_CODEC="json", DBPREFERENCES_DICT_COMPRESS_THRESHOLD=100):
+            text = dict_codec.dumps(data)
+        self.assertTrue(text.startswith(dict_codec.ZLIB_MARKER))
+        self.assertEqual(dict_codec.loads(text), data)
+
+    def test_error(self):
+        self.assertRaises(DataEvalError, dict_codec.loads, "zlib:no zlib data")
+
+    def test_max_length(self):
+        text = dict_codec.compress(dict_codec.JSON_MARKER + '"%s"' % ("x" * 1000))
+        with override_settings(DBPREFERENCES_DATA_EVAL_LIMITS={"max_length": 100}):
+            self.assertRaises(DataEvalLimitError, dict_codec.loads, text)
+            self.assertRaises(DataEvalLimitError, dict_codec.loads, dict_codec.decompress(text))
+        self.assertEqual(dict_codec.loads(text), "x" * 1000)
+
+
+class TestDictModelFieldCodec(django.test.TestCase):
+    def test_mixed_rows(self):
+        with override_settings(DBPREFERENCES_DICT_CODEC="python"):
+            UnittestDictModelFieldModel.objects.create(dict_field={"row": (1,)})
+        with override_settings(DBPREFERENCES_DICT_CODEC="json"):
+            UnittestDictModelFieldModel.objects.create(dict_field={"row": (2,)})
+
+        self.assertEqual(
+            [instance.dict_field for instance in UnittestDictModelFieldModel.objects.order_by("pk")],
+            [{"row": (1,)}, {"row": (2,)}]
+        )
+
+    def test_mixed_compressed_rows(self):
+        big = {"text": "foo bar " * 100}
+        UnittestDictModelFieldModel.objects.create(dict_field=big)
+        with override_settings(DBPREFERENCES_DICT_COMPRESS_THRESHOLD=200):
+            UnittestDictModelFieldModel.objects.create(dict_field=big)
+
+        raw = UnittestDictModelFieldModel.objects.order_by("pk").values_list("dict_field", flat=True)
+        self.assertEqual(
+            [text.startswith(dict_codec.ZLIB_MARKER) for text in raw],
+            [False, True]
+        )
+        self.assertEqual(
+            [instance.dict_field for instance in UnittestDictModelFieldModel.objects.all()],
+            [big, big]
+        )
@@ -17,6 +17,7 @@ import django
 
 from django.core.exceptions import ValidationError
 from django import forms
+from django.utils import six
 
 from django_tools.unittest_utils.print_sql import PrintQueries
 
@@ -135,6 +136,47 @@ class TestDictModelField(django.test.TestCase):
             d = instance.dict_field
             self.assertEqual(d, {'foo': 'bar', 'test': 'test_get()'})
 
+    def test_lazy_deserialization(self):
+        instance = UnittestDictModelFieldModel.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.__dict__["dict_field"], "{'foo': 'bar'}") # not parsed, yet
+        self.assertEqual(instance.dict_field, {'foo': 'bar'})
+        self.assertIsInstance(instance.__dict__["dict_field"], DictData)
+
+    def test_save_untouched(self):
+        """ A never read value would be saved back without serialize it again """
+        raw = "{  'foo' :'bar'  }" # not in the form dict_codec.dumps() writes
+        UnittestDictModelFieldModel.objects.filter(pk=self.instance.pk).update(dict_field=raw)
+
+        instance = UnittestDictModelFieldModel.objects.get(pk=self.instance.pk)
+        instance.save()
+        self.assertIsInstance(instance.__dict__["dict_field"], six.string_types)
+
+        values = UnittestDictModelFieldModel.objects.filter(pk=self.instance.pk).values_list("dict_field", flat=True)
+        self.assertEqual(list(values), [raw])
+
+    def test_has_changed(self):
+        field = UnittestDictModelFieldModel._meta.get_field("dict_field")
+        self.assertFalse(field.has_changed(self.instance)) # snapshot from save()
+
+        instance = UnittestDictModelFieldModel.objects.get(pk=self.instance.pk)
+        self.assertFalse(field.has_changed(instance))
+        self.assertEqual(instance.dict_field, {'foo': 'bar'})
+        self.assertFalse(field.has_changed(instance))
+
+        instance.dict_field = {'foo': 'bar'} # the same content
+        self.assertFalse(field.has_changed(instance))
+
+        instance.dict_field["foo"] = ["nested"]
+        self.assertTrue(field.has_changed(instance))
+        instance.dict_field["foo"][0] = "new"
+        self.assertTrue(field.has_changed(instance))
+
+        with self.assertNumQueries(1):
+            instance.save()
+        self.assertFalse(field.has_changed(instance))
+
+        self.assertTrue(field.has_changed(UnittestDictModelFieldModel(dict_field={})))
+
     @unittest.expectedFailure # FIXME!
     def test_values(self):
         """
@@ -0,0 +1,100 @@
+# coding: utf-8
+
+"""
+    unittests for the form registry
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import unittest
+
+from django import forms as django_forms
+
+try:
+    from django.apps import apps
+except ImportError: # Django < 1.7
+    apps = None
+
+from django_tools.unittest_utils.unittest_base import BaseTestCase
+
+from dbpreferences.form_registry import FormRegistry, form_registry
+from dbpreferences.forms import DBPreferencesBaseForm
+from dbpreferences.models import Preference
+
+from test_project import preference_forms
+from test_project.preference_forms import UnittestForm, TestModelChoiceForm
+
+
+class NotDiscoveredForm(DBPreferencesBaseForm):
+    """ defined outside of a preference_forms module """
+    color = django_forms.CharField(initial="red")
+
+    class Meta:
+        app_label = "test_project"
+
+
+class TestFormRegistry(BaseTestCase):
+    @unittest.skipIf(apps is None, "no app registry in Django < 1.7")
+    def test_app_config(self):
+        from dbpreferences.apps import DBPreferencesConfig
+        self.assertIsInstance(apps.get_app_config("dbpreferences"), DBPreferencesConfig)
+
+    def test_autodiscover(self):
+        self.assertIn(("test_project", "UnittestForm"), form_registry)
+        self.assertIn(("test_project", "TestModelChoiceForm"), form_registry)
+
+        registry = FormRegistry()
+        registry.autodiscover()
+        self.assertEqual(sorted(registry.keys()), [
+            ("test_project", "TestModelChoiceForm"), ("test_project", "UnittestForm")
+        ])
+        self.assertIs(
+            registry.get_form_class("test_project", "UnittestForm"), UnittestForm
+        )
+
+    def test_register_module(self):
+        registry = FormRegistry()
+        registry.register_module(preference_forms)
+        # DBPreferencesBaseForm and Preference are imported, not defined there:
+        self.assertEqual(len(registry), 2)
+
+    def test_precomputed(self):
+        registered_form = form_registry.get("test_project", "UnittestForm")
+        self.assertEqual(registered_form.init_dict,
+            {'count': 10, 'foo_bool': True, 'font_size': 0.7, 'subject': 'foobar'}
+        )
+        init_dict = registered_form.get_init_dict()
+        init_dict["count"] = 99
+        self.assertEqual(registered_form.init_dict["count"], 10)
+
+        fields = dict((field.name, field) for field in registered_form.fields)
+        self.assertEqual(fields["count"].field_type, "IntegerField")
+        self.assertEqual(fields["count"].initial, 10)
+        self.assertTrue(fields["count"].required)
+        self.assertFalse(fields["foo_bool"].required)
+        self.assertEqual(fields["subject"].help_text, "Some foo text")
+
+    def test_get_form_class(self):
+        UnittestForm().get_preferences() # create the db entry
+        instance = Preference.objects.get(form_name="UnittestForm")
+        self.assertIs(instance.get_form_class(), UnittestForm)
+
+    def test_not_discovered(self):
+        registry = FormRegistry()
+        # Fallback: import the form from the preference_forms module:
+        self.assertIs(
+            registry.get_form_class("test_project", "UnittestForm"), UnittestForm
+        )
+        self.assertIn(("test_project", "UnittestForm"), registry)
+        self.assertRaises(ImportError, registry.get, "does_not_exist", "Foo")
+        self.assertRaises(AttributeError, registry.get, "test_project", "DoesNotExist")
+
+        registered_form = registry.get_for_class(NotDiscoveredForm)
+        self.assertEqual(registered_form.init_dict, {"color": "red"})
+        self.assertIs(
+            registry.get_form_class("test_project", "NotDiscoveredForm"), NotDiscoveredForm
+        )
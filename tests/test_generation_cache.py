@@ -0,0 +1,389 @@
+# coding: utf-8
+
+"""
+    unittests for the generation cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import sys
+import threading
+import time
+
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from django_tools.unittest_utils.unittest_base import BaseTestCase
+
+from dbpreferences import forms, models
+from dbpreferences.models import CacheInvalidation, Preference, UserSettings
+from dbpreferences.tools import generation_cache
+from dbpreferences.tools.generation_cache import GenerationCache
+
+from test_project.preference_forms import UnittestForm
+
+
+class SlowLog(object):
+    """ CacheInvalidation.objects replacement: Every query takes a while """
+    def __init__(self, entries):
+        self.entries = entries
+        self.running = self.max_running = 0
+        self.lock = threading.Lock()
+
+    def get_entries(self, generation, older_generations=()):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.1)
+        with self.lock:
+            self.running -= 1
+        return [
+            entry for entry in self.entries
+            if entry[0] >= generation or entry[0] in older_generations
+        ]
+
+
+class SlowLogCache(GenerationCache):
+    log = None
+
+    @property
+    def _log(self):
+        return self.log
+
+
+class TestGenerationCache(BaseTestCase):
+    def setUp(self):
+        self.old_caches = list(GenerationCache.CACHES)
+        # Two instances with the same id, as they would exist in two processes
+        self.cache1 = GenerationCache(id="unittest", check_interval=0)
+        self.cache2 = GenerationCache(id="unittest", check_interval=0)
+
+    def tearDown(self):
+        GenerationCache.CACHES[:] = self.old_caches
+
+    def fill(self, cache, **data):
+        cache.check_state(force=True)
+        for key, value in data.items():
+            cache[key] = value
+
+    def assertCacheEqual(self, cache, data):
+        self.assertEqual(dict(cache.items()), data)
+
+    def test_invalidate(self):
+        self.fill(self.cache1, a=1, b=2)
+        self.fill(self.cache2, a=1, b=2)
+
+        self.cache1.invalidate("a")
+        self.assertCacheEqual(self.cache1, {"b": 2})
+
+        with self.assertNumQueries(1):
+            self.assertNotIn("a", self.cache2)
+        self.assertCacheEqual(self.cache2, {"b": 2})
+
+        self.cache2["a"] = "new"
+        self.assertEqual(self.cache2["a"], "new")
+
+    def test_invalidate_many(self):
+        self.fill(self.cache1, a=1, b=2, c=3)
+        self.fill(self.cache2, a=1, b=2, c=3)
+        start = self.cache1.generation
+        with CaptureQueriesContext(connection) as queries:
+            self.cache1.invalidate_many(["a", "b"])
+        self.assertEqual(len([query for query in queries if "INSERT INTO" in query["sql"]]), 1)
+        self.assertCacheEqual(self.cache1, {"c": 3})
+        self.assertEqual(CacheInvalidation.objects.get_generation(), start + 2)
+
+        self.cache2.check_state()
+        self.assertCacheEqual(self.cache2, {"c": 3})
+
+        with self.assertNumQueries(0):
+            self.cache1.invalidate_many([])
+
+    def test_set_if_version(self):
+        self.fill(self.cache1, a=1)
+        version = self.cache1.get_version("a")
+        self.assertTrue(self.cache1.set_if_version("a", version, 2))
+        self.assertCacheEqual(self.cache1, {"a": 2})
+
+        # invalidated in this process:
+        version = self.cache1.get_version("a")
+        self.cache1.invalidate("b")
+        self.assertFalse(self.cache1.set_if_version("a", version, 3))
+        self.assertCacheEqual(self.cache1, {"a": 2})
+
+        # invalidated in a other process:
+        self.fill(self.cache2, a=2)
+        version = self.cache2.get_version("a")
+        self.cache1.invalidate("a")
+        self.cache2.check_state()
+        self.assertFalse(self.cache2.set_if_version("a", version, 3))
+        self.assertCacheEqual(self.cache2, {})
+
+    def test_clear(self):
+        self.fill(self.cache1, a=1)
+        self.fill(self.cache2, a=1)
+        other = GenerationCache(id="unittest_other", check_interval=0)
+        self.fill(other, a=1)
+        self.cache1.clear()
+        self.cache2.check_state()
+        other.check_state()
+        self.assertCacheEqual(self.cache2, {})
+        self.assertCacheEqual(other, {"a": 1})
+
+    def test_check_interval(self):
+        cache = GenerationCache(id="unittest", check_interval=60)
+        self.fill(cache, a=1)
+        self.cache1.invalidate("a")
+        with self.assertNumQueries(0):
+            self.assertEqual(cache["a"], 1) # stale, until the next check
+        with self.assertNumQueries(1):
+            cache.check_state(force=True)
+        self.assertNotIn("a", cache)
+
+    def test_default_check_interval(self):
+        """ Without the middleware, the caches are synced by the interval """
+        cache = GenerationCache(id="unittest")
+        self.assertEqual(cache.check_interval, generation_cache.DEFAULT_CHECK_INTERVAL)
+
+    def add_log_entry(self, generation, key):
+        CacheInvalidation.objects.create(id=generation, cache_id="unittest", key=key)
+
+    def test_late_commit(self):
+        """ A lower id committed after a higher one, e.g. by a long transaction """
+        self.fill(self.cache1, a=1, b=2, c=3)
+        start = self.cache1.generation
+        self.add_log_entry(start + 2, "b")
+        self.cache1.check_state()
+        self.assertCacheEqual(self.cache1, {"a": 1, "c": 3})
+        self.assertEqual(self.cache1.generation, start + 2)
+        self.assertEqual(list(self.cache1._gaps), [start + 1])
+
+        self.add_log_entry(start + 1, "a") # committed now
+        self.cache1.check_state()
+        self.assertCacheEqual(self.cache1, {"c": 3})
+        self.assertEqual(self.cache1._gaps, {})
+
+    def test_late_commit_first_check(self):
+        start = CacheInvalidation.objects.get_generation()
+        self.add_log_entry(start + 2, "b")
+        self.fill(self.cache1, a=1)
+        self.assertEqual(list(self.cache1._gaps), [start + 1])
+        self.add_log_entry(start + 1, "a")
+        self.cache1.check_state()
+        self.assertCacheEqual(self.cache1, {})
+
+    def test_gap_timeout(self):
+        self.fill(self.cache1, a=1)
+        start = self.cache1.generation
+        self.add_log_entry(start + 2, "b")
+        self.cache1.check_state()
+        self.cache1._gaps[start + 1] -= generation_cache.GAP_TIMEOUT + 1 # e.g. rolled back
+        self.cache1.check_state()
+        self.assertEqual(self.cache1._gaps, {})
+
+    def test_too_many_gaps(self):
+        self.fill(self.cache1, a=1)
+        start = self.cache1.generation
+        self.add_log_entry(start + generation_cache.MAX_GAPS + 2, "b")
+        self.cache1.check_state()
+        self.assertCacheEqual(self.cache1, {})
+        self.assertEqual(self.cache1._gaps, {})
+
+    def test_concurrent_checks(self):
+        cache = SlowLogCache(id="unittest", check_interval=0)
+        cache.log = SlowLog([(9, "unittest", "a"), (10, "unittest", "b")])
+        cache.generation = 10
+        cache._gaps = {9: time.time()} # committed late, will be applied by one thread
+        cache["a"] = cache["c"] = 1
+
+        errors = []
+        def check():
+            try:
+                cache.check_state(force=True)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+        threads = [threading.Thread(target=check) for no in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(cache.log.max_running, 1)
+        self.assertEqual(cache._gaps, {})
+        self.assertEqual(cache.generation, 10)
+        self.assertEqual(list(cache.keys()), ["c"])
+
+    def test_first_check(self):
+        self.cache1["a"] = 1 # unknown generation
+        self.cache1.check_state()
+        self.assertCacheEqual(self.cache1, {})
+
+    def test_generation(self):
+        self.fill(self.cache2)
+        start = self.cache2.generation
+        self.cache1.invalidate("a")
+        self.cache1.invalidate("b")
+        self.cache2.check_state()
+        self.assertEqual(self.cache2.generation, start + 2)
+        self.assertEqual(CacheInvalidation.objects.get_generation(), start + 2)
+
+    def test_pruned(self):
+        self.cache2.invalidate("foo")
+        self.fill(self.cache1, a=1, b=2)
+        for no in range(3):
+            self.cache2.invalidate("foo")
+        CacheInvalidation.objects.prune(CacheInvalidation.objects.get_generation() - 1)
+        self.cache1.check_state()
+        self.assertCacheEqual(self.cache1, {})
+
+        self.fill(self.cache1, a=1)
+        CacheInvalidation.objects.all().delete()
+        self.cache1.check_state()
+        self.assertCacheEqual(self.cache1, {})
+        self.cache2.invalidate("a")
+        self.fill(self.cache1, a=1)
+        self.cache2.invalidate("a")
+        self.cache1.check_state()
+        self.assertCacheEqual(self.cache1, {})
+
+    def test_bounded(self):
+        cache = GenerationCache(id="unittest", check_interval=0,
+            maxsize=3, maxmemory=10, sizeof=len
+        )
+        cache.check_state(force=True)
+        for key in ("a", "b", "c", "d"):
+            cache[key] = "x"
+        self.assertEqual(sorted(cache.keys()), ["b", "c", "d"])
+        cache["b"] # mark as most recently used
+        cache["e"] = "x" * 9 # "c" and "d" must be discarded, because of the memory limit
+        self.assertCacheEqual(cache, {"b": "x", "e": "x" * 9})
+        self.assertEqual(cache.info()["evictions"], 3)
+        self.assertEqual(cache.memory, 10)
+
+        cache.invalidate("e")
+        self.assertEqual(cache.memory, 1)
+
+    def test_prune_every(self):
+        old_prune_every = generation_cache.PRUNE_EVERY
+        generation_cache.PRUNE_EVERY = 1
+        self.cache1.log_size = 2
+        try:
+            for no in range(5):
+                self.cache1.invalidate("a")
+        finally:
+            generation_cache.PRUNE_EVERY = old_prune_every
+        self.assertEqual(CacheInvalidation.objects.count(), 2)
+
+    def test_prune_skipped_ids(self):
+        """ pruned, even if the ids are not continuous """
+        self.cache1.log_size = 2
+        self.cache1.invalidate("a") # The first one prunes
+        start = self.cache1._last_pruned
+        self.cache1.invalidate("a")
+        self.assertEqual(self.cache1._last_pruned, start)
+
+        # The ids in between are used by other processes:
+        self.add_log_entry(start + generation_cache.PRUNE_EVERY + 1, "b")
+        self.cache1.invalidate("a")
+        self.assertEqual(self.cache1._last_pruned, start + generation_cache.PRUNE_EVERY + 2)
+        self.assertEqual(CacheInvalidation.objects.count(), 2)
+
+
+class TestGenerationCacheIntegration(BaseTestCase):
+    def setUp(self):
+        Preference.objects.all().delete()
+        self.old_caches = list(GenerationCache.CACHES)
+        self.old_preferences_cache = forms._PREFERENCES_CACHE
+        self.old_user_settings_cache = models._USER_SETTINGS_CACHE
+        forms._PREFERENCES_CACHE = GenerationCache(id="form")
+
+    def tearDown(self):
+        GenerationCache.CACHES[:] = self.old_caches
+        forms._PREFERENCES_CACHE = self.old_preferences_cache
+        models._USER_SETTINGS_CACHE = self.old_user_settings_cache
+
+    def test_preferences(self):
+        cache = forms._PREFERENCES_CACHE
+        self.assertIsInstance(cache, GenerationCache)
+        UnittestForm().get_preferences() # create the db entry
+        form = UnittestForm()
+        form.get_preferences()
+        self.assertIn(form.cache_key, cache)
+
+        # A other process changed the preferences:
+        preferences = Preference.objects.get(form_name="UnittestForm").preferences
+        preferences["count"] = 20
+        Preference.objects.filter(form_name="UnittestForm").update(preferences=preferences)
+        CacheInvalidation.objects.add_entry(cache.id, form.cache_key)
+
+        self.assertEqual(UnittestForm().get_preferences()["count"], 10) # stale
+        generation_cache.check_caches()
+        self.assertEqual(UnittestForm().get_preferences()["count"], 20)
+
+    def test_user_settings(self):
+        self.create_testusers()
+        staff_user = self._get_user(usertype="staff")
+        normal_user = self._get_user(usertype="normal")
+        for user in (staff_user, normal_user):
+            UserSettings.objects.create(
+                user=user, settings={"foo": "bar"}, createby=user, lastupdateby=user
+            )
+
+        # A other process caches the settings of both users:
+        other_process = GenerationCache(id="user_settings")
+        models._USER_SETTINGS_CACHE = other_process
+        other_process.check_state(force=True)
+        for user in (staff_user, normal_user):
+            UserSettings.objects.get_settings(user)
+        models._USER_SETTINGS_CACHE = GenerationCache(id="user_settings")
+
+        instance = UserSettings.objects.get(user=staff_user)
+        instance.settings["foo"] = "new"
+        instance.save()
+
+        # Only the entry of the changed user is dropped:
+        other_process.check_state(force=True)
+        self.assertEqual(other_process.keys(),
+            [models.get_user_settings_cache_key(normal_user.pk)]
+        )
+        self.assertEqual(UserSettings.objects.get_cache_info()["size"], 0)
+
+    def test_user_settings_size(self):
+        self.create_testusers()
+        user = self._get_user(usertype="normal")
+        UserSettings.objects.create(
+            user=user, settings={"foo": "bar", "list": [1, 2]}, createby=user, lastupdateby=user
+        )
+        cache = GenerationCache(id="user_settings", maxmemory=1024, sizeof=models.user_settings_size)
+        models._USER_SETTINGS_CACHE = cache
+        cache.check_state(force=True)
+
+        def data_repr(data):
+            raise AssertionError("settings serialized again")
+        old_data_repr = models.data_repr
+        models.data_repr = data_repr
+        try:
+            UserSettings.objects.get_settings(user)
+        finally:
+            models.data_repr = old_data_repr
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT settings FROM %s WHERE user_id = %%s" % UserSettings._meta.db_table,
+            [user.pk]
+        )
+        self.assertEqual(cache.memory, len(cursor.fetchone()[0]))
+
+    def test_middleware(self):
+        cache = forms._PREFERENCES_CACHE
+        cache.check_state(force=True)
+        cache["foo"] = "bar"
+        CacheInvalidation.objects.add_entry(cache.id, "foo")
+        self.client.get(reverse("test_user_settings",
+            kwargs={"test_name": "base_test", "key": "Foo", "value": "Bar"}
+        ))
+        self.assertNotIn("foo", cache)
@@ -0,0 +1,151 @@
+# coding: utf-8
+
+"""
+    unittests for the DBPreferencesMiddleware
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import sys
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.utils.functional import empty
+
+from django_tools.unittest_utils.unittest_base import BaseTestCase
+
+from dbpreferences import models
+from dbpreferences.middleware import DBPreferencesMiddleware, SettingsDict, dbpreferences_exempt
+from dbpreferences.models import CacheInvalidation, UserSettings
+from dbpreferences.tools.generation_cache import GenerationCache
+
+
+def view(request):
+    return HttpResponse("OK")
+
+
+class TestDBPreferencesMiddleware(BaseTestCase):
+    def setUp(self):
+        self.create_testusers()
+        UserSettings.objects.all().delete()
+        self.old_cache = models._USER_SETTINGS_CACHE
+        models._USER_SETTINGS_CACHE = {}
+
+        self.user = self._get_user(usertype="staff")
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        models._USER_SETTINGS_CACHE = self.old_cache
+
+    def get_request(self, path="/"):
+        request = self.factory.get(path)
+        request.user = self.user
+        return request
+
+    def test_lazy(self):
+        middleware = DBPreferencesMiddleware()
+        request = self.get_request()
+        with self.assertNumQueries(0):
+            middleware.process_request(request)
+            middleware.process_response(request, view(request))
+        self.assertIs(request.user_settings._wrapped, empty)
+
+    def test_save(self):
+        middleware = DBPreferencesMiddleware()
+        request = self.get_request()
+        middleware.process_request(request)
+        self.assertIsInstance(request.user_settings, SettingsDict)
+        request.user_settings["Foo"] = "Bar"
+        middleware.process_response(request, view(request))
+        self.assertEqual(UserSettings.objects.get(user=self.user).settings, {"Foo": "Bar"})
+
+        # Only read -> nothing to save:
+        request = self.get_request()
+        middleware.process_request(request)
+        self.assertEqual(request.user_settings["Foo"], "Bar")
+        with self.assertNumQueries(0):
+            middleware.process_response(request, view(request))
+
+    def test_new_style(self):
+        def get_response(request):
+            request.user_settings["Foo"] = "new style"
+            return view(request)
+
+        middleware = DBPreferencesMiddleware(get_response)
+        response = middleware(self.get_request())
+        self.assertEqual(response.content, b"OK")
+        self.assertEqual(UserSettings.objects.get(user=self.user).settings, {"Foo": "new style"})
+
+    def test_exclude_paths(self):
+        with override_settings(DBPREFERENCES_MIDDLEWARE_EXCLUDE_PATHS=("/static/", "/health")):
+            middleware = DBPreferencesMiddleware()
+
+        for path in ("/static/foo.css", "/health/"):
+            request = self.get_request(path)
+            middleware.process_request(request)
+            self.assertFalse(hasattr(request, "user_settings"))
+            middleware.process_response(request, view(request))
+
+        request = self.get_request("/foo/")
+        middleware.process_request(request)
+        self.assertTrue(hasattr(request, "user_settings"))
+
+    def test_exempt_view(self):
+        exempt_view = dbpreferences_exempt(view)
+        self.assertEqual(exempt_view.__name__, "view")
+
+        middleware = DBPreferencesMiddleware()
+        request = self.get_request()
+        middleware.process_request(request)
+        middleware.process_view(request, exempt_view, (), {})
+        self.assertFalse(hasattr(request, "user_settings"))
+        middleware.process_response(request, exempt_view(request))
+
+        request = self.get_request()
+        middleware.process_request(request)
+        middleware.process_view(request, view, (), {})
+        self.assertTrue(hasattr(request, "user_settings"))
+
+    def test_cache_check_on_access(self):
+        old_caches = list(GenerationCache.CACHES)
+        try:
+            cache = GenerationCache(id="unittest")
+            cache.check_state(force=True)
+            cache["foo"] = "bar"
+            CacheInvalidation.objects.add_entry(cache.id, "foo")
+
+            middleware = DBPreferencesMiddleware()
+            request = self.get_request()
+            with self.assertNumQueries(0):
+                middleware.process_request(request)
+                middleware.process_response(request, view(request))
+
+            # The first access in the next request checks the state:
+            middleware.process_request(self.get_request())
+            with self.assertNumQueries(1):
+                self.assertNotIn("foo", cache)
+            with self.assertNumQueries(0):
+                self.assertNotIn("foo", cache)
+        finally:
+            GenerationCache.CACHES[:] = old_caches
+
+    def test_without_write_behind_module(self):
+        # e.g.: Django < 1.8 can't import it, but it's only used if enabled:
+        old_module = sys.modules.pop("dbpreferences.write_behind", None)
+        sys.modules["dbpreferences.write_behind"] = None # -> ImportError
+        try:
+            user_settings = SettingsDict(self.user)
+            user_settings["Foo"] = "Bar"
+            user_settings.save()
+            user_settings["Foo"] = "Baz"
+            user_settings.save()
+        finally:
+            del sys.modules["dbpreferences.write_behind"]
+            if old_module is not None:
+                sys.modules["dbpreferences.write_behind"] = old_module
+        self.assertEqual(UserSettings.objects.get(user=self.user).settings, {"Foo": "Baz"})
@@ -0,0 +1,283 @@
+# coding: utf-8
+
+"""
+    unittests for the shared cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import shutil
+import tempfile
+
+try:
+    from django.core.cache import caches
+except ImportError: # Django < 1.7
+    from django.core.cache import get_cache
+    caches = None
+from django.test.utils import override_settings
+from django.utils import six
+
+from django_tools.unittest_utils.unittest_base import BaseTestCase
+
+from dbpreferences import models, forms
+from dbpreferences.models import Preference, UserSettings
+from dbpreferences.tools import generation_cache
+from dbpreferences.tools.shared_cache import SharedCache, model_snapshot
+
+from test_project.preference_forms import UnittestForm
+
+
+def clear_django_cache():
+    if caches is None:
+        get_cache("default").clear()
+    else:
+        caches["default"].clear()
+
+
+class SharedCacheTestMixin(object):
+    def setUp(self):
+        self.old_caches = list(generation_cache.CACHES)
+        # Two instances with the same id, as they would exist in two processes.
+        # Check the versions on every access:
+        self.cache1 = SharedCache("unittest", "default", check_interval=0)
+        self.cache2 = SharedCache("unittest", "default", check_interval=0)
+
+    def tearDown(self):
+        clear_django_cache()
+        generation_cache.CACHES[:] = self.old_caches
+
+    def test_set_get(self):
+        self.cache1["a"] = {"foo": "bar"}
+        self.assertEqual(self.cache1["a"], {"foo": "bar"})
+        self.assertEqual(self.cache2["a"], {"foo": "bar"})
+        self.assertEqual(self.cache2.keys(), ["a"])
+        self.assertNotIn("b", self.cache2)
+        self.assertEqual(self.cache2.get("b", "default"), "default")
+        self.assertRaises(KeyError, lambda: self.cache2["b"])
+
+    def test_invalidate(self):
+        self.cache1["a"] = 1
+        self.cache1["b"] = 2
+        self.assertEqual(self.cache2["a"], 1)
+
+        self.cache1.invalidate("a")
+        self.assertNotIn("a", self.cache1)
+        self.assertNotIn("a", self.cache2)
+        self.assertEqual(self.cache2["b"], 2)
+
+        self.cache2["a"] = "new"
+        self.assertEqual(self.cache1["a"], "new")
+
+    def test_pop(self):
+        self.cache1["a"] = 1
+        self.assertEqual(self.cache2.pop("a"), 1)
+        self.assertNotIn("a", self.cache1)
+        self.assertEqual(self.cache2.pop("a", "default"), "default")
+
+    def test_set_if_version(self):
+        self.cache1["a"] = 1
+        version = self.cache1.get_version("a")
+        self.assertTrue(self.cache1.set_if_version("a", version, 2))
+        self.assertEqual(self.cache2["a"], 2)
+
+        version = self.cache1.get_version("a")
+        self.cache2.invalidate("a")
+        self.assertFalse(self.cache1.set_if_version("a", version, 3))
+        self.assertNotIn("a", self.cache1)
+        self.assertNotIn("a", self.cache2)
+
+        # Never stored or cleared: no versions
+        self.assertFalse(self.cache1.set_if_version("b", self.cache1.get_version("b"), 1))
+
+    def test_clear(self):
+        self.cache1["a"] = 1
+        self.cache2["b"] = 2
+        self.cache2.clear()
+        self.assertEqual(len(self.cache2), 0)
+        self.assertNotIn("a", self.cache1)
+        self.assertNotIn("b", self.cache1)
+        self.assertEqual(len(self.cache1), 0)
+
+        self.cache1["a"] = "new"
+        self.assertEqual(self.cache2["a"], "new")
+
+    def test_local_entry(self):
+        value = {"foo": "bar"}
+        self.cache1["a"] = value
+        self.assertIs(self.cache1["a"], value) # not unpickled again
+        self.assertIsNot(self.cache2["a"], value)
+        self.assertIs(self.cache2["a"], self.cache2["a"])
+
+    def test_evicted_entry(self):
+        self.cache1["a"] = 1
+        clear_django_cache() # e.g.: memcached restarted
+        self.assertNotIn("a", self.cache1)
+        self.cache2["a"] = 2
+        self.assertEqual(self.cache1["a"], 2)
+
+    def test_other_id(self):
+        self.cache1["a"] = 1
+        other = SharedCache("unittest_other", "default")
+        self.assertNotIn("a", other)
+        other.clear()
+        self.assertEqual(self.cache2["a"], 1)
+
+    def test_snapshot_conversion(self):
+        cache1 = SharedCache("unittest", "default", check_interval=0,
+            to_snapshot=lambda value: value * 2, from_snapshot=lambda value: value + 1
+        )
+        cache1["a"] = 10
+        self.assertEqual(cache1["a"], 10) # local entry
+        self.assertEqual(self.cache2["a"], 20)
+        cache2 = SharedCache("unittest", "default", check_interval=0,
+            from_snapshot=lambda value: value + 1
+        )
+        self.assertEqual(cache2["a"], 21)
+
+
+class CountingSharedCache(SharedCache):
+    """ counts the round trips to the django cache """
+    def __init__(self, *args, **kwargs):
+        super(CountingSharedCache, self).__init__(*args, **kwargs)
+        self.version_checks = 0
+
+    def _get_versions(self, key, create=False):
+        self.version_checks += 1
+        return super(CountingSharedCache, self)._get_versions(key, create)
+
+
+class TestLocMemSharedCache(SharedCacheTestMixin, BaseTestCase):
+    def test_check_once_per_request(self):
+        cache = CountingSharedCache("unittest", "default")
+        self.cache1["a"] = 1
+        for no in range(3):
+            self.assertEqual(cache["a"], 1)
+        self.assertEqual(cache.version_checks, 1)
+
+        # Invalidated by a other process: the local entry is used until the next request
+        self.cache1["a"] = 2
+        self.cache1.invalidate("a")
+        self.cache1["a"] = 2
+        self.assertEqual(cache["a"], 1)
+        generation_cache.check_caches_on_access() # e.g. by the middleware
+        self.assertEqual(cache["a"], 2)
+        self.assertEqual(cache["a"], 2)
+        self.assertEqual(cache.version_checks, 2)
+
+        # The own invalidation is seen at once:
+        cache.invalidate("a")
+        self.assertNotIn("a", cache)
+
+    def test_check_interval(self):
+        cache = CountingSharedCache("unittest", "default", check_interval=60)
+        self.cache1["a"] = 1
+        self.assertEqual(cache["a"], 1)
+        self.assertEqual(cache["a"], 1)
+        self.assertEqual(cache.version_checks, 1)
+
+        versions, value, epoch, checked = cache._local["a"]
+        cache._local["a"] = (versions, value, epoch, checked - 61) # interval reached
+        self.assertEqual(cache["a"], 1)
+        self.assertEqual(cache.version_checks, 2)
+
+
+class TestFileBasedSharedCache(SharedCacheTestMixin, BaseTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="dbpreferences_")
+        self.settings_override = override_settings(CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": self.temp_dir,
+            }
+        })
+        self.settings_override.enable()
+        super(TestFileBasedSharedCache, self).setUp()
+
+    def tearDown(self):
+        super(TestFileBasedSharedCache, self).tearDown()
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True) # Django 1.6: removed by clear()
+
+
+class TestSharedPreferences(BaseTestCase):
+    def setUp(self):
+        Preference.objects.all().delete()
+        self.old_preferences_cache = forms._PREFERENCES_CACHE
+        self.old_user_settings_cache = models._USER_SETTINGS_CACHE
+        self.old_caches = list(generation_cache.CACHES)
+        clear_django_cache()
+        self.new_process()
+
+    def tearDown(self):
+        forms._PREFERENCES_CACHE = self.old_preferences_cache
+        models._USER_SETTINGS_CACHE = self.old_user_settings_cache
+        generation_cache.CACHES[:] = self.old_caches
+        clear_django_cache()
+
+    def new_process(self):
+        """ replace the caches with new instances, like in a other process """
+        forms._PREFERENCES_CACHE = SharedCache("form", "default", check_interval=0,
+            to_snapshot=forms.to_snapshot, from_snapshot=forms.from_snapshot
+        )
+        models._USER_SETTINGS_CACHE = SharedCache("user_settings", "default", check_interval=0,
+            to_snapshot=models.user_settings_snapshot,
+            from_snapshot=models.user_settings_from_snapshot
+        )
+
+    def test_model_snapshot(self):
+        UnittestForm().get_preferences() # create the db entry
+        instance = Preference.objects.get()
+        snapshot = model_snapshot(instance)
+        self.assertIsNot(snapshot, instance)
+        self.assertIsInstance(snapshot.__dict__["preferences"], six.string_types)
+        self.assertEqual(snapshot.preferences, instance.preferences)
+        self.assertFalse(snapshot.has_changed())
+
+    def test_preferences(self):
+        self.new_process()
+        UnittestForm().get_preferences() # create the db entry
+        UnittestForm().get_preferences() # put it into the cache
+
+        self.new_process()
+        with self.assertNumQueries(0):
+            self.assertEqual(UnittestForm().get_preferences()["count"], 10)
+
+        form = UnittestForm()
+        form["count"] = 20
+        form.save()
+
+        self.new_process()
+        with self.assertNumQueries(1):
+            self.assertEqual(UnittestForm().get_preferences()["count"], 20)
+        with self.assertNumQueries(0):
+            self.assertEqual(UnittestForm().get_preferences()["count"], 20)
+
+    def test_user_settings(self):
+        self.create_testusers()
+        user = self._get_user(usertype="normal")
+        UserSettings.objects.create(
+            user=user, settings={"foo": "bar"}, createby=user, lastupdateby=user
+        )
+
+        self.new_process()
+        with self.assertNumQueries(1):
+            instance, user_settings = UserSettings.objects.get_settings(user)
+        self.assertEqual(user_settings, {"foo": "bar"})
+
+        self.new_process()
+        with self.assertNumQueries(0):
+            instance, user_settings = UserSettings.objects.get_settings(user)
+        self.assertEqual(user_settings, {"foo": "bar"})
+        self.assertIs(instance.settings, user_settings)
+
+        instance.settings["foo"] = "new"
+        instance.save()
+
+        self.new_process()
+        with self.assertNumQueries(1):
+            instance, user_settings = UserSettings.objects.get_settings(user)
+        self.assertEqual(user_settings, {"foo": "new"})
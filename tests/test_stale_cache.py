@@ -0,0 +1,303 @@
+# coding: utf-8
+
+"""
+    unittests for the stale-while-revalidate cache mode
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import threading
+import time
+import unittest
+import weakref
+
+from django.utils import timezone
+
+from django_tools.unittest_utils.unittest_base import BaseTestCase
+
+from dbpreferences import forms, models
+from dbpreferences.tools import stale_cache
+from dbpreferences.models import Preference, UserSettings
+from dbpreferences.tools.stale_cache import RefreshPool, StaleWhileRevalidate
+
+from test_project.preference_forms import UnittestForm
+
+
+class SyncPool(object):
+    """ runs the refresh directly, like a finished background thread """
+    def submit(self, func, *args):
+        func(*args)
+        return True
+
+
+class Entry(object):
+    """ a cache entry """
+
+
+def expire(entry):
+    entry._cache_expires = time.time() - 1
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    def setUp(self):
+        self.refreshed = []
+        self.entry = Entry()
+
+    def refresh(self, ttl, *args):
+        """ reload the entry, like refresh_cache_entry() """
+        self.refreshed.append(args)
+        ttl.stored(self.entry)
+
+    def test_disabled(self):
+        ttl = StaleWhileRevalidate(ttl=None, pool=SyncPool())
+        ttl.stored(self.entry)
+        ttl.check("a", self.entry, self.refresh, ttl)
+        self.assertEqual(ttl.get_expires(self.entry), None)
+        self.assertEqual(self.refreshed, [])
+
+    def test_refresh(self):
+        ttl = StaleWhileRevalidate(ttl=60, pool=SyncPool())
+        ttl.stored(self.entry)
+        ttl.check("a", self.entry, self.refresh, ttl, 1, 2)
+        self.assertEqual(self.refreshed, [])
+
+        expire(self.entry)
+        ttl.check("a", self.entry, self.refresh, ttl, 1, 2)
+        self.assertEqual(self.refreshed, [(1, 2)])
+        self.assertGreater(ttl.get_expires(self.entry), time.time())
+        self.assertEqual(ttl._refreshing, set())
+
+    def test_unknown_entry(self):
+        ttl = StaleWhileRevalidate(ttl=60, pool=SyncPool())
+        ttl.check("a", self.entry, self.refresh, ttl)
+        self.assertGreater(ttl.get_expires(self.entry), time.time())
+        self.assertEqual(self.refreshed, [])
+
+    def test_no_references(self):
+        # The expire time is gone with the invalidated or evicted entry:
+        ttl = StaleWhileRevalidate(ttl=60, pool=SyncPool())
+        entry = Entry()
+        ttl.stored(entry)
+        expire(entry)
+        ttl.check("a", entry, self.refresh, ttl)
+        ref = weakref.ref(entry)
+        del entry
+        self.assertIs(ref(), None)
+        self.assertEqual(ttl._refreshing, set())
+
+    def test_jitter(self):
+        ttl = StaleWhileRevalidate(ttl=100, jitter=0.1, pool=SyncPool())
+        now = time.time()
+        entries = [Entry() for no in range(100)]
+        for entry in entries:
+            ttl.stored(entry)
+        expires = [ttl.get_expires(entry) - now for entry in entries]
+        self.assertGreaterEqual(min(expires), 90)
+        self.assertLessEqual(max(expires), 110 + 1)
+        self.assertGreater(len(set(expires)), 1)
+
+    def test_refresh_error(self):
+        def refresh():
+            raise RuntimeError("DB is down")
+        ttl = StaleWhileRevalidate(ttl=60, pool=SyncPool())
+        ttl.stored(self.entry)
+        expire(self.entry)
+        self.assertRaises(RuntimeError, ttl.check, "a", self.entry, refresh)
+        self.assertEqual(ttl._refreshing, set())
+        self.assertLess(ttl.get_expires(self.entry), time.time()) # retry on next access
+
+    def test_one_refresh_for_many_threads(self):
+        pool = RefreshPool(max_workers=2)
+        ttl = StaleWhileRevalidate(ttl=60, pool=pool)
+        ttl.stored(self.entry)
+        expire(self.entry)
+
+        started = threading.Event()
+        release = threading.Event()
+        def refresh():
+            started.set()
+            release.wait(5)
+            self.refresh(ttl)
+
+        threads = [
+            threading.Thread(target=ttl.check, args=("a", self.entry, refresh))
+            for no in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(started.wait(5))
+        release.set()
+        pool.join()
+
+        self.assertEqual(self.refreshed, [()])
+        self.assertLessEqual(len(pool._workers), 2)
+        self.assertEqual(ttl._refreshing, set())
+
+    def test_full_queue(self):
+        release = threading.Event()
+        pool = RefreshPool(max_workers=1, max_queue=1)
+        self.assertTrue(pool.submit(release.wait, 5))
+        ttl = StaleWhileRevalidate(ttl=60, pool=pool)
+        try:
+            for key in ("a", "b", "c"):
+                entry = Entry()
+                ttl.stored(entry)
+                expire(entry)
+                ttl.check(key, entry, self.refresh, ttl)
+        finally:
+            release.set()
+        pool.join()
+        # Not all refreshes fit into the queue, but the keys are not blocked:
+        self.assertLess(len(self.refreshed), 3)
+        self.assertEqual(ttl._refreshing, set())
+
+
+class BrokenConnections(object):
+    def all(self):
+        raise RuntimeError("can't close")
+
+
+class TestRefreshPool(unittest.TestCase):
+    def test_cleanup_error(self):
+        pool = RefreshPool(max_workers=1)
+        done = []
+        old_connections = stale_cache.connections
+        stale_cache.connections = BrokenConnections()
+        stale_cache.log.disabled = True
+        try:
+            for no in range(2):
+                self.assertTrue(pool.submit(done.append, no))
+            joined = threading.Thread(target=pool.join)
+            joined.start()
+            joined.join(5)
+        finally:
+            stale_cache.connections = old_connections
+            stale_cache.log.disabled = False
+        self.assertFalse(joined.is_alive())
+        self.assertEqual(done, [0, 1]) # the worker is still alive
+
+
+class TestStaleWhileRevalidateIntegration(BaseTestCase):
+    def setUp(self):
+        Preference.objects.all().delete()
+        self.old_preferences_cache = forms._PREFERENCES_CACHE
+        self.old_preferences_ttl = forms._PREFERENCES_TTL
+        self.old_user_settings_cache = models._USER_SETTINGS_CACHE
+        self.old_user_settings_ttl = models._USER_SETTINGS_TTL
+        forms._PREFERENCES_CACHE = {}
+        forms._PREFERENCES_TTL = StaleWhileRevalidate(ttl=60, pool=SyncPool())
+        models._USER_SETTINGS_CACHE = {}
+        models._USER_SETTINGS_TTL = StaleWhileRevalidate(ttl=60, pool=SyncPool())
+
+    def tearDown(self):
+        forms._PREFERENCES_CACHE = self.old_preferences_cache
+        forms._PREFERENCES_TTL = self.old_preferences_ttl
+        models._USER_SETTINGS_CACHE = self.old_user_settings_cache
+        models._USER_SETTINGS_TTL = self.old_user_settings_ttl
+
+    def test_preferences(self):
+        UnittestForm().get_preferences() # create the db entry
+        form = UnittestForm()
+        form.get_preferences()
+        cache_key = form.cache_key
+        cache_entry = forms._PREFERENCES_CACHE[cache_key]
+        self.assertGreater(forms._PREFERENCES_TTL.get_expires(cache_entry), time.time())
+
+        # Changed without cache invalidation, e.g. by a other process:
+        preferences = Preference.objects.get(form_name="UnittestForm").preferences
+        preferences["count"] = 20
+        Preference.objects.filter(form_name="UnittestForm").update(
+            preferences=preferences, lastupdatetime=timezone.now()
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(UnittestForm().get_preferences()["count"], 10)
+
+        expire(cache_entry)
+        # The stale entry is served, the refresh stores the new one:
+        self.assertEqual(UnittestForm().get_preferences()["count"], 10)
+        with self.assertNumQueries(0):
+            self.assertEqual(UnittestForm().get_preferences()["count"], 20)
+
+    def test_unchanged_preferences(self):
+        UnittestForm().get_preferences() # create the db entry
+        form = UnittestForm()
+        form.get_preferences()
+        cache_entry = forms._PREFERENCES_CACHE[form.cache_key]
+
+        expire(cache_entry)
+        UnittestForm().get_preferences()
+        # The entry with the validated cleaned_data is kept:
+        self.assertIs(forms._PREFERENCES_CACHE[form.cache_key], cache_entry)
+        self.assertGreater(forms._PREFERENCES_TTL.get_expires(cache_entry), time.time())
+
+    def patch_get(self, manager, concurrent):
+        """ call concurrent() after the query of the next manager.get() """
+        def get(**kwargs):
+            del manager.get
+            instance = manager.get(**kwargs)
+            concurrent()
+            return instance
+        manager.get = get
+
+    def test_preferences_invalidated_while_refreshing(self):
+        UnittestForm().get_preferences() # create the db entry
+        form = UnittestForm()
+        form.get_preferences()
+        expire(forms._PREFERENCES_CACHE[form.cache_key])
+
+        def save_concurrent():
+            form = UnittestForm()
+            form["count"] = 20
+            form.save()
+        self.patch_get(Preference.objects, save_concurrent)
+        UnittestForm().get_preferences()
+        # The row read by the refresh is older than the invalidation:
+        self.assertNotIn(form.cache_key, forms._PREFERENCES_CACHE)
+        self.assertEqual(UnittestForm().get_preferences()["count"], 20)
+
+    def test_user_settings_invalidated_while_refreshing(self):
+        self.create_testusers()
+        user = self._get_user(usertype="normal")
+        UserSettings.objects.create(
+            user=user, settings={"foo": "bar"}, createby=user, lastupdateby=user
+        )
+        instance, user_settings = UserSettings.objects.get_settings(user)
+        expire(instance)
+
+        def save_concurrent():
+            instance = UserSettings.objects.get(user=user)
+            instance.settings = {"foo": "new"}
+            instance.save()
+        self.patch_get(UserSettings.objects, save_concurrent)
+        UserSettings.objects.get_settings(user)
+        cache_key = models.get_user_settings_cache_key(user.pk)
+        self.assertNotIn(cache_key, models._USER_SETTINGS_CACHE)
+        instance, user_settings = UserSettings.objects.get_settings(user)
+        self.assertEqual(user_settings, {"foo": "new"})
+
+    def test_user_settings(self):
+        self.create_testusers()
+        user = self._get_user(usertype="normal")
+        UserSettings.objects.create(
+            user=user, settings={"foo": "bar"}, createby=user, lastupdateby=user
+        )
+        UserSettings.objects.get_settings(user)
+        UserSettings.objects.filter(user=user).update(settings={"foo": "new"})
+
+        instance, user_settings = UserSettings.objects.get_settings(user)
+        self.assertEqual(user_settings, {"foo": "bar"})
+
+        expire(instance)
+        instance, user_settings = UserSettings.objects.get_settings(user)
+        self.assertEqual(user_settings, {"foo": "bar"})
+        with self.assertNumQueries(0):
+            instance, user_settings = UserSettings.objects.get_settings(user)
+        self.assertEqual(user_settings, {"foo": "new"})
+
@@ -0,0 +1,111 @@
+# coding: utf-8
+
+"""
+    unittests for the sync_preferences management command
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.utils import six
+
+from django_tools.unittest_utils.unittest_base import BaseTestCase
+
+from dbpreferences import forms
+from dbpreferences.form_registry import form_registry
+from dbpreferences.models import Preference
+
+from test_project.preference_forms import UnittestForm
+
+
+class TestSyncPreferences(BaseTestCase):
+    def setUp(self):
+        Preference.objects.all().delete()
+        self.old_preferences_cache = forms._PREFERENCES_CACHE
+        forms._PREFERENCES_CACHE = {}
+        self.site2 = Site.objects.create(domain="two.example.com", name="two")
+
+    def tearDown(self):
+        forms._PREFERENCES_CACHE = self.old_preferences_cache
+
+    def call_command(self, *args, **kwargs):
+        out = six.StringIO()
+        call_command("sync_preferences", *args, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def get_keys(self):
+        return sorted(
+            Preference.objects.values_list("site_id", "app_label", "form_name")
+        )
+
+    def test_create_missing(self):
+        UnittestForm().get_preferences() # exists for the current site
+        out = self.call_command(batch_size=1)
+
+        form_count = len(form_registry)
+        self.assertIn("%i preferences entries created, 1 exists." % (form_count * 2 - 1), out)
+        expected = sorted(
+            (site_id, app_label, form_name)
+            for site_id in (Site.objects.get_current().id, self.site2.id)
+            for app_label, form_name in form_registry.keys()
+        )
+        self.assertEqual(self.get_keys(), expected)
+
+        instance = Preference.objects.get(site=self.site2, form_name="UnittestForm")
+        self.assertEqual(instance.preferences,
+            {'count': 10, 'foo_bool': True, 'font_size': 0.7, 'subject': 'foobar'}
+        )
+
+        # Nothing to do on the second run:
+        with self.assertNumQueries(2):
+            out = self.call_command()
+        self.assertIn("0 preferences entries created", out)
+
+    def test_site_and_dry_run(self):
+        out = self.call_command(site_ids=[self.site2.id], dry_run=True)
+        self.assertIn("create: test_project.UnittestForm for site two.example.com", out)
+        self.assertIn("preferences entries missing, 0 exists.", out)
+        self.assertEqual(self.get_keys(), [])
+
+        self.call_command(site_ids=[self.site2.id])
+        self.assertEqual(
+            set(site_id for site_id, app_label, form_name in self.get_keys()),
+            set([self.site2.id])
+        )
+
+    def test_changed_fields(self):
+        UnittestForm().get_preferences()
+        instance = Preference.objects.get(form_name="UnittestForm")
+        del instance.preferences["count"]
+        instance.preferences["old_field"] = 1
+        instance.save()
+
+        # The sites and all existing entries with their site:
+        with self.assertNumQueries(2):
+            out = self.call_command(dry_run=True)
+        self.assertIn("test_project.UnittestForm: new fields: count", out)
+        self.assertIn("test_project.UnittestForm: removed fields: old_field", out)
+
+    def test_not_registered(self):
+        Preference.objects.create(
+            site=self.site2, app_label="test_project", form_name="RemovedForm", preferences={}
+        )
+        out = self.call_command(dry_run=True)
+        self.assertIn("test_project.RemovedForm: form is not registered", out)
+
+    @override_settings(DBPREFERENCES_PRELOAD=True)
+    def test_preload_marker(self):
+        UnittestForm().get_preferences() # create the db entry
+        UnittestForm().get_preferences() # preload
+        preload_key = forms.get_preload_key(Site.objects.get_current().id)
+        self.assertIn(preload_key, forms._PREFERENCES_CACHE)
+
+        # The new rows must be found by the next preload:
+        self.call_command()
+        self.assertNotIn(preload_key, forms._PREFERENCES_CACHE)
@@ -0,0 +1,311 @@
+# coding: utf-8
+
+"""
+    unittests for the write-behind user settings
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyleft: 2015 by the dbpreferences team, see AUTHORS for more details.
+    :license: GNU GPL v3 or above, see LICENSE for more details.
+"""
+
+from __future__ import absolute_import, print_function
+
+import threading
+import unittest
+
+import django
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from django_tools.unittest_utils.unittest_base import BaseTestCase
+
+from dbpreferences import models
+from dbpreferences.middleware import SettingsDict
+from dbpreferences.models import CacheInvalidation, UserSettings
+from dbpreferences.tools.generation_cache import GenerationCache
+
+if django.VERSION >= (1, 8):
+    from dbpreferences import write_behind
+else: # Needs Case/When, see TestWriteBehind
+    write_behind = None
+
+
+def recording_queue(**kwargs):
+    """ returns a queue, that counts the flushes, without writing anything """
+    queue = write_behind.WriteBehindQueue(**kwargs)
+    queue.flushed = threading.Event()
+    queue.flush = queue.flushed.set
+    return queue
+
+
+@unittest.skipIf(write_behind is None, "The write-behind needs Django 1.8 or newer")
+class TestWriteBehind(BaseTestCase):
+    def setUp(self):
+        self.create_testusers()
+        UserSettings.objects.all().delete()
+
+        self.old_cache = models._USER_SETTINGS_CACHE
+        models._USER_SETTINGS_CACHE = {}
+        self.old_caches = list(GenerationCache.CACHES)
+        self.old_queue = write_behind._WRITE_BEHIND_QUEUE
+        write_behind._WRITE_BEHIND_QUEUE = None
+
+        self.users = [self._get_user(usertype) for usertype in ("normal", "staff", "superuser")]
+        self.instances = [
+            UserSettings.objects.create(user=user, settings={"count": 0},
+                createby=user, lastupdateby=user
+            )
+            for user in self.users
+        ]
+
+    def tearDown(self):
+        models._USER_SETTINGS_CACHE = self.old_cache
+        GenerationCache.CACHES[:] = self.old_caches
+        write_behind._WRITE_BEHIND_QUEUE = self.old_queue
+
+    def db_settings(self, user):
+        return UserSettings.objects.get(user=user).settings
+
+    def test_coalesce(self):
+        queue = write_behind.WriteBehindQueue(background=False)
+        instance = self.instances[0]
+        for count in range(1, 4):
+            instance.settings["count"] = count
+            self.assertTrue(queue.add(instance))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 0})
+
+        queue.flush()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 3})
+        self.assertEqual(UserSettings.objects.get(user=self.users[0]).version, 1)
+
+    def test_unchanged(self):
+        queue = write_behind.WriteBehindQueue(background=False)
+        instance = self.instances[0]
+        self.assertTrue(queue.add(instance))
+        self.assertEqual(len(queue), 0)
+
+        instance.settings["count"] = 1
+        queue.add(instance)
+        queue.flush()
+        # The queued state counts as saved:
+        self.assertFalse(instance.has_changed())
+        self.assertTrue(queue.add(instance))
+        self.assertEqual(len(queue), 0)
+
+    def test_one_query_per_batch(self):
+        queue = write_behind.WriteBehindQueue(batch_size=2, background=False)
+        for no, instance in enumerate(self.instances):
+            instance.settings["count"] = no + 10
+            queue.add(instance)
+
+        with CaptureQueriesContext(connection) as queries:
+            queue.flush()
+        self.assertEqual(len(queries), 2) # two UPDATE for 3 users
+
+        for no, user in enumerate(self.users):
+            self.assertEqual(self.db_settings(user), {"count": no + 10})
+
+    def save_concurrent(self, user, **values):
+        """ save the settings like a other process, without the write-behind """
+        instance = UserSettings.objects.get(user=user)
+        instance.settings.update(values)
+        instance.save()
+
+    def test_concurrent_save(self):
+        queue = write_behind.WriteBehindQueue(background=False)
+        instance = self.instances[0]
+        instance.settings["count"] = 1
+        queue.add(instance, ["count"])
+        self.save_concurrent(self.users[0], other="value")
+
+        queue.flush()
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 1, "other": "value"})
+        self.assertEqual(UserSettings.objects.get(user=self.users[0]).version, 2)
+
+    def test_conflict_in_batch(self):
+        queue = write_behind.WriteBehindQueue(background=False)
+        for instance in self.instances:
+            instance.settings["count"] = 1
+            queue.add(instance, ["count"])
+        self.save_concurrent(self.users[1], count=5, other="value")
+
+        queue.flush()
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 1})
+        self.assertEqual(self.db_settings(self.users[1]), {"count": 1, "other": "value"})
+        self.assertEqual(self.db_settings(self.users[2]), {"count": 1})
+        self.assertEqual(
+            [UserSettings.objects.get(user=user).version for user in self.users], [1, 2, 1]
+        )
+
+    def test_conflict_retry(self):
+        queue = write_behind.WriteBehindQueue(background=False)
+        self.instances[0].settings["count"] = 1
+        queue.add(self.instances[0], ["count"])
+        self.save_concurrent(self.users[0], first=1)
+
+        # Saved again, while the conflict is merged:
+        original_save = UserSettings.save
+        def save(instance, *args, **kwargs):
+            UserSettings.save = original_save
+            self.save_concurrent(self.users[0], second=2)
+            return original_save(instance, *args, **kwargs)
+        UserSettings.save = save
+        try:
+            queue.flush()
+        finally:
+            UserSettings.save = original_save
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 1, "first": 1, "second": 2})
+
+    def test_coalesce_reloaded(self):
+        queue = write_behind.WriteBehindQueue(background=False)
+        self.instances[0].settings["count"] = 1
+        queue.add(self.instances[0], ["count"])
+
+        # Reloaded from the database, without the queued state:
+        self.save_concurrent(self.users[0], other="value")
+        instance = UserSettings.objects.get(user=self.users[0])
+        instance.settings["new"] = True
+        queue.add(instance, ["new"])
+        self.assertEqual(len(queue), 1)
+
+        queue.flush()
+        self.assertEqual(self.db_settings(self.users[0]),
+            {"count": 1, "other": "value", "new": True}
+        )
+
+    def test_one_log_insert_per_batch(self):
+        models._USER_SETTINGS_CACHE = GenerationCache(id="unittest_user_settings", check_interval=0)
+        queue = write_behind.WriteBehindQueue(batch_size=2, background=False)
+        for instance in self.instances:
+            instance.settings["count"] = 1
+            queue.add(instance)
+        start = CacheInvalidation.objects.get_generation()
+
+        with CaptureQueriesContext(connection) as queries:
+            queue.flush()
+        inserts = [query for query in queries if "INSERT INTO" in query["sql"]]
+        self.assertEqual(len(inserts), 2) # one per batch
+        self.assertEqual(
+            sorted(CacheInvalidation.objects.filter(id__gt=start).values_list("key", flat=True)),
+            sorted(models.get_user_settings_cache_key(user.pk) for user in self.users)
+        )
+
+    def test_invalidate(self):
+        models._USER_SETTINGS_CACHE = {
+            models.get_user_settings_cache_key(self.users[0].pk): "old", "other": "entry"
+        }
+        queue = write_behind.WriteBehindQueue(background=False)
+        self.instances[0].settings["count"] = 1
+        queue.add(self.instances[0])
+        self.assertEqual(len(models._USER_SETTINGS_CACHE), 2)
+        queue.flush()
+        self.assertEqual(models._USER_SETTINGS_CACHE, {"other": "entry"})
+
+    def test_full_queue(self):
+        queue = write_behind.WriteBehindQueue(max_size=2, background=False)
+        for no, instance in enumerate(self.instances):
+            instance.settings["count"] = 1
+            self.assertEqual(queue.add(instance), no < 2)
+
+        # A queued user can always be updated:
+        self.instances[0].settings["count"] = 2
+        self.assertTrue(queue.add(self.instances[0]))
+        self.assertEqual(len(queue), 2)
+
+    def test_error_requeue(self):
+        queue = write_behind.WriteBehindQueue(background=False)
+        self.instances[0].settings["count"] = 1
+        queue.add(self.instances[0])
+
+        def broken_write(batch):
+            # A newer state is queued, while the old one is written:
+            self.instances[0].settings["count"] = 2
+            queue.add(self.instances[0])
+            raise RuntimeError("DB is down")
+        queue._write = broken_write
+        write_behind.log.disabled = True
+        try:
+            queue.flush()
+        finally:
+            write_behind.log.disabled = False
+        self.assertEqual(len(queue), 1)
+
+        del queue._write
+        queue.flush()
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 2})
+
+    def test_batch_size_trigger(self):
+        queue = recording_queue(batch_size=2, flush_interval=60)
+        self.instances[0].settings["count"] = 1
+        queue.add(self.instances[0])
+        self.assertFalse(queue.flushed.wait(0.1))
+
+        self.instances[1].settings["count"] = 1
+        queue.add(self.instances[1])
+        self.assertTrue(queue.flushed.wait(5))
+        queue.shutdown()
+
+    def test_time_trigger(self):
+        queue = recording_queue(flush_interval=0.01)
+        self.instances[0].settings["count"] = 1
+        queue.add(self.instances[0])
+        self.assertTrue(queue.flushed.wait(5))
+        queue.shutdown()
+
+    def test_shutdown(self):
+        queue = recording_queue(flush_interval=60)
+        self.instances[0].settings["count"] = 1
+        queue.add(self.instances[0])
+        self.assertFalse(queue.flushed.is_set())
+        queue.shutdown()
+        self.assertTrue(queue.flushed.is_set())
+        self.assertFalse(queue._thread.is_alive())
+
+    def test_disabled(self):
+        self.assertEqual(write_behind.get_write_behind_queue(), None)
+
+        user_settings = SettingsDict(self.users[0])
+        user_settings["count"] = 1
+        user_settings.save()
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 1})
+
+    def test_middleware(self):
+        write_behind._WRITE_BEHIND_QUEUE = write_behind.WriteBehindQueue(background=False)
+        with override_settings(DBPREFERENCES_WRITE_BEHIND=True):
+            for count in (1, 2):
+                user_settings = SettingsDict(self.users[0])
+                user_settings["count"] = count
+                user_settings.save()
+
+                # The cached instance of this process is up to date:
+                self.assertEqual(SettingsDict(self.users[0])["count"], count)
+                self.assertEqual(self.db_settings(self.users[0]), {"count": 0})
+
+        write_behind.flush_write_behind()
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 2})
+
+    def test_middleware_concurrent(self):
+        write_behind._WRITE_BEHIND_QUEUE = write_behind.WriteBehindQueue(background=False)
+        with override_settings(DBPREFERENCES_WRITE_BEHIND=True):
+            user_settings = SettingsDict(self.users[0])
+            user_settings["count"] = 1
+            user_settings.save()
+
+        # A other request without write-behind:
+        models._USER_SETTINGS_CACHE = {}
+        user_settings = SettingsDict(self.users[0])
+        user_settings["other"] = "value"
+        user_settings.save()
+
+        write_behind.flush_write_behind()
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 1, "other": "value"})
+
+    def test_middleware_full_queue(self):
+        write_behind._WRITE_BEHIND_QUEUE = write_behind.WriteBehindQueue(max_size=0, background=False)
+        with override_settings(DBPREFERENCES_WRITE_BEHIND=True):
+            user_settings = SettingsDict(self.users[0])
+            user_settings["count"] = 1
+            user_settings.save()
+        self.assertEqual(self.db_settings(self.users[0]), {"count": 1})